@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Compare computing the md5 and sha256 checksums the fetcher verifies
+# with bb.utils.file_digests() against reading the file twice, line by
+# line, as was done before. Give the files to checksum, for example
+# downloaded archives, or --size to create a file of random data first:
+#
+#   checksum_benchmark.py [--size <MiB>] [--blocksize <KiB>] [<file>...]
+#
+# The output format is:
+# file size-MiB two-pass-seconds single-pass-seconds
+#
+
+import hashlib
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+# For importing bb
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+
+import bb.utils
+
+def two_pass(filename):
+    digests = {}
+    for name in ["md5", "sha256"]:
+        hasher = hashlib.new(name)
+        with open(filename, "rb") as f:
+            for line in f:
+                hasher.update(line)
+        digests[name] = hasher.hexdigest()
+    return digests
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [--size <MiB>] [--blocksize <KiB>] [<file>...]")
+    parser.add_option("-s", "--size", type = "int", default = 0,
+                      help = "create and checksum a file of this many MiB of random data")
+    parser.add_option("-b", "--blocksize", type = "int", default = 1024,
+                      help = "block size for file_digests() in KiB (default 1024)")
+    options, files = parser.parse_args()
+
+    created = None
+    if options.size:
+        fd, created = tempfile.mkstemp(prefix = "checksum_benchmark.")
+        with os.fdopen(fd, "wb") as f:
+            for _ in xrange(options.size):
+                f.write(os.urandom(1024 * 1024))
+        files.append(created)
+
+    if not files:
+        parser.error("no files given")
+
+    try:
+        for filename in files:
+            # Read once first so that both start with the file in the page cache
+            bb.utils.file_digests(filename, ["md5"])
+            old, oldtime = timed(two_pass, filename)
+            new, newtime = timed(bb.utils.file_digests, filename, ["md5", "sha256"], options.blocksize * 1024)
+            if old != new:
+                sys.exit("Checksums of %s differ: %s %s" % (filename, old, new))
+            print("%s %.1f %.2f %.2f" % (filename, os.path.getsize(filename) / 1048576.0, oldtime, newtime))
+    finally:
+        if created:
+            os.unlink(created)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Time datastore operations on copies of a recipe's datastore, made
+# createCopy() of a createCopy() up to the given depth, each copy setting
+# a few variables as the worker and class extension do. Run from an
+# initialised build directory:
+#
+#   datastore_benchmark.py <recipe file> <depth>
+#
+# The output format is:
+# depth variables getvar-microseconds iter-milliseconds copy-microseconds
+#
+
+import os
+import sys
+import time
+
+# For importing bb
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+
+import bb.cache
+import bb.cooker
+import bb.tinfoil
+
+def timeit(func, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+def main(argv=None):
+    if len(argv) != 2:
+        print >>sys.stderr, "usage: %s <recipe file> <depth>" % os.path.basename(sys.argv[0])
+        return 2
+    fn, depth = os.path.abspath(argv[0]), int(argv[1])
+
+    tinfoil = bb.tinfoil.Tinfoil(output=sys.stderr)
+    tinfoil.prepare(config_only=True)
+    cooker = tinfoil.cooker
+    collection = bb.cooker.CookerCollectFiles(cooker.recipecache.bbfile_config_priorities)
+    d = bb.cache.Cache.loadDataFull(fn, collection.get_file_appends(fn), cooker.data)
+    tinfoil.shutdown()
+
+    keys = list(d)
+    for level in xrange(depth + 1):
+        if level:
+            d = d.createCopy()
+            d.setVar("BENCHMARK_LEVEL", str(level))
+            d.setVar("PN", d.getVar("PN", False))
+            d.setVarFlag("do_compile", "benchmark", str(level))
+        def getvars():
+            for key in keys:
+                d.getVar(key, False)
+        getvar = timeit(getvars, 5) / len(keys)
+        iterate = timeit(lambda: list(d), 5)
+        copy = timeit(d.createCopy, 100)
+        print("%d %d %.2f %.2f %.2f" % (level, len(keys), getvar * 1e6, iterate * 1e3, copy * 1e6))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
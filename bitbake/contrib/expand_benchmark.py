@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Measure variable expansion while parsing recipes in a single process.
+# Run from an initialised build directory, giving the recipes to parse
+# (all the recipes in BBFILES if none are given):
+#
+#   expand_benchmark.py [--wipe] [<recipe file>...]
+#
+# --wipe empties the expansion cache on every write to the datastore, as
+# was done before the cache tracked what each expansion referenced.
+#
+# The output format is:
+# recipes getvar-expand-calls expansions cpu-seconds
+#
+
+import os
+import sys
+import time
+
+# For importing bb
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+
+import bb.cache
+import bb.cooker
+import bb.data_smart
+import bb.tinfoil
+
+counts = {"getvar" : 0, "expand" : 0}
+
+def count_calls(wipe):
+    DataSmart = bb.data_smart.DataSmart
+
+    getVarFlag = DataSmart.getVarFlag
+    def counted_getVarFlag(self, var, flag, expand=False, noweakdefault=False, parsing=False):
+        if expand and flag == "_content":
+            counts["getvar"] += 1
+        return getVarFlag(self, var, flag, expand, noweakdefault, parsing)
+    DataSmart.getVarFlag = counted_getVarFlag
+
+    expandWithRefs = DataSmart.expandWithRefs
+    def counted_expandWithRefs(self, s, varname):
+        if not (varname and varname in self.expand_cache):
+            counts["expand"] += 1
+        return expandWithRefs(self, s, varname)
+    DataSmart.expandWithRefs = counted_expandWithRefs
+
+    if not wipe:
+        return
+    def wiping(method):
+        def wrapper(self, *args, **kwargs):
+            self._clear_expand_cache()
+            return method(self, *args, **kwargs)
+        return wrapper
+    for name in ["setVar", "delVar", "setVarFlag", "delVarFlag", "setVarFlags", "delVarFlags", "initVar"]:
+        setattr(DataSmart, name, wiping(getattr(DataSmart, name)))
+
+def main(argv=None):
+    wipe = False
+    if argv and argv[0] == "--wipe":
+        wipe = True
+        argv = argv[1:]
+
+    tinfoil = bb.tinfoil.Tinfoil(output=sys.stderr)
+    tinfoil.prepare(config_only=True)
+    cooker = tinfoil.cooker
+    collection = bb.cooker.CookerCollectFiles(cooker.recipecache.bbfile_config_priorities)
+    if argv:
+        recipes = [os.path.abspath(fn) for fn in argv]
+    else:
+        recipes, _ = collection.collect_bbfiles(cooker.data, cooker.expanded_data)
+
+    count_calls(wipe)
+    start = time.clock()
+    for fn in recipes:
+        appends = collection.get_file_appends(fn)
+        bb.cache.Cache.parse(fn, appends, cooker.data, cooker.caches_array)
+    elapsed = time.clock() - start
+    tinfoil.shutdown()
+
+    print("%d %d %d %.2f" % (len(recipes), counts["getvar"], counts["expand"], elapsed))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Measure recipe parsing throughput for different numbers of parser
+# processes. Run from an initialised build directory, the cache is
+# disabled for each run so every recipe is parsed:
+#
+#   parse_benchmark.py 1 2 4 8
+#
+# The output format is:
+# workers recipes seconds recipes/second
+#
+
+import os
+import sys
+import subprocess
+import time
+
+# For importing bb
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+
+def run(workers):
+    import bb.tinfoil
+
+    tinfoil = bb.tinfoil.Tinfoil(output=sys.stderr)
+    tinfoil.prepare(config_only=True)
+    tinfoil.config_data.setVar("BB_NUMBER_PARSE_THREADS", str(workers))
+    tinfoil.config_data.setVar("CACHE", "")
+    start = time.time()
+    tinfoil.parseRecipes()
+    elapsed = time.time() - start
+    parsed = tinfoil.cooker.parser.parsed
+    tinfoil.shutdown()
+    print("%d %d %.2f %.1f" % (workers, parsed, elapsed, parsed / elapsed))
+
+def main(argv=None):
+    if len(argv) == 2 and argv[0] == "--run":
+        run(int(argv[1]))
+        return 0
+
+    if not argv:
+        print >>sys.stderr, "usage: %s <workers> [<workers>...]" % os.path.basename(sys.argv[0])
+        return 2
+
+    # Each run needs a fresh cooker so use a separate process
+    for workers in argv:
+        ret = subprocess.call([sys.executable, sys.argv[0], "--run", str(int(workers))])
+        if ret:
+            return ret
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Load test a PR server started on a throwaway database. Each of the
+# client processes asks for the PRs of its own checksums, either over a
+# new connection for each request as bitbake's tasks used to, over one
+# persistent connection, or in batches with getPRs. With --lookups, the
+# same PRs are asked for again, as builds sharing the server do:
+#
+#   prserv_loadtest.py [--clients <n>] [--requests <n>] [--batch <n>] [--lookups <n>] [mode...]
+#
+# where mode is one of connect, persistent and batch (default all). The
+# output format is:
+# mode clients requests seconds requests-per-second
+#
+
+import multiprocessing
+import optparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# For importing bb and prserv
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+
+import bb.utils
+import prserv.serv
+
+def queries(client, count, lookups):
+    return [("1.0-r0", "loadtest", "client%d-%d" % (client, i % (count / lookups or 1))) for i in range(count)]
+
+def run_client(args):
+    host, port, mode, client, count, batch, lookups = args
+    if mode == "connect":
+        for query in queries(client, count, lookups):
+            prserv.serv.PRServerConnection(host, port).getPR(*query)
+    elif mode == "persistent":
+        conn = prserv.serv.PRServerConnection(host, port)
+        for query in queries(client, count, lookups):
+            conn.getPR(*query)
+    else:
+        conn = prserv.serv.PRServerConnection(host, port)
+        allqueries = queries(client, count, lookups)
+        for i in range(0, count, batch):
+            conn.getPRs(allqueries[i:i + batch])
+
+def run(mode, options):
+    tempdir = tempfile.mkdtemp()
+    try:
+        server = prserv.serv.PRServer(os.path.join(tempdir, "prserv.sqlite3"),
+                                      os.path.join(tempdir, "prserv.log"),
+                                      ("127.0.0.1", 0), daemon=False)
+        thread = threading.Thread(target=server.work_forever)
+        thread.start()
+        host, port = server.getinfo()
+
+        pool = multiprocessing.Pool(options.clients)
+        start = time.time()
+        pool.map(run_client, [(host, port, mode, client, options.requests, options.batch, options.lookups)
+                              for client in range(options.clients)])
+        elapsed = time.time() - start
+        pool.close()
+        pool.join()
+
+        prserv.serv.PRServerConnection(host, port).terminate()
+        thread.join()
+    finally:
+        bb.utils.prunedir(tempdir)
+
+    total = options.clients * options.requests
+    print("%s %d %d %.2f %.0f" % (mode, options.clients, total, elapsed, total / elapsed))
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [connect|persistent|batch...]")
+    parser.add_option("--clients", type="int", default=8,
+                      help="number of client processes")
+    parser.add_option("--requests", type="int", default=500,
+                      help="PRs asked for by each client")
+    parser.add_option("--batch", type="int", default=50,
+                      help="PRs asked for in each request in batch mode")
+    parser.add_option("--lookups", type="int", default=1,
+                      help="times each PR is asked for")
+    options, modes = parser.parse_args()
+
+    for mode in modes or ["connect", "persistent", "batch"]:
+        if mode not in ("connect", "persistent", "batch"):
+            parser.error("unknown mode %s" % mode)
+        run(mode, options)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Time the runqueue schedulers over a synthetic task graph, simulating a
+# build with the given number of threads. Each scheduler is also run with
+# the original list scanning next_buildable_task() for comparison:
+#
+#   sched_benchmark.py <recipes> <threads>
+#
+# The output format is:
+# scheduler setup-seconds run-seconds
+#
+
+import os
+import sys
+import tempfile
+import shutil
+import time
+
+# For importing bb
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+
+import bb
+import bb.parse
+import bb.runqueue
+import bb.siggen
+from bb.tests.runqueue import TaskGraph, LinearSchedulerMixin
+
+def main(argv=None):
+    if len(argv) != 2:
+        print >>sys.stderr, "usage: %s <recipes> <threads>" % os.path.basename(sys.argv[0])
+        return 2
+    recipes, threads = int(argv[0]), int(argv[1])
+
+    bb.parse.siggen = bb.siggen.SignatureGenerator(None)
+    stampdir = tempfile.mkdtemp()
+    try:
+        graph = TaskGraph(stampdir, recipes, 1)
+        for schedulerclass in [bb.runqueue.RunQueueScheduler,
+                               bb.runqueue.RunQueueSchedulerSpeed,
+                               bb.runqueue.RunQueueSchedulerCompletion]:
+            linear = type("Linear", (LinearSchedulerMixin, schedulerclass), {})
+            for name, cls in [(schedulerclass.name, schedulerclass),
+                              (schedulerclass.name + "-linear", linear)]:
+                rq = graph.runqueue(threads)
+                start = time.time()
+                sched = cls(rq, graph.rqdata)
+                setup = time.time() - start
+                start = time.time()
+                graph.simulate(rq, sched)
+                print("%s %.2f %.2f" % (name, setup, time.time() - start))
+    finally:
+        shutil.rmtree(stampdir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -30,7 +30,10 @@ import sys
 import logging
 import shlex
 import glob
+import fnmatch
 import time
+import errno
+import re
 import stat
 import bb
 import bb.msg
@@ -630,21 +633,21 @@ def stamp_cleanmask_internal(taskname, d, file_name):
 
     return [cleanmask, cleanmask.replace(taskflagname, taskflagname + "_setscene")]
 
-def make_stamp(task, d, file_name = None):
+def make_stamp(task, d, file_name = None, stampindex = None):
     """
     Creates/updates a stamp for a given task
     (d can be a data dict or dataCache)
+
+    The task's stamps for other hashes are removed, using stampindex if
+    given. For the tasks the workers run this is left to the server's
+    StampIndex once they complete.
     """
-    cleanmask = stamp_cleanmask_internal(task, d, file_name)
-    for mask in cleanmask:
-        for name in glob.glob(mask):
-            # Preserve sigdata files in the stamps directory
-            if "sigdata" in name:
-                continue
-            # Preserve taint files in the stamps directory
-            if name.endswith('.taint'):
-                continue
-            os.unlink(name)
+    if stampindex is None and (file_name or not d.getVar('__BB_STAMPCLEAN_DEFERRED', False)):
+        cleanmask = stamp_cleanmask_internal(task, d, file_name)
+        for mask in cleanmask:
+            for name in glob.glob(mask):
+                if _stamp_cleanable(name):
+                    os.unlink(name)
 
     stamp = stamp_internal(task, d, file_name)
     # Remove the file and recreate to force timestamp
@@ -653,6 +656,9 @@ def make_stamp(task, d, file_name = None):
         bb.utils.remove(stamp)
         open(stamp, "w").close()
 
+    if stampindex is not None:
+        stampindex.stamp_made(task, d, file_name)
+
     # If we're in task context, write out a signature file for each task
     # as it completes
     if not task.endswith("_setscene") and task != "do_setscene" and not file_name:
@@ -668,6 +674,10 @@ def del_stamp(task, d, file_name = None):
     stamp = stamp_internal(task, d, file_name)
     bb.utils.remove(stamp)
 
+def _stamp_cleanable(name):
+    # Preserve sigdata and taint files in the stamps directory
+    return "sigdata" not in name and not name.endswith('.taint')
+
 def write_taint(task, d, file_name = None):
     """
     Creates a "taint" file which will force the specified task and its
@@ -693,6 +703,197 @@ def stampfile(taskname, d, file_name = None):
     """
     return stamp_internal(taskname, d, file_name)
 
+class StampIndex(object):
+    """
+    Answers whether stamps exist and their mtimes from a listing of each
+    stamp directory, read the first time one of its stamps is asked about,
+    rather than with an access() and stat() per stamp. The mtimes are
+    looked up as needed and kept.
+
+    It also replaces a task's stamp for another hash without globbing
+    the directory each time, keeping the stamps matching each clean mask.
+
+    Stamps written or removed once the directory has been listed need
+    reporting with stamp_made() and stamp_removed().
+    """
+
+    def __init__(self):
+        self.dirs = {}
+        self.stamps = {}
+        self.cleanable = {}
+
+    def _entries(self, stampdir):
+        entries = self.dirs.get(stampdir)
+        if entries is None:
+            try:
+                entries = dict.fromkeys(os.listdir(stampdir))
+            except OSError:
+                entries = {}
+            self.dirs[stampdir] = entries
+        return entries
+
+    def stampfile(self, taskname, d, file_name):
+        """
+        As stampfile(), remembered since the task hashes it uses don't
+        change once they've been worked out
+        """
+        key = (file_name, taskname)
+        if key not in self.stamps:
+            self.stamps[key] = stampfile(taskname, d, file_name)
+        return self.stamps[key]
+
+    def exists(self, stamp):
+        stampdir, name = os.path.split(stamp)
+        return name in self._entries(stampdir)
+
+    def mtime(self, stamp):
+        """
+        Return the mtime of stamp or None if it doesn't exist
+        """
+        stampdir, name = os.path.split(stamp)
+        entries = self._entries(stampdir)
+        if name not in entries:
+            return None
+        if entries[name] is None:
+            try:
+                entries[name] = os.stat(stamp)[stat.ST_MTIME]
+            except OSError:
+                del entries[name]
+                return None
+        return entries[name]
+
+    def _cleanable(self, maskdir, maskname):
+        masks = self.cleanable.setdefault(maskdir, {})
+        if maskname not in masks:
+            names = fnmatch.filter(self._entries(maskdir), maskname)
+            masks[maskname] = set(name for name in names if _stamp_cleanable(name))
+        return masks[maskname]
+
+    def _add(self, stampdir, name):
+        self._entries(stampdir)[name] = None
+        for maskname, names in self.cleanable.get(stampdir, {}).iteritems():
+            if fnmatch.fnmatch(name, maskname) and _stamp_cleanable(name):
+                names.add(name)
+
+    def _remove(self, stampdir, name):
+        self.dirs.get(stampdir, {}).pop(name, None)
+        for names in self.cleanable.get(stampdir, {}).itervalues():
+            names.discard(name)
+
+    def stamp_made(self, task, d, file_name):
+        """
+        Remove the task's stamps for other hashes, as make_stamp() does
+        without an index, and record its new stamp. The server calls this
+        for the stamps the workers write.
+        """
+        stampdir, stampname = os.path.split(self.stampfile(task, d, file_name))
+        for mask in stamp_cleanmask_internal(task, d, file_name):
+            maskdir, maskname = os.path.split(mask)
+            if glob.has_magic(maskdir):
+                stale = [os.path.split(name) for name in glob.glob(mask) if _stamp_cleanable(name)]
+            else:
+                stale = [(maskdir, name) for name in self._cleanable(maskdir, maskname)]
+            for staledir, name in stale:
+                if staledir == stampdir and name == stampname:
+                    continue
+                try:
+                    os.unlink(os.path.join(staledir, name))
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+                self._remove(staledir, name)
+        self._add(stampdir, stampname)
+
+    def stamp_removed(self, task, d, file_name):
+        """
+        Update the index after del_stamp(task, ...)
+        """
+        self._remove(*os.path.split(self.stampfile(task, d, file_name)))
+
+_stampname_re = re.compile(r"^(?P<base>.*)\.(?P<task>do_[^.]+)(?:\.(?P<rest>.*))?$")
+_stamphash_re = re.compile(r"^[0-9a-f]{32,}$")
+
+def _split_stampname(name):
+    """
+    Split a name from a stamps directory into (base, task, kind, hash,
+    extrainfo), kind being "stamp", "sigdata", "sigbasedata" or "taint".
+    Returns None for names which aren't stamp files.
+    """
+    m = _stampname_re.match(name)
+    if not m:
+        return None
+    base, task, rest = m.group("base", "task", "rest")
+    parts = rest.split(".") if rest else []
+    if parts and parts[0] == "taint":
+        return (base, task, "taint", None, None)
+    if parts and parts[0] in ("sigdata", "sigbasedata"):
+        return (base, task, parts[0], ".".join(parts[1:]), None)
+    if parts and _stamphash_re.match(parts[0]):
+        return (base, task, "stamp", parts[0], ".".join(parts[1:]))
+    return (base, task, "stamp", None, rest or "")
+
+def prune_stamps(stampsdir, keep = 3, per_dir = False, dry_run = False):
+    """
+    Remove stale stamps and signature data below stampsdir, as make_stamp()
+    does for a single task but for the whole tree.
+
+    Of the stamps for a task only the newest is kept, per base name and
+    extra info, or per directory and extra info if per_dir is set (for
+    layouts with one directory per recipe whose base names change with
+    the version). The sigdata and sigbasedata files matching a kept stamp
+    are kept along with the newest keep of the others, so recent changes
+    can still be compared with bitbake-diffsigs. Taint files are kept.
+
+    Returns the list of paths removed (or which would be, with dry_run).
+    """
+    removed = []
+    for root, dirs, files in os.walk(stampsdir):
+        stamps = {}
+        sigs = {}
+        for name in files:
+            split = _split_stampname(name)
+            if split is None:
+                continue
+            base, task, kind, taskhash, extrainfo = split
+            if kind == "taint":
+                continue
+            path = os.path.join(root, name)
+            try:
+                mtime = os.lstat(path)[stat.ST_MTIME]
+            except OSError:
+                continue
+            if kind == "stamp":
+                key = (None if per_dir else base, task, extrainfo)
+                stamps.setdefault(key, []).append((mtime, name, base, taskhash))
+            else:
+                sigs.setdefault((base, task, kind), []).append((mtime, name, taskhash))
+
+        stale = []
+        current = set()
+        for (_, task, _), entries in stamps.iteritems():
+            entries.sort(reverse=True)
+            _, _, base, taskhash = entries[0]
+            if task.endswith("_setscene"):
+                task = task[:-9]
+            current.add((base, task, taskhash))
+            stale.extend(name for _, name, _, _ in entries[1:])
+        for (base, task, _), entries in sigs.iteritems():
+            entries.sort(reverse=True)
+            for i, (_, name, taskhash) in enumerate(entries):
+                if i >= keep and (base, task, taskhash) not in current:
+                    stale.append(name)
+
+        for name in sorted(stale):
+            path = os.path.join(root, name)
+            if not dry_run:
+                try:
+                    os.unlink(path)
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+            removed.append(path)
+    return removed
+
 def add_tasks(tasklist, d):
     task_deps = d.getVar('_task_deps', False)
     if not task_deps:
@@ -727,6 +928,7 @@ def add_tasks(tasklist, d):
         getTask('fakeroot')
         getTask('noexec')
         getTask('umask')
+        getTask('resourceclass')
         task_deps['parents'][task] = []
         if 'deps' in flags:
             for dep in flags['deps']:
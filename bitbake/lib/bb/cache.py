@@ -31,6 +31,10 @@
 
 import os
 import logging
+import hashlib
+import mmap
+import struct
+import time
 from collections import defaultdict
 import bb.utils
 
@@ -43,16 +47,110 @@ except ImportError:
     logger.info("Importing cPickle failed. "
                 "Falling back to a very slow implementation.")
 
-__cache_version__ = "148"
+__cache_version__ = "151"
 
-def getCacheFile(path, filename, data_hash):
-    return os.path.join(path, filename + "." + data_hash)
+def getCacheFile(path, filename, data_hash=None):
+    if data_hash:
+        return os.path.join(path, filename + "." + data_hash)
+    return os.path.join(path, filename)
+
+class ConfigSignature(object):
+    """
+    A summary of the configuration metadata used to decide which cached
+    recipes are still valid when the configuration changes.
+
+    Every configuration variable is numbered (in sorted order) so a recipe
+    can record the set of configuration variables it looked up during
+    parsing as a bitmask. Things which cannot be attributed to individual
+    recipes (the set of variable names, which finalisation iterates, and
+    the global tasks, handlers and anonymous functions) are folded into a
+    single global hash; if that changes, every cache entry is invalid.
+    """
+
+    def __init__(self, data, data_hash=None):
+        self.data = data
+        self.data_hash = data_hash
+        whitelist = set((data.getVar("BB_HASHCONFIG_WHITELIST", True) or "").split())
+        self.keys = sorted(key for key in data.keys()
+                           if not key.startswith("__") and key not in whitelist)
+        self.index = dict((key, i) for i, key in enumerate(self.keys))
+        self._globalhash = None
+        self._digests = None
+
+    @property
+    def globalhash(self):
+        if self._globalhash is None:
+            h = hashlib.md5()
+            h.update("\n".join(self.keys))
+            for key in ["__BBTASKS", "__BBANONFUNCS", "__BBHANDLERS"]:
+                funcs = sorted(self.data.getVar(key, False) or [])
+                h.update(str(funcs))
+                if key != "__BBTASKS":
+                    for func in funcs:
+                        h.update(str(self.data.getVar(func, False)))
+            self._globalhash = h.hexdigest()
+        return self._globalhash
+
+    @property
+    def digests(self):
+        if self._digests is None:
+            self._digests = []
+            for key in self.keys:
+                flags = self.data.getVarFlags(key, internalflags=True) or {}
+                value = (sorted(flags.items()), self.data.overridedata.get(key))
+                self._digests.append(hashlib.md5(str(value)).digest())
+        return self._digests
+
+    def mask(self, varnames):
+        """Return a bitmask of the configuration variables in varnames"""
+        mask = 0
+        for var in varnames:
+            i = self.index.get(var)
+            if i is not None:
+                mask |= 1 << i
+        return mask
+
+    def record(self):
+        return (self.data_hash, self.globalhash, self.digests)
+
+    def changed(self, record):
+        """
+        Compare against a record from an earlier run, returning a bitmask of
+        the configuration variables whose values changed or None if the
+        configuration changed in a way that invalidates everything.
+        """
+        data_hash, globalhash, digests = record
+        if self.data_hash and data_hash == self.data_hash:
+            return 0
+        if globalhash != self.globalhash or len(digests) != len(self.keys):
+            return None
+        changed = 0
+        for i, digest in enumerate(self.digests):
+            if digest != digests[i]:
+                changed |= 1 << i
+        return changed
+
+_configsig = None
+
+def getConfigSignature(data, data_hash=None):
+    """
+    Return the ConfigSignature for data, reusing the last one computed for
+    the same datastore (parser processes inherit it from the cooker)
+    """
+    global _configsig
+    if data_hash or _configsig is None or _configsig.data is not data:
+        _configsig = ConfigSignature(data, data_hash)
+    return _configsig
 
 # RecipeInfoCommon defines common data retrieving methods
 # from meta data for caches. CoreRecipeInfo as well as other
 # Extra RecipeInfo needs to inherit this class
 class RecipeInfoCommon(object):
 
+    # Whether remove_cacheData() is implemented, so that a recipe can be
+    # reparsed on its own
+    supports_reparse = False
+
     @classmethod
     def listvar(cls, var, metadata):
         return cls.getvar(var, metadata).split()
@@ -88,13 +186,26 @@ class RecipeInfoCommon(object):
     def getvar(cls, var, metadata, expand = True):
         return metadata.getVar(var, expand) or ''
 
+    @classmethod
+    def remove_cacheData(cls, cachedata, fn):
+        """
+        Remove everything add_cacheData() added for fn, used when a single
+        recipe is reparsed. Classes implementing this set supports_reparse.
+        """
+        raise NotImplementedError("%s does not support removing recipes" % cls.__name__)
+
 
 class CoreRecipeInfo(RecipeInfoCommon):
     __slots__ = ()
 
+    supports_reparse = True
+
     cachefile = "bb_cache.dat"   
 
     def __init__(self, filename, metadata):      
+        # Bitmask of the configuration variables read during parsing, filled
+        # in by Cache.parse(); by default depend on all of them
+        self.configdeps = -1
         self.file_depends = metadata.getVar('__depends', False)
         self.timestamp = bb.parse.cached_mtime(filename)
         self.variants = self.listvar('__VARIANTS', metadata) + ['']
@@ -252,6 +363,218 @@ class CoreRecipeInfo(RecipeInfoCommon):
         cachedata.fakerootnoenv[fn] = self.fakerootnoenv
         cachedata.fakerootdirs[fn] = self.fakerootdirs
 
+    @classmethod
+    def remove_cacheData(cls, cachedata, fn):
+        if fn not in cachedata.pkg_fn:
+            return
+        pn = cachedata.pkg_fn[fn]
+
+        for task in cachedata.task_deps[fn].get('tasks', []):
+            cachedata.basetaskhash.pop('%s.%s' % (fn, task), None)
+
+        for fndict in (cachedata.task_deps, cachedata.pkg_fn, cachedata.pkg_pepvpr,
+                       cachedata.pkg_dp, cachedata.stamp, cachedata.stampclean,
+                       cachedata.stamp_base, cachedata.stamp_base_clean,
+                       cachedata.stamp_extrainfo, cachedata.file_checksums,
+                       cachedata.fn_provides, cachedata.deps, cachedata.rundeps,
+                       cachedata.runrecs, cachedata.hashfn, cachedata.inherits,
+                       cachedata.fakerootenv, cachedata.fakerootnoenv,
+                       cachedata.fakerootdirs):
+            fndict.pop(fn, None)
+
+        for fnlists in (cachedata.pkg_pn, cachedata.providers, cachedata.rproviders,
+                        cachedata.packages, cachedata.packages_dynamic):
+            for key, fns in fnlists.items():
+                if fn in fns:
+                    fns.remove(fn)
+                    if not fns:
+                        del fnlists[key]
+
+        if fn in cachedata.possible_world:
+            cachedata.possible_world.remove(fn)
+        cachedata.universe_target.remove(pn)
+        # Another version of the recipe can still be in world
+        if not any(otherfn in cachedata.possible_world for otherfn in cachedata.pkg_pn.get(pn, [])):
+            cachedata.world_target.discard(pn)
+
+        # These are shared with the other recipes so rebuild them
+        cachedata.pn_provides.pop(pn, None)
+        for otherfn in cachedata.pkg_pn.get(pn, []):
+            for provide in cachedata.fn_provides[otherfn]:
+                if provide not in cachedata.pn_provides[pn]:
+                    cachedata.pn_provides[pn].append(provide)
+        seen = set()
+        cachedata.all_depends = []
+        for deps in cachedata.deps.itervalues():
+            for dep in deps:
+                if dep not in seen:
+                    seen.add(dep)
+                    cachedata.all_depends.append(dep)
+
+
+class RecipeInfoSummary(object):
+    """
+    The subset of CoreRecipeInfo needed to decide whether an entry is valid,
+    kept in the cache index so validity can be checked without deserializing
+    the entry itself
+    """
+    __slots__ = ("timestamp", "file_depends", "appends", "variants",
+                 "file_checksums", "configdeps")
+
+    def __init__(self, info):
+        for attr in self.__slots__:
+            setattr(self, attr, getattr(info, attr, None))
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+class IndexedCacheFile(object):
+    """
+    A cache file for a single RecipeInfo class.
+
+    The file starts with the offset of a trailing index, followed by one
+    standalone pickle per entry. The index holds the version information,
+    the (offset, length) of each entry and, for CoreRecipeInfo, the entry
+    summaries. The file is mmap'd so only the index is read when loading
+    and each entry is deserialized on first access.
+    """
+    header = struct.Struct("<Q")
+
+    def __init__(self, filename, classname):
+        self.filename = filename
+        self.classname = classname
+        with open(filename, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset, = self.header.unpack(self.mm[:self.header.size])
+            (self.cache_version, self.bitbake_version, self.configsig,
+             self.index, self.summaries) = pickle.loads(self.mm[offset:])
+        except:
+            self.close()
+            raise
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def record(self, key):
+        offset, length = self.index[key]
+        return self.mm[offset:offset + length]
+
+    def get(self, key):
+        return pickle.loads(self.record(key))
+
+    def close(self):
+        self.mm.close()
+
+class IndexedCacheFileWriter(object):
+    """
+    Write an IndexedCacheFile. The new file is written alongside and renamed
+    into place so readers with the old file mapped are unaffected.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tmpfile = "%s.%s" % (filename, os.getpid())
+        self.f = open(self.tmpfile, "wb")
+        self.f.write(IndexedCacheFile.header.pack(0))
+        self.index = {}
+        self.summaries = {}
+
+    def add(self, key, record):
+        self.index[key] = (self.f.tell(), len(record))
+        self.f.write(record)
+
+    def close(self, configsig=None):
+        offset = self.f.tell()
+        pickle.dump((__cache_version__, bb.__version__, configsig,
+                     self.index, self.summaries), self.f, pickle.HIGHEST_PROTOCOL)
+        self.f.seek(0)
+        self.f.write(IndexedCacheFile.header.pack(offset))
+        self.f.close()
+        os.rename(self.tmpfile, self.filename)
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.tmpfile):
+            os.unlink(self.tmpfile)
+
+class RecipeInfoStore(object):
+    """
+    Mapping of (virtual) filename to the list of RecipeInfo objects for it,
+    backed by IndexedCacheFiles. Entries from the files are deserialized on
+    access but not retained, only entries stored into the mapping are kept
+    in memory.
+    """
+
+    def __init__(self):
+        self.cachefiles = []
+        self.entries = {}
+        self.removed = set()
+
+    def add_cachefile(self, cachefile):
+        # The first file added must be the CoreRecipeInfo one
+        self.cachefiles.append(cachefile)
+
+    def __contains__(self, key):
+        if key in self.entries:
+            return True
+        return bool(self.cachefiles) and key in self.cachefiles[0] and key not in self.removed
+
+    def __getitem__(self, key):
+        if key in self.entries:
+            return self.entries[key]
+        if key not in self:
+            raise KeyError(key)
+        return [cachefile.get(key) for cachefile in self.cachefiles if key in cachefile]
+
+    def __setitem__(self, key, info_array):
+        self.entries[key] = info_array
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.entries.pop(key, None)
+        self.removed.add(key)
+
+    def __iter__(self):
+        for key in self.entries:
+            yield key
+        if self.cachefiles:
+            for key in self.cachefiles[0].index:
+                if key not in self.entries and key not in self.removed:
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def summary(self, key):
+        """Return the RecipeInfoSummary for key without deserializing it"""
+        if key in self.entries:
+            return RecipeInfoSummary(self.entries[key][0])
+        if key not in self:
+            raise KeyError(key)
+        return self.cachefiles[0].summaries[key]
+
+    def records(self, key):
+        """Return (class name, pickled entry) pairs for key"""
+        if key in self.entries:
+            return [(info.__class__.__name__, pickle.dumps(info, pickle.HIGHEST_PROTOCOL))
+                    for info in self.entries[key] if isinstance(info, RecipeInfoCommon)]
+        return [(cachefile.classname, cachefile.record(key))
+                for cachefile in self.cachefiles if key in cachefile]
+
+    def close(self):
+        for cachefile in self.cachefiles:
+            cachefile.close()
+        self.cachefiles = []
+        self.entries = {}
+        self.removed = set()
 
 
 class Cache(object):
@@ -267,7 +590,7 @@ class Cache(object):
         self.cachedir = data.getVar("CACHE", True)
         self.clean = set()
         self.checked = set()
-        self.depends_cache = {}
+        self.depends_cache = RecipeInfoStore()
         self.data = None
         self.data_fn = None
         self.cacheclean = True
@@ -280,7 +603,8 @@ class Cache(object):
             return
 
         self.has_cache = True
-        self.cachefile = getCacheFile(self.cachedir, "bb_cache.dat", self.data_hash)
+        self.cachefile = getCacheFile(self.cachedir, "bb_cache.dat")
+        self.configsig = getConfigSignature(data, data_hash)
 
         logger.debug(1, "Using cache in '%s'", self.cachedir)
         bb.utils.mkdirhier(self.cachedir)
@@ -289,7 +613,7 @@ class Cache(object):
         if self.caches_array:
             for cache_class in self.caches_array:
                 if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
+                    cachefile = getCacheFile(self.cachedir, cache_class.cachefile)
                     cache_ok = cache_ok and os.path.exists(cachefile)
                     cache_class.init_cacheData(self)
         if cache_ok:
@@ -300,60 +624,52 @@ class Cache(object):
     def load_cachefile(self):
         # Firstly, using core cache file information for
         # valid checking
-        with open(self.cachefile, "rb") as cachefile:
-            pickled = pickle.Unpickler(cachefile)
-            try:
-                cache_ver = pickled.load()
-                bitbake_ver = pickled.load()
-            except Exception:
-                logger.info('Invalid cache, rebuilding...')
-                return
+        cachefiles = {}
+        try:
+            for cache_class in self.caches_array:
+                if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
+                    cachefile = getCacheFile(self.cachedir, cache_class.cachefile)
+                    cachefiles[cache_class.__name__] = IndexedCacheFile(cachefile, cache_class.__name__)
+        except Exception:
+            logger.info('Invalid cache, rebuilding...')
+            return
 
-            if cache_ver != __cache_version__:
+        core = cachefiles['CoreRecipeInfo']
+        for cachefile in cachefiles.itervalues():
+            if cachefile.cache_version != __cache_version__:
                 logger.info('Cache version mismatch, rebuilding...')
                 return
-            elif bitbake_ver != bb.__version__:
+            elif cachefile.bitbake_version != bb.__version__:
                 logger.info('Bitbake version mismatch, rebuilding...')
                 return
 
+        changed = self.configsig.changed(core.configsig)
+        if changed is None:
+            logger.info('Out of date cache found, rebuilding...')
+            return
+        if core.configsig[0] != self.data_hash:
+            # Make sure the new configuration signature gets saved
+            self.cacheclean = False
 
-        cachesize = 0
-        previous_progress = 0
-        previous_percent = 0
-
-        # Calculate the correct cachesize of all those cache files
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    cachesize += os.fstat(cachefile.fileno()).st_size
-
+        # Only the indexes are read here, the recipe information itself is
+        # deserialized from the mmap'd files when first accessed
+        cachesize = sum(cachefile.size for cachefile in cachefiles.itervalues())
         bb.event.fire(bb.event.CacheLoadStarted(cachesize), self.data)
-        
+
         for cache_class in self.caches_array:
             if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    pickled = pickle.Unpickler(cachefile)                    
-                    while cachefile:
-                        try:
-                            key = pickled.load()
-                            value = pickled.load()
-                        except Exception:
-                            break
-                        if self.depends_cache.has_key(key):
-                            self.depends_cache[key].append(value)
-                        else:
-                            self.depends_cache[key] = [value]
-                        # only fire events on even percentage boundaries
-                        current_progress = cachefile.tell() + previous_progress
-                        current_percent = 100 * current_progress / cachesize
-                        if current_percent > previous_percent:
-                            previous_percent = current_percent
-                            bb.event.fire(bb.event.CacheLoadProgress(current_progress, cachesize),
-                                          self.data)
-
-                    previous_progress += current_progress
+                self.depends_cache.add_cachefile(cachefiles[cache_class.__name__])
+
+        # Drop the recipes which looked up configuration variables that
+        # have since changed
+        if changed:
+            stale = [key for key, summary in core.summaries.iteritems()
+                     if summary.configdeps & changed]
+            for key in stale:
+                logger.debug(2, "Cache: %s depends on changed configuration", key)
+                del self.depends_cache[key]
+            if stale:
+                logger.info('Configuration changed, %d cached recipes are out of date' % len(stale))
 
         # Note: depends cache number is corresponding to the parsing file numbers.
         # The same file has several caches, still regarded as one item in the cache
@@ -361,7 +677,6 @@ class Cache(object):
                                                   len(self.depends_cache)),
                       self.data)
 
-    
     @staticmethod
     def virtualfn2realfn(virtualfn):
         """
@@ -405,6 +720,7 @@ class Cache(object):
         """Parse the specified filename, returning the recipe information"""
         infos = []
         datastores = cls.load_bbfile(filename, appends, configdata)
+        accessed = None
         depends = []
         for variant, data in sorted(datastores.iteritems(),
                                     key=lambda i: i[0],
@@ -420,6 +736,14 @@ class Cache(object):
                     info = cache_class(filename, data)
                     info_array.append(info)
             infos.append((virtualfn, info_array))
+            accessed = data.getAccessedVars()
+
+        # All the variants share the set of variables looked up, so this
+        # is only complete once every info object has been created
+        if accessed is not None:
+            configdeps = getConfigSignature(configdata).mask(accessed)
+            for _, info_array in infos:
+                info_array[0].configdeps = configdeps
 
         return infos
 
@@ -435,8 +759,8 @@ class Cache(object):
         if cached:
             infos = []
             # info_array item is a list of [CoreRecipeInfo, XXXRecipeInfo]
-            info_array = self.depends_cache[filename]
-            for variant in info_array[0].variants:
+            info = self.depends_cache.summary(filename)
+            for variant in info.variants:
                 virtualfn = self.realfn2virtual(filename, variant)
                 infos.append((virtualfn, self.depends_cache[virtualfn]))
         else:
@@ -501,15 +825,16 @@ class Cache(object):
             self.remove(fn)
             return False
 
-        info_array = self.depends_cache[fn]
+        # Only the summary is needed here, avoid deserializing the whole entry
+        info = self.depends_cache.summary(fn)
         # Check the file's timestamp
-        if mtime != info_array[0].timestamp:
+        if mtime != info.timestamp:
             logger.debug(2, "Cache: %s changed", fn)
             self.remove(fn)
             return False
 
         # Check dependencies are still valid
-        depends = info_array[0].file_depends
+        depends = info.file_depends
         if depends:
             for f, old_mtime in depends:
                 fmtime = bb.parse.cached_mtime_noerror(f)
@@ -526,8 +851,8 @@ class Cache(object):
                     self.remove(fn)
                     return False
 
-        if hasattr(info_array[0], 'file_checksums'):
-            for _, fl in info_array[0].file_checksums.items():
+        if getattr(info, 'file_checksums', None):
+            for _, fl in info.file_checksums.items():
                 fl = fl.strip()
                 while fl:
                     # A .split() would be simpler but means spaces or colons in filenames would break
@@ -551,14 +876,14 @@ class Cache(object):
                         self.remove(fn)
                         return False
 
-        if appends != info_array[0].appends:
+        if appends != info.appends:
             logger.debug(2, "Cache: appends for %s changed", fn)
-            logger.debug(2, "%s to %s" % (str(appends), str(info_array[0].appends)))
+            logger.debug(2, "%s to %s" % (str(appends), str(info.appends)))
             self.remove(fn)
             return False
 
         invalid = False
-        for cls in info_array[0].variants:
+        for cls in info.variants:
             virtualfn = self.realfn2virtual(fn, cls)
             self.clean.add(virtualfn)
             if virtualfn not in self.depends_cache:
@@ -567,7 +892,7 @@ class Cache(object):
 
         # If any one of the variants is not present, mark as invalid for all
         if invalid:
-            for cls in info_array[0].variants:
+            for cls in info.variants:
                 virtualfn = self.realfn2virtual(fn, cls)
                 if virtualfn in self.clean:
                     logger.debug(2, "Cache: Removing %s from cache", virtualfn)
@@ -605,30 +930,31 @@ class Cache(object):
             logger.debug(2, "Cache is clean, not saving.")
             return
 
-        file_dict = {}
-        pickler_dict = {}
+        writers = {}
         for cache_class in self.caches_array:
             if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cache_class_name = cache_class.__name__
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                file_dict[cache_class_name] = open(cachefile, "wb")
-                pickler_dict[cache_class_name] =  pickle.Pickler(file_dict[cache_class_name], pickle.HIGHEST_PROTOCOL)
-                   
-        pickler_dict['CoreRecipeInfo'].dump(__cache_version__)
-        pickler_dict['CoreRecipeInfo'].dump(bb.__version__)
+                cachefile = getCacheFile(self.cachedir, cache_class.cachefile)
+                writers[cache_class.__name__] = IndexedCacheFileWriter(cachefile)
 
         try:
-            for key, info_array in self.depends_cache.iteritems():
-                for info in info_array:
-                    if isinstance(info, RecipeInfoCommon):
-                        cache_class_name = info.__class__.__name__
-                        pickler_dict[cache_class_name].dump(key)
-                        pickler_dict[cache_class_name].dump(info)
+            # Entries which were never accessed are copied across without
+            # being deserialized
+            for key in self.depends_cache:
+                for cache_class_name, record in self.depends_cache.records(key):
+                    writers[cache_class_name].add(key, record)
+                writers['CoreRecipeInfo'].summaries[key] = self.depends_cache.summary(key)
+
+            for cache_class_name, writer in writers.iteritems():
+                if cache_class_name == 'CoreRecipeInfo':
+                    writer.close(self.configsig.record())
+                else:
+                    writer.close()
+        except:
+            for writer in writers.itervalues():
+                writer.abort()
+            raise
         finally:
-            for cache_class in self.caches_array:
-                if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cache_class_name = cache_class.__name__
-                    file_dict[cache_class_name].close()
+            self.depends_cache.close()
 
         del self.depends_cache
 
@@ -646,6 +972,10 @@ class Cache(object):
         if not self.has_cache:
             return
 
+        if not parsed and filename in self.depends_cache:
+            # Came from the cache, leave it to be loaded lazily
+            return
+
         if (info_array[0].skipped or 'SRCREVINACTION' not in info_array[0].pv) and not info_array[0].nocache:
             if parsed:
                 self.cacheclean = False
@@ -680,6 +1010,9 @@ class Cache(object):
         oldpath = os.path.abspath(os.getcwd())
         parse.cached_mtime_noerror(bbfile_loc)
         bb_data = config.createCopy()
+        # Track the variables the recipe looks up so the cache can tell
+        # which configuration changes affect it
+        bb_data.enableAccessTracking()
         # The ConfHandler first looks if there is a TOPDIR and if not
         # then it would call getcwd().
         # Previously, we chdir()ed to bbfile_loc, called the handler
@@ -745,6 +1078,228 @@ class CacheData(object):
         for info in info_array:
             info.add_cacheData(self, fn)
 
+    def supports_reparse(self):
+        """Whether all the cache classes can remove a single recipe"""
+        for cache_class in self.caches_array:
+            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
+                if not cache_class.supports_reparse:
+                    return False
+        return True
+
+    def remove_recipeinfo(self, fn):
+        for cache_class in self.caches_array:
+            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
+                cache_class.remove_cacheData(self, fn)
+
+class ParseCostCache(object):
+    """
+    How long each recipe took to parse last time, used to balance the
+    parsing work between the parser processes
+    """
+    cache_file_name = "bb_parsecost.dat"
+    CACHE_VERSION = 1
+
+    def __init__(self, cachedir):
+        self.costs = {}
+        self.cachefile = None
+        if cachedir in [None, '']:
+            return
+        self.cachefile = os.path.join(cachedir, self.cache_file_name)
+        try:
+            with open(self.cachefile, "rb") as f:
+                costs, version = pickle.load(f)
+        except Exception:
+            return
+        if version == self.CACHE_VERSION:
+            self.costs = costs
+
+    def save(self, filenames=None):
+        """
+        Write the costs out, only keeping those of filenames if given. The
+        file is written alongside and renamed into place so that a parse
+        starting meanwhile never reads half of it.
+        """
+        if not self.cachefile:
+            return
+        if filenames is not None:
+            filenames = set(filenames)
+            self.costs = dict((fn, cost) for fn, cost in self.costs.iteritems() if fn in filenames)
+        tmpfile = "%s.%s" % (self.cachefile, os.getpid())
+        try:
+            with open(tmpfile, "wb") as f:
+                pickle.dump([self.costs, self.CACHE_VERSION], f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile, self.cachefile)
+        except (IOError, OSError) as exc:
+            logger.debug(1, "Unable to save parse costs: %s" % exc)
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+class TaskDurationCache(object):
+    """
+    How long each task took the last time it ran, keyed by (PN, taskname),
+    used by the critical path scheduler
+    """
+    cache_file_name = "bb_taskdurations.dat"
+    CACHE_VERSION = 1
+
+    def __init__(self, cachedir):
+        self.durations = {}
+        self.cachefile = None
+        self.dirty = False
+        if cachedir in [None, '']:
+            return
+        self.cachefile = os.path.join(cachedir, self.cache_file_name)
+        try:
+            with open(self.cachefile, "rb") as f:
+                durations, version = pickle.load(f)
+        except Exception:
+            return
+        if version == self.CACHE_VERSION:
+            self.durations = durations
+
+    def get(self, pn, taskname):
+        return self.durations.get((pn, taskname))
+
+    def record(self, pn, taskname, elapsed):
+        self.durations[(pn, taskname)] = elapsed
+        self.dirty = True
+
+    def import_buildstats(self, bsdir, pfmap):
+        """
+        Add the elapsed times from a buildstats directory, laid out as
+        <PF>/<taskname>, for tasks with no duration recorded. pfmap maps
+        PF to PN.
+        """
+        try:
+            pfs = os.listdir(bsdir)
+        except OSError:
+            return
+        for pf in pfs:
+            pn = pfmap.get(pf)
+            if pn is None:
+                continue
+            taskdir = os.path.join(bsdir, pf)
+            try:
+                tasknames = os.listdir(taskdir)
+            except OSError:
+                continue
+            for taskname in tasknames:
+                if (pn, taskname) in self.durations:
+                    continue
+                try:
+                    with open(os.path.join(taskdir, taskname)) as f:
+                        for line in f:
+                            if "Elapsed time:" in line:
+                                self.durations[(pn, taskname)] = float(line.split("Elapsed time:")[1].split()[0])
+                                self.dirty = True
+                                break
+                except (IOError, ValueError, IndexError):
+                    continue
+
+    def save(self):
+        if not self.cachefile or not self.dirty:
+            return
+        try:
+            bb.utils.mkdirhier(os.path.dirname(self.cachefile))
+            with open(self.cachefile, "wb") as f:
+                pickle.dump([self.durations, self.CACHE_VERSION], f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError) as exc:
+            logger.debug(1, "Unable to save task durations: %s" % exc)
+        self.dirty = False
+
+class CollectSnapshotCache(object):
+    """
+    The result of expanding each BBFILES entry along with the modification
+    time of every directory that was read to produce it. Adding, removing
+    or renaming an entry changes the mtime of its directory, so while none
+    of those mtimes change the previous result can be reused without
+    listing the directories again.
+    """
+    cache_file_name = "bb_collect.dat"
+    CACHE_VERSION = 1
+
+    # Directories modified this recently might change again within the
+    # filesystem's timestamp granularity, don't trust them
+    racy_window = 2
+
+    def __init__(self, cachedir):
+        self.snapshots = {}
+        self.used = set()
+        self.cachefile = None
+        self.dirty = False
+        if cachedir in [None, '']:
+            return
+        self.cachefile = os.path.join(cachedir, self.cache_file_name)
+        try:
+            with open(self.cachefile, "rb") as f:
+                snapshots, version = pickle.load(f)
+        except Exception:
+            return
+        if version == self.CACHE_VERSION:
+            self.snapshots = snapshots
+
+    @staticmethod
+    def key(pattern):
+        # Relative patterns are relative to the current directory
+        if os.path.isabs(pattern):
+            return pattern
+        return os.path.join(os.getcwd(), pattern)
+
+    @staticmethod
+    def dir_mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def lookup(self, pattern):
+        """
+        Return the files pattern matched last time, or None if any of the
+        directories involved have changed since
+        """
+        key = self.key(pattern)
+        self.used.add(key)
+        snapshot = self.snapshots.get(key)
+        if snapshot is None:
+            return None
+        dirs, files = snapshot
+        for path, mtime in dirs.iteritems():
+            if self.dir_mtime(path) != mtime:
+                return None
+        return files
+
+    def update(self, pattern, dirs, files):
+        key = self.key(pattern)
+        self.used.add(key)
+        now = time.time()
+        mtimes = {}
+        for path in dirs:
+            mtime = self.dir_mtime(path)
+            if mtime is not None and mtime > now - self.racy_window:
+                self.snapshots.pop(key, None)
+                self.dirty = True
+                return
+            mtimes[path] = mtime
+        self.snapshots[key] = (mtimes, files)
+        self.dirty = True
+
+    def save(self):
+        """Save the snapshots, dropping any for patterns no longer in use"""
+        if not self.cachefile:
+            return
+        for key in self.snapshots.keys():
+            if key not in self.used:
+                del self.snapshots[key]
+                self.dirty = True
+        if not self.dirty:
+            return
+        try:
+            bb.utils.mkdirhier(os.path.dirname(self.cachefile))
+            with open(self.cachefile, "wb") as f:
+                pickle.dump([self.snapshots, self.CACHE_VERSION], f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError) as exc:
+            logger.debug(1, "Unable to save collection snapshot: %s" % exc)
+
 class MultiProcessCache(object):
     """
     BitBake multi-process cache implementation
@@ -30,6 +30,8 @@ from bb.cache import RecipeInfoCommon
 class HobRecipeInfo(RecipeInfoCommon):
     __slots__ = ()
 
+    supports_reparse = True
+
     classname = "HobRecipeInfo"
     # please override this member with the correct data cache file
     # such as (bb_cache.dat, bb_extracache_hob.dat) 
@@ -73,3 +75,8 @@ class HobRecipeInfo(RecipeInfoCommon):
         cachedata.bugtracker[fn] = self.bugtracker
         cachedata.prevision[fn] = self.prevision
         cachedata.files_info[fn] = self.files_info
+
+    @classmethod
+    def remove_cacheData(cls, cachedata, fn):
+        for field in cls.cachefields:
+            getattr(cachedata, field).pop(fn, None)
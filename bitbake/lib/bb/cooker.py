@@ -140,6 +140,10 @@ class BBCooker:
         self.initConfigurationData()
 
         self.inotify_modified_files = []
+        # Recipes (real filenames) affected by modified files and a map of
+        # each file the parsed recipes depend upon to those recipes
+        self.inotify_modified_recipes = set()
+        self.recipe_filedeps = defaultdict(set)
 
         def _process_inotify_updates(server, notifier_list, abort):
             for n in notifier_list:
@@ -196,7 +200,21 @@ class BBCooker:
     def notifications(self, event):
         if not event.path in self.inotify_modified_files:
             self.inotify_modified_files.append(event.path)
-        self.parsecache_valid = False
+        if not event.pathname in self.inotify_modified_files:
+            self.inotify_modified_files.append(event.pathname)
+
+        filesetmask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_DELETE_SELF | \
+                      pyinotify.IN_MOVE_SELF | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        if event.mask & filesetmask and (event.dir or event.pathname.endswith((".bb", ".bbappend"))):
+            # The set of recipes or appends may have changed, collect them again
+            self.parsecache_valid = False
+        elif event.pathname in self.recipe_filedeps:
+            # Only the recipes which depend on this file need reparsing
+            self.inotify_modified_recipes.update(self.recipe_filedeps[event.pathname])
+
+    def add_recipe_filedeps(self, fn, deps):
+        for i in deps or []:
+            self.recipe_filedeps[i[0]].add(fn)
 
     def add_filewatch(self, deps, watcher=None):
         if not watcher:
@@ -537,12 +555,16 @@ class BBCooker:
         clean = True
         for o in options:
             if o in ['prefile', 'postfile']:
-                clean = False
+                value = options[o]
                 server_val = getattr(self.configuration, "%s_server" % o)
-                if not options[o] and server_val:
+                if not value and server_val:
                     # restore value provided on server start
-                    setattr(self.configuration, o, server_val)
-                    continue
+                    value = server_val
+                # Only a changed value needs a reparse
+                if getattr(self.configuration, o, None) != value:
+                    clean = False
+                setattr(self.configuration, o, value)
+                continue
             setattr(self.configuration, o, options[o])
         for k in bb.utils.approved_variables():
             if k in environment and k not in self.configuration.env:
@@ -1527,7 +1549,18 @@ class BBCooker:
         if self.state != state.parsing:
             self.updateCacheSync()
 
+        if self.state != state.parsing and self.parsecache_valid and self.inotify_modified_recipes:
+            # Reparsing in the cooker is serial, if a lot of recipes are
+            # affected (e.g. a widely used class changed) the parallel
+            # parser will be quicker
+            if len(self.inotify_modified_recipes) > self.parser.num_processes:
+                self.parsecache_valid = False
+            else:
+                self.parser.reparse_modified(self.inotify_modified_recipes)
+
         if self.state != state.parsing and not self.parsecache_valid:
+            self.inotify_modified_recipes = set()
+            self.recipe_filedeps = defaultdict(set)
             self.parseConfiguration ()
             if CookerFeatures.SEND_SANITYEVENTS in self.featureset:
                 bb.event.fire(bb.event.SanityCheck(False), self.data)
@@ -1697,6 +1730,12 @@ class CookerExit(bb.event.Event):
 class CookerCollectFiles(object):
     def __init__(self, priorities):
         self.bbappends = []
+        # Index of self.bbappends by recipe basename, and by the text before
+        # the '%' for wildcard appends. Entries are (position, filename) so
+        # matches can be returned in the same order as self.bbappends.
+        self.appendindex = defaultdict(list)
+        self.appendwildcards = defaultdict(list)
+        self.appendprefixlens = []
         self.bbfile_config_priorities = priorities
 
     def calc_bbfile_priority( self, filename, matched = None ):
@@ -1718,17 +1757,53 @@ class CookerCollectFiles(object):
                 bbfiles.append(os.path.abspath(os.path.join(path, f)))
         return bbfiles
 
-    def find_bbfiles(self, path):
-        """Find all the .bb and .bbappend files in a directory"""
+    def find_bbfiles(self, path, searched=None):
+        """
+        Find all the .bb and .bbappend files in a directory, adding the
+        directories read to searched if given
+        """
         found = []
         for dir, dirs, files in os.walk(path):
+            if searched is not None:
+                searched.add(dir)
             for ignored in ('SCCS', 'CVS', '.svn'):
                 if ignored in dirs:
                     dirs.remove(ignored)
-            found += [os.path.join(dir, f) for f in files if (f.endswith(['.bb', '.bbappend']))]
+            found += [os.path.join(dir, f) for f in files if (f.endswith(('.bb', '.bbappend')))]
 
         return found
 
+    def glob_bbfiles(self, pattern, searched):
+        """
+        glob.glob() which also adds the directories it had to read to
+        searched, the result only changes if one of them does
+        """
+        dirname, basename = os.path.split(pattern)
+        if not glob.has_magic(pattern):
+            searched.add(dirname or os.curdir)
+            if basename:
+                if os.path.lexists(pattern):
+                    return [pattern]
+            elif os.path.isdir(dirname):
+                return [pattern]
+            return []
+        if not dirname:
+            searched.add(os.curdir)
+            return glob.glob1(os.curdir, basename)
+        if dirname != pattern and glob.has_magic(dirname):
+            dirs = self.glob_bbfiles(dirname, searched)
+        else:
+            dirs = [dirname]
+        if glob.has_magic(basename):
+            glob_in_dir = glob.glob1
+        else:
+            glob_in_dir = glob.glob0
+        found = []
+        for dirname in dirs:
+            searched.add(dirname)
+            found += [os.path.join(dirname, name) for name in glob_in_dir(dirname, basename)]
+        return found
+
     def collect_bbfiles(self, config, eventdata):
         """Collect all available .bb build files"""
         masked = 0
@@ -1748,21 +1823,29 @@ class CookerCollectFiles(object):
             collectlog.error("no recipe files to build, check your BBPATH and BBFILES?")
             bb.event.fire(CookerExit(), eventdata)
 
+        # Reuse the results from last time for entries where none of the
+        # directories involved have changed
+        snapshot = bb.cache.CollectSnapshotCache(config.getVar("CACHE", True))
+
         # Can't use set here as order is important
         newfiles = []
+        seen = set()
         for f in files:
-            if os.path.isdir(f):
-                dirfiles = self.find_bbfiles(f)
-                for g in dirfiles:
-                    if g not in newfiles:
-                        newfiles.append(g)
-            else:
-                globbed = glob.glob(f)
-                if not globbed and os.path.exists(f):
-                    globbed = [f]
-                for g in globbed:
-                    if g not in newfiles:
-                        newfiles.append(g)
+            globbed = snapshot.lookup(f)
+            if globbed is None:
+                searched = set()
+                if os.path.isdir(f):
+                    globbed = self.find_bbfiles(f, searched)
+                else:
+                    globbed = self.glob_bbfiles(f, searched)
+                    if not globbed and os.path.exists(f):
+                        globbed = [f]
+                snapshot.update(f, searched, globbed)
+            for g in globbed:
+                if g not in seen:
+                    seen.add(g)
+                    newfiles.append(g)
+        snapshot.save()
 
         bbmask = config.getVar('BBMASK', True)
 
@@ -1791,6 +1874,7 @@ class CookerCollectFiles(object):
         for f in bbappend:
             base = os.path.basename(f).replace('.bbappend', '.bb')
             self.bbappends.append((base, f))
+        self.index_bbappends()
 
         # Find overlayed recipes
         # bbfiles will be in priority order which makes this easy
@@ -1806,17 +1890,36 @@ class CookerCollectFiles(object):
 
         return (bbfiles, masked)
 
+    def index_bbappends(self):
+        """
+        Index self.bbappends for get_file_appends(). A wildcard append
+        applies to every recipe whose name starts with the text before the
+        '%' so those are looked up by each prefix length in use.
+        """
+        self.appendindex = defaultdict(list)
+        self.appendwildcards = defaultdict(list)
+        for pos, (bbappend, filename) in enumerate(self.bbappends):
+            if '%' in bbappend:
+                prefix = bbappend[:bbappend.index('%')]
+                self.appendwildcards[prefix].append((pos, filename))
+            else:
+                self.appendindex[bbappend].append((pos, filename))
+        self.appendprefixlens = sorted(set(len(prefix) for prefix in self.appendwildcards))
+
     def get_file_appends(self, fn):
         """
         Returns a list of .bbappend files to apply to fn
         """
-        filelist = []
         f = os.path.basename(fn)
-        for b in self.bbappends:
-            (bbappend, filename) = b
-            if (bbappend == f) or ('%' in bbappend and bbappend.startswith(f[:bbappend.index('%')])):
-                filelist.append(filename)
-        return filelist
+        matches = self.appendindex.get(f, [])
+        wildcards = []
+        for length in self.appendprefixlens:
+            if length > len(f):
+                break
+            wildcards.extend(self.appendwildcards.get(f[:length], []))
+        if wildcards:
+            matches = sorted(matches + wildcards)
+        return [filename for _, filename in matches]
 
     def collection_priorities(self, pkgfns, d):
 
@@ -1858,38 +1961,16 @@ class ParsingFailure(Exception):
         self.recipe = recipe
         Exception.__init__(self, realexception, recipe)
 
-class Feeder(multiprocessing.Process):
-    def __init__(self, jobs, to_parsers, quit):
-        self.quit = quit
-        self.jobs = jobs
-        self.to_parsers = to_parsers
-        multiprocessing.Process.__init__(self)
-
-    def run(self):
-        while True:
-            try:
-                quit = self.quit.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                if quit == 'cancel':
-                    self.to_parsers.cancel_join_thread()
-                break
-
-            try:
-                job = self.jobs.pop()
-            except IndexError:
-                break
-
-            try:
-                self.to_parsers.put(job, timeout=0.5)
-            except Queue.Full:
-                self.jobs.insert(0, job)
-                continue
-
 class Parser(multiprocessing.Process):
-    def __init__(self, jobs, results, quit, init, profile):
-        self.jobs = jobs
+    """
+    Parse chunks of recipes. Each parser has its own queue of chunks and
+    steals from the other parsers' queues once that runs dry. Results are
+    sent back one list per chunk.
+    """
+    def __init__(self, jobs, index, remaining, results, quit, init, profile):
+        # Look at our own queue first, then the others in turn
+        self.jobs = jobs[index:] + jobs[:index]
+        self.remaining = remaining
         self.results = results
         self.quit = quit
         self.init = init
@@ -1919,32 +2000,61 @@ class Parser(multiprocessing.Process):
         if self.init:
             self.init()
 
-        pending = []
         while True:
-            try:
-                self.quit.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                self.results.cancel_join_thread()
+            chunk = self.next_chunk()
+            if chunk is None:
                 break
 
-            if pending:
-                result = pending.pop()
-            else:
+            results = []
+            for job in chunk:
+                if self.quitting():
+                    return
+                start = time.time()
+                result = self.parse(*job)
+                results.append((job[0], time.time() - start, result))
+                if isinstance(result[1], BaseException):
+                    # Report failures straight away
+                    break
+
+            if results:
+                self.results.put(results)
+
+    def quitting(self):
+        try:
+            self.quit.get_nowait()
+        except Queue.Empty:
+            return False
+        self.results.cancel_join_thread()
+        return True
+
+    def next_chunk(self):
+        """
+        Return the next chunk of jobs, stealing from the other parsers if
+        our own queue is empty, or None once every chunk has been taken
+        """
+        while not self.quitting():
+            for jobs in self.jobs:
                 try:
-                    job = self.jobs.get(timeout=0.25)
+                    chunk = jobs.get_nowait()
                 except Queue.Empty:
                     continue
+                with self.remaining.get_lock():
+                    self.remaining.value -= 1
+                return chunk
 
-                if job is None:
-                    break
-                result = self.parse(*job)
+            if self.remaining.value <= 0:
+                break
 
+            # Chunks may still be in flight from the cooker, wait on our own queue
             try:
-                self.results.put(result, timeout=0.25)
-            except Queue.Full:
-                pending.append(result)
+                chunk = self.jobs[0].get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            with self.remaining.get_lock():
+                self.remaining.value -= 1
+            return chunk
+
+        return None
 
     def parse(self, filename, appends, caches_array):
         try:
@@ -1986,6 +2096,7 @@ class CookerParser(object):
         self.process_names = []
 
         self.bb_cache = bb.cache.Cache(self.cfgdata, self.cfghash, cooker.caches_array)
+        self.parsecost = bb.cache.ParseCostCache(self.bb_cache.cachedir)
         self.fromcache = []
         self.willparse = []
         for filename in self.filelist:
@@ -2005,25 +2116,62 @@ class CookerParser(object):
         self.processes = []
         if self.toparse:
             bb.event.fire(bb.event.ParseStarted(self.toparse), self.cfgdata)
+            bb.siggen.basehash_cache_init(self.cfgdata)
             def init():
                 Parser.cfg = self.cfgdata
+                bb.parse.siggen.set_basehash_cache(bb.siggen.basehashcache)
                 multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, args=(self.cfgdata,), exitpriority=1)
                 multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, args=(self.cfgdata,), exitpriority=1)
+                multiprocessing.util.Finalize(None, bb.siggen.basehash_cache_save, args=(self.cfgdata,), exitpriority=1)
 
-            self.feeder_quit = multiprocessing.Queue(maxsize=1)
-            self.parser_quit = multiprocessing.Queue(maxsize=self.num_processes)
-            self.jobs = multiprocessing.Queue(maxsize=self.num_processes)
+            chunks = self.chunk_jobs()
+            num_processes = min(self.num_processes, len(chunks))
+            self.parser_quit = multiprocessing.Queue(maxsize=num_processes)
+            self.jobs = [multiprocessing.Queue() for i in range(num_processes)]
+            self.remaining = multiprocessing.Value('i', len(chunks))
             self.result_queue = multiprocessing.Queue()
-            self.feeder = Feeder(self.willparse, self.jobs, self.feeder_quit)
-            self.feeder.start()
-            for i in range(0, self.num_processes):
-                parser = Parser(self.jobs, self.result_queue, self.parser_quit, init, self.cooker.configuration.profile)
+            # Deal the chunks out most expensive first, the parsers steal
+            # from each other to even out the tail
+            for i, chunk in enumerate(chunks):
+                self.jobs[i % num_processes].put(chunk)
+            for i in range(0, num_processes):
+                parser = Parser(self.jobs, i, self.remaining, self.result_queue, self.parser_quit, init, self.cooker.configuration.profile)
                 parser.start()
                 self.process_names.append(parser.name)
                 self.processes.append(parser)
 
             self.results = itertools.chain(self.results, self.parse_generator())
 
+    def chunk_jobs(self):
+        """
+        Group the recipes to parse into chunks of roughly equal cost, based
+        on how long each recipe took to parse previously. Recipes with no
+        history are assumed to take the average time.
+        """
+        costs = self.parsecost.costs
+        known = [costs[job[0]] for job in self.willparse if job[0] in costs]
+        default = sum(known) / len(known) if known else 1.0
+        def cost(job):
+            return costs.get(job[0], default)
+
+        jobs = sorted(self.willparse, key=cost, reverse=True)
+        # A few chunks per parser leaves room to balance the load
+        target = sum(cost(job) for job in jobs) / (self.num_processes * 4)
+
+        chunks = []
+        chunk = []
+        chunkcost = 0
+        for job in jobs:
+            chunk.append(job)
+            chunkcost += cost(job)
+            if chunkcost >= target:
+                chunks.append(chunk)
+                chunk = []
+                chunkcost = 0
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
     def shutdown(self, clean=True, force=False):
         if not self.toparse:
             return
@@ -2038,17 +2186,13 @@ class CookerParser(object):
                                             self.total)
 
             bb.event.fire(event, self.cfgdata)
-            self.feeder_quit.put(None)
-            for process in self.processes:
-                self.jobs.put(None)
         else:
-            self.feeder_quit.put('cancel')
-
             self.parser_quit.cancel_join_thread()
             for process in self.processes:
                 self.parser_quit.put(None)
 
-            self.jobs.cancel_join_thread()
+            for jobs in self.jobs:
+                jobs.cancel_join_thread()
 
         for process in self.processes:
             if force:
@@ -2056,13 +2200,16 @@ class CookerParser(object):
                 process.terminate()
             else:
                 process.join()
-        self.feeder.join()
+
+        if clean:
+            self.parsecost.save(self.filelist)
 
         sync = threading.Thread(target=self.bb_cache.sync)
         sync.start()
         multiprocessing.util.Finalize(None, sync.join, exitpriority=-100)
         bb.codeparser.parser_cache_savemerge(self.cooker.data)
         bb.fetch.fetcher_parse_done(self.cooker.data)
+        bb.siggen.basehash_cache_savemerge(self.cooker.data)
         if self.cooker.configuration.profile:
             profiles = []
             for i in self.process_names:
@@ -2085,10 +2232,12 @@ class CookerParser(object):
                 break
 
             try:
-                result = self.result_queue.get(timeout=0.25)
+                results = self.result_queue.get(timeout=0.25)
             except Queue.Empty:
-                pass
-            else:
+                continue
+
+            for filename, elapsed, result in results:
+                self.parsecost.costs[filename] = elapsed
                 value = result[1]
                 if isinstance(value, BaseException):
                     raise value
@@ -2159,11 +2308,54 @@ class CookerParser(object):
                 self.cooker.skiplist[virtualfn] = SkippedPackage(info_array[0])
             self.bb_cache.add_info(virtualfn, info_array, self.cooker.recipecache,
                                         parsed=parsed, watcher = self.cooker.add_filewatch)
+            realfn = bb.cache.Cache.virtualfn2realfn(virtualfn)[0]
+            self.cooker.add_recipe_filedeps(realfn, info_array[0].file_depends)
         return True
 
     def reparse(self, filename):
+        """
+        Parse filename again, replacing its existing entries (including
+        any variants) in the recipe cache
+        """
         infos = self.bb_cache.parse(filename,
                                     self.cooker.collection.get_file_appends(filename),
                                     self.cfgdata, self.cooker.caches_array)
+
+        recipecache = self.cooker.recipecache
+        oldfns = [fn for fn in recipecache.pkg_fn.keys() + self.cooker.skiplist.keys()
+                  if bb.cache.Cache.virtualfn2realfn(fn)[0] == filename]
+        for fn in oldfns:
+            recipecache.remove_recipeinfo(fn)
+            recipecache.bbfile_priority.pop(fn, None)
+            self.cooker.skiplist.pop(fn, None)
+
         for vfn, info_array in infos:
-            self.cooker.recipecache.add_from_recipeinfo(vfn, info_array)
+            if info_array[0].skipped:
+                self.cooker.skiplist[vfn] = SkippedPackage(info_array[0])
+            else:
+                recipecache.add_from_recipeinfo(vfn, info_array)
+                recipecache.bbfile_priority[vfn] = self.cooker.collection.calc_bbfile_priority(filename)
+            self.cooker.add_filewatch(info_array[0].file_depends)
+            self.cooker.add_recipe_filedeps(filename, info_array[0].file_depends)
+
+    def reparse_modified(self, filenames):
+        """
+        Reparse the recipes affected by modified files, removing each from
+        filenames once it has been reparsed successfully
+        """
+        if not self.cooker.recipecache.supports_reparse():
+            # An extra cache class can't remove a recipe, parse everything
+            logger.debug(1, "Not all cache classes support reparsing a recipe")
+            self.cooker.parsecache_valid = False
+            return
+        for filename in sorted(filenames):
+            if filename not in self.filelist:
+                filenames.discard(filename)
+                continue
+            logger.debug(1, "Reparsing modified recipe %s", filename)
+            try:
+                self.reparse(filename)
+            except Exception as exc:
+                logger.error('Unable to parse %s: %s' % (filename, exc))
+                raise bb.BBHandledException()
+            filenames.discard(filename)
@@ -28,7 +28,9 @@ BitBake build tools.
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
+import ast
 import copy, re, sys, traceback
+import weakref
 from collections import MutableMapping
 import logging
 import hashlib
@@ -89,6 +91,26 @@ def infer_caller_details(loginfo, parent = False, varval = True):
         if func not in loginfo:
             loginfo['func'] = func
 
+python_names_cache = {}
+
+def python_names(code):
+    """The names python code uses which it doesn't bind itself"""
+    try:
+        return python_names_cache[code]
+    except KeyError:
+        pass
+    loaded = set()
+    bound = set()
+    for node in ast.walk(ast.parse(code.strip(), mode="eval")):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+    names = python_names_cache[code] = frozenset(loaded - bound)
+    return names
+
+
 class VariableParse:
     def __init__(self, varname, d, val = None):
         self.varname = varname
@@ -98,6 +120,10 @@ class VariableParse:
         self.references = set()
         self.execs = set()
         self.contains = {}
+        # Variables python looked up while being evaluated and whether
+        # the value depends on anything other than the datastore
+        self.lookups = set()
+        self.volatile = False
 
     def var_sub(self, match):
             key = match.group()[2:-1]
@@ -135,21 +161,64 @@ class VariableParse:
                     self.contains[k] = parser.contains[k].copy()
                 else:
                     self.contains[k].update(parser.contains[k])
-            value = utils.better_eval(codeobj, DataContext(self.d))
+            outer = self.d.expand_lookups
+            self.d.expand_lookups = set()
+            context = DataContext(self.d)
+            try:
+                value = utils.better_eval(codeobj, context)
+            finally:
+                lookups = self.d.expand_lookups
+                self.d.expand_lookups = outer
+                if outer is not None:
+                    outer |= lookups
+            self.lookups |= lookups
+            if not self.is_pure(code, parser.execs, context.found):
+                self.volatile = True
             return str(value)
 
+    # Names and functions python can use without its value depending on
+    # anything other than the datastore
+    purenames = frozenset(["d", "bb", "None", "True", "False", "abs", "all",
+        "any", "bool", "dict", "enumerate", "filter", "float", "int", "len",
+        "list", "map", "max", "min", "range", "repr", "reversed", "set",
+        "sorted", "str", "sum", "tuple", "unicode", "xrange", "zip"])
+    purefuncs = frozenset(["d.getVarFlag", "d.expand", "bb.utils.filter",
+        "bb.utils.to_boolean", "bb.data.inherits_class"])
+
+    def is_pure(self, code, execs, found):
+        """
+        Whether python only uses the datastore, the variables in it it found
+        by name and purenames, and calls only purefuncs and methods of those
+        variables. Anything else may be using the time, a pid or the
+        filesystem so its expansion is volatile.
+        """
+        names = python_names(code)
+        for name in names:
+            if name not in self.purenames and name not in found:
+                return False
+        for func in execs:
+            if func in self.purefuncs or func in self.purenames:
+                continue
+            # Methods of values python computed itself are fine too
+            name = func.split(".")[0]
+            if name in names and name not in found:
+                return False
+        return True
 
 class DataContext(dict):
     def __init__(self, metadata, **kwargs):
         self.metadata = metadata
         dict.__init__(self, **kwargs)
         self['d'] = metadata
+        # Names found in the datastore
+        self.found = set()
 
     def __missing__(self, key):
         value = self.metadata.getVar(key, True)
         if value is None or self.metadata.getVarFlag(key, 'func'):
             raise KeyError(key)
         else:
+            self.found.add(key)
             return value
 
 class ExpansionError(Exception):
@@ -347,13 +416,33 @@ class VariableHistory(object):
 
 class DataSmart(MutableMapping):
     def __init__(self):
+        # Every variable visible in the datastore, including those seen
+        # through the datastore this was copied from. Only those in
+        # localvars may be changed in place, the others must be copied
+        # first (see _makeShadowCopy()).
         self.dict = {}
+        self.localvars = set()
+        # The dict of the datastore this was copied from and weak
+        # references to the copies made of this one, which see variables
+        # set here unless they set them themselves
+        self.parentdict = None
+        self.copies = []
 
         self.inchistory = IncludeHistory()
         self.varhistory = VariableHistory(self)
         self._tracking = False
+        self._accessed = None
 
+        # Expansions of variables (and of flags, keyed as var[flag]) along
+        # with the cache keys depending on each variable and the keys of
+        # volatile expansions, see _invalidate_expand_cache()
         self.expand_cache = {}
+        self.expand_deps = {}
+        self.expand_volatile = set()
+        # The above made with the overrides before internal_finalize()
+        self.expand_stash = None
+        # Variables looked up by the python being expanded
+        self.expand_lookups = None
 
         # cookie monster tribute
         # Need to be careful about writes to overridedata as
@@ -364,12 +453,36 @@ class DataSmart(MutableMapping):
         self.overridevars = set(["OVERRIDES", "FILE"])
         self.inoverride = False
 
+        # For each value of OVERRIDES seen recently, the variable overriding
+        # each variable in overridedata (or False) and whether each "_"
+        # joined override is active, see _set_overrides()
+        self.override_cache = {}
+        self.override_winners = None
+        self.override_matches = None
+
+        # The digests of variables worked out so far (see get_var_hash()),
+        # and once get_hash() has been called, their sum along with the
+        # variables changed since which it doesn't include yet
+        self.hash_digests = {}
+        self.hash_sum = None
+        self.hash_changed = set()
+
     def enableTracking(self):
         self._tracking = True
 
     def disableTracking(self):
         self._tracking = False
 
+    def enableAccessTracking(self):
+        """
+        Record the name of every variable looked up in this datastore and
+        in any copies subsequently made from it (the set is shared).
+        """
+        self._accessed = set()
+
+    def getAccessedVars(self):
+        return self._accessed
+
     def expandWithRefs(self, s, varname):
 
         if not isinstance(s, basestring): # sanity check
@@ -398,10 +511,88 @@ class DataSmart(MutableMapping):
         varparse.value = s
 
         if varname:
+            # Cached expansions mustn't keep a copy alive, see createCopy()
+            varparse.d = None
             self.expand_cache[varname] = varparse
+            if not isinstance(varname, basestring):
+                # Not a variable name, drop it on the next change
+                self.expand_volatile.add(varname)
+            else:
+                if "[" in varname:
+                    self._add_expand_deps(varname, [varname[:varname.find("[")]], False)
+                self._add_expand_deps(varname, varparse.references | varparse.lookups, varparse.volatile)
 
         return varparse
 
+    def _add_expand_deps(self, key, references, volatile):
+        for ref in references:
+            if ref not in self.expand_deps:
+                self.expand_deps[ref] = set()
+            self.expand_deps[ref].add(key)
+        if volatile:
+            self.expand_volatile.add(key)
+
+    def _clear_expand_cache(self):
+        self.expand_cache = {}
+        self.expand_deps = {}
+        self.expand_volatile = set()
+
+    def _invalidate_expand_cache(self, var):
+        """
+        Drop the cached expansions affected by a change to var: its own,
+        those of its flags and, recursively, those referencing or looking
+        up any of them. A variable named with an override or an _append,
+        _prepend or _remove changes the value of its base variable(s) so
+        they are dropped too. Volatile expansions are dropped on every
+        change, as all expansions were before they were tracked.
+        """
+        if not self.expand_cache and not self.expand_stash:
+            return
+        if self.expand_cache:
+            overrides = None
+            if self.overrides is not None:
+                overrides = self.overridesset
+            changed = self._expand_changed(var, overrides)
+            self._drop_expansions(changed, self.expand_cache, self.expand_deps, self.expand_volatile)
+        if self.expand_stash:
+            changed = self._expand_changed(var, set(self.expand_stash[0]))
+            self._drop_expansions(changed, *self.expand_stash[1:])
+
+    @staticmethod
+    def _expand_changed(var, overrides):
+        """
+        The variables whose values a change to var can affect: var, the
+        variable an _append, _prepend or _remove applies to and those var
+        overrides with the given OVERRIDES, e.g. FOO for FOO_arm with "arm"
+        in them. Any override is taken to apply if overrides is None.
+        """
+        changed = [var]
+        match = __setvar_regexp__.match(var)
+        if match:
+            var = match.group("base")
+            changed.append(var)
+        pos = var.rfind('_')
+        while pos > 0:
+            if overrides is None or overrides.issuperset(var[pos+1:].split("_")):
+                changed.append(var[:pos])
+            pos = var.rfind('_', 0, pos)
+        return changed
+
+    @staticmethod
+    def _drop_expansions(changed, cache, deps, volatile):
+        if not cache:
+            return
+        pending = list(changed)
+        if volatile:
+            pending.extend(volatile)
+            volatile.clear()
+        while pending:
+            key = pending.pop()
+            if key in cache:
+                del cache[key]
+            if key in deps:
+                pending.extend(deps.pop(key))
+
     def expand(self, s, varname = None):
         return self.expandWithRefs(s, varname).value
 
@@ -410,6 +601,12 @@ class DataSmart(MutableMapping):
 
     def internal_finalize(self, parent = False):
         """Performs final steps upon the datastore, including application of overrides"""
+        if self.overrides is not None:
+            # The overrides usually come out the same, so keep the expansions
+            # for need_overrides() to restore. Until then only expansions
+            # which don't involve overrides can be made.
+            self.expand_stash = (self.overrides, self.expand_cache, self.expand_deps, self.expand_volatile)
+            self._clear_expand_cache()
         self.overrides = None
 
     def need_overrides(self):
@@ -420,43 +617,129 @@ class DataSmart(MutableMapping):
         for count in range(5):
             self.inoverride = True
             # Can end up here recursively so setup dummy values
-            self.overrides = []
-            self.overridesset = set()
-            self.overrides = (self.getVar("OVERRIDES", True) or "").split(":") or []
-            self.overridesset = set(self.overrides)
+            self._set_overrides([])
+            self._set_overrides((self.getVar("OVERRIDES", True) or "").split(":") or [])
             self.inoverride = False
-            self.expand_cache = {}
+            if self.expand_stash and self.expand_stash[0] == self.overrides:
+                # Nothing expanded with the previous overrides has changed
+                _, self.expand_cache, self.expand_deps, self.expand_volatile = self.expand_stash
+                self.expand_stash = None
+            else:
+                self._clear_expand_cache()
             newoverrides = (self.getVar("OVERRIDES", True) or "").split(":") or []
             if newoverrides == self.overrides:
                 break
-            self.overrides = newoverrides
-            self.overridesset = set(self.overrides)
+            self._set_overrides(newoverrides)
         else:
             bb.fatal("Overrides could not be expanded into a stable state after 5 iterations, overrides must be being referenced by other overridden variables in some recursive fashion. Please provide your configuration to bitbake-devel so we can laugh, er, I mean try and understand how to make it work.")
+        self.expand_stash = None
+
+    def _set_overrides(self, overrides):
+        self.overrides = overrides
+        self.overridesset = set(overrides)
+        key = tuple(overrides)
+        if key not in self.override_cache:
+            # OVERRIDES settles on a few values, don't keep every one
+            # seen while parsing the configuration
+            if len(self.override_cache) >= 4:
+                self.override_cache.clear()
+            self.override_cache[key] = ({}, {})
+        self.override_winners, self.override_matches = self.override_cache[key]
+
+    def _override_active(self, override):
+        """Whether each part of the "_" joined override is in OVERRIDES"""
+        try:
+            return self.override_matches[override]
+        except KeyError:
+            active = set(override.split("_")).issubset(self.overridesset)
+            self.override_matches[override] = active
+            return active
+
+    def _override_winner(self, var):
+        """
+        The variable overriding var with the current OVERRIDES, False if
+        none does. Only changes with OVERRIDES and overridedata[var] so is
+        kept until _overridedata_changed() is called for var.
+        """
+        try:
+            return self.override_winners[var]
+        except KeyError:
+            pass
+
+        match = False
+        active = {}
+        for (r, o) in self.overridedata[var]:
+            # What about double overrides both with "_" in the name?
+            if o in self.overridesset or self._override_active(o):
+                active[o] = r
+
+        mod = True
+        while mod:
+            mod = False
+            for o in self.overrides:
+                for a in active.copy():
+                    if a.endswith("_" + o):
+                        t = active[a]
+                        del active[a]
+                        active[a.replace("_" + o, "")] = t
+                        mod = True
+                    elif a == o:
+                        match = active[a]
+                        del active[a]
+
+        self.override_winners[var] = match
+        return match
+
+    def _overridedata_changed(self, var):
+        for winners, _ in self.override_cache.itervalues():
+            winners.pop(var, None)
 
     def initVar(self, var):
-        self.expand_cache = {}
-        if not var in self.dict:
-            self.dict[var] = {}
+        self._invalidate_expand_cache(var)
+        self._hash_var_changed(var)
+        if not var in self.localvars:
+            self._setLocalVar(var, {})
 
     def _findVar(self, var):
-        dest = self.dict
-        while dest:
-            if var in dest:
-                return dest[var]
-
-            if "_data" not in dest:
-                break
-            dest = dest["_data"]
+        if self._accessed is not None:
+            self._accessed.add(var)
+        if self.expand_lookups is not None:
+            self.expand_lookups.add(var)
+        return self.dict.get(var)
+
+    def _setLocalVar(self, var, local_var):
+        self.dict[var] = local_var
+        self.localvars.add(var)
+        self._updateCopies(var)
+
+    def _delLocalVar(self, var):
+        self.localvars.discard(var)
+        self._inheritVar(var)
+
+    def _inheritVar(self, var):
+        """Pick up var from the parent datastore unless it is set here"""
+        if var in self.localvars:
+            return
+        if self.parentdict is not None and var in self.parentdict:
+            self.dict[var] = self.parentdict[var]
+        elif var in self.dict:
+            del self.dict[var]
+        self._updateCopies(var)
+
+    def _updateCopies(self, var):
+        for ref in self.copies:
+            data = ref()
+            if data is not None:
+                data._inheritVar(var)
 
     def _makeShadowCopy(self, var):
-        if var in self.dict:
+        if var in self.localvars:
             return
 
         local_var = self._findVar(var)
 
         if local_var:
-            self.dict[var] = copy.copy(local_var)
+            self._setLocalVar(var, copy.copy(local_var))
         else:
             self.initVar(var)
 
@@ -469,7 +752,8 @@ class DataSmart(MutableMapping):
 
         if 'op' not in loginfo:
             loginfo['op'] = "set"
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
+        self._hash_var_changed(var)
         match  = __setvar_regexp__.match(var)
         if match and match.group("keyword") in __setvar_keyword__:
             base = match.group('base')
@@ -497,7 +781,7 @@ class DataSmart(MutableMapping):
                 self._setvar_update_overridevars(var, value)
             return
 
-        if not var in self.dict:
+        if not var in self.localvars:
             self._makeShadowCopy(var)
 
         if not parsing:
@@ -509,14 +793,12 @@ class DataSmart(MutableMapping):
                 active = []
                 self.need_overrides()
                 for (r, o) in self.overridedata[var]:
-                    if o in self.overridesset:
+                    if o in self.overridesset or self._override_active(o):
                         active.append(r)
-                    elif "_" in o:
-                        if set(o.split("_")).issubset(self.overridesset):
-                            active.append(r)
                 for a in active:
                     self.delVar(a)
                 del self.overridedata[var]
+                self._overridedata_changed(var)
 
         # more cookies for the cookie monster
         if '_' in var:
@@ -554,6 +836,7 @@ class DataSmart(MutableMapping):
                 # Force CoW by recreating the list first
                 self.overridedata[shortvar] = list(self.overridedata[shortvar])
                 self.overridedata[shortvar].append([var, override])
+                self._overridedata_changed(shortvar)
             override = None
             if "_" in shortvar:
                 override = var[shortvar.rfind('_')+1:]
@@ -590,6 +873,7 @@ class DataSmart(MutableMapping):
             for (v, o) in self.overridedata[key]:
                 self.overridedata[newkey].append([v.replace(key, newkey), o])
                 self.renameVar(v, v.replace(key, newkey))
+            self._overridedata_changed(newkey)
 
         if '_' in newkey and val is None:
             self._setvar_update_overrides(newkey, **loginfo)
@@ -614,10 +898,12 @@ class DataSmart(MutableMapping):
         loginfo['detail'] = ""
         loginfo['op'] = 'del'
         self.varhistory.record(**loginfo)
-        self.expand_cache = {}
-        self.dict[var] = {}
+        self._invalidate_expand_cache(var)
+        self._hash_var_changed(var)
+        self._setLocalVar(var, {})
         if var in self.overridedata:
             del self.overridedata[var]
+            self._overridedata_changed(var)
         if '_' in var:
             override = var[var.rfind('_')+1:]
             shortvar = var[:var.rfind('_')]
@@ -627,6 +913,7 @@ class DataSmart(MutableMapping):
                         # Force CoW by recreating the list first
                         self.overridedata[shortvar] = list(self.overridedata[shortvar])
                         self.overridedata[shortvar].remove([var, override])
+                        self._overridedata_changed(shortvar)
                 except ValueError as e:
                     pass
                 override = None
@@ -637,12 +924,13 @@ class DataSmart(MutableMapping):
                          override = None
 
     def setVarFlag(self, var, flag, value, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
+        self._hash_var_changed(var)
         if 'op' not in loginfo:
             loginfo['op'] = "set"
         loginfo['flag'] = flag
         self.varhistory.record(**loginfo)
-        if not var in self.dict:
+        if not var in self.localvars:
             self._makeShadowCopy(var)
         self.dict[var][flag] = value
 
@@ -652,40 +940,20 @@ class DataSmart(MutableMapping):
             self._setvar_update_overridevars(var, value)
 
         if flag == "unexport" or flag == "export":
-            if not "__exportlist" in self.dict:
+            if not "__exportlist" in self.localvars:
                 self._makeShadowCopy("__exportlist")
-            if not "_content" in self.dict["__exportlist"]:
-                self.dict["__exportlist"]["_content"] = set()
-            self.dict["__exportlist"]["_content"].add(var)
+            exports = self.dict["__exportlist"].get("_content", set())
+            if var not in exports:
+                # The set may be shared with the datastore copied from
+                self.dict["__exportlist"]["_content"] = exports | set([var])
+                self._hash_var_changed("__exportlist")
 
     def getVarFlag(self, var, flag, expand=False, noweakdefault=False, parsing=False):
         local_var = self._findVar(var)
         value = None
         if flag == "_content" and var in self.overridedata and not parsing:
-            match = False
-            active = {}
             self.need_overrides()
-            for (r, o) in self.overridedata[var]:
-                # What about double overrides both with "_" in the name?
-                if o in self.overridesset:
-                    active[o] = r
-                elif "_" in o:
-                    if set(o.split("_")).issubset(self.overridesset):
-                        active[o] = r
-
-            mod = True
-            while mod:
-                mod = False
-                for o in self.overrides:
-                    for a in active.copy():
-                        if a.endswith("_" + o):
-                            t = active[a]
-                            del active[a]
-                            active[a.replace("_" + o, "")] = t
-                            mod = True
-                        elif a == o:
-                            match = active[a]
-                            del active[a]
+            match = self._override_winner(var)
             if match:
                 value = self.getVar(match)
 
@@ -701,12 +969,7 @@ class DataSmart(MutableMapping):
                 value = ""
             self.need_overrides()
             for (r, o) in local_var["_append"]:
-                match = True
-                if o:
-                    for o2 in o.split("_"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
+                if not o or self._override_active(o):
                     value = value + r
 
         if flag == "_content" and local_var is not None and "_prepend" in local_var and not parsing:
@@ -714,13 +977,7 @@ class DataSmart(MutableMapping):
                 value = ""
             self.need_overrides()
             for (r, o) in local_var["_prepend"]:
-
-                match = True
-                if o:
-                    for o2 in o.split("_"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
+                if not o or self._override_active(o):
                     value = r + value
 
         if expand and value:
@@ -734,15 +991,15 @@ class DataSmart(MutableMapping):
 
         if value and flag == "_content" and local_var is not None and "_remove" in local_var:
             removes = []
+            references = set()
+            volatile = False
             self.need_overrides()
             for (r, o) in local_var["_remove"]:
-                match = True
-                if o:
-                    for o2 in o.split("_"):
-                        if not o2 in self.overrides:
-                            match = False                            
-                if match:
-                    removes.extend(self.expand(r).split())
+                if not o or self._override_active(o):
+                    varparse = self.expandWithRefs(r, None)
+                    removes.extend(varparse.value.split())
+                    references |= varparse.references | varparse.lookups
+                    volatile = volatile or varparse.volatile
 
             filtered = filter(lambda v: v not in removes,
                               value.split())
@@ -751,14 +1008,16 @@ class DataSmart(MutableMapping):
                  # We need to ensure the expand cache has the correct value
                  # flag == "_content" here
                 self.expand_cache[var].value = value
+                self._add_expand_deps(var, references, volatile)
         return value
 
     def delVarFlag(self, var, flag, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
+        self._hash_var_changed(var)
         local_var = self._findVar(var)
         if not local_var:
             return
-        if not var in self.dict:
+        if not var in self.localvars:
             self._makeShadowCopy(var)
 
         if var in self.dict and flag in self.dict[var]:
@@ -784,9 +1043,10 @@ class DataSmart(MutableMapping):
         self.setVarFlag(var, flag, newvalue, ignore=True)
 
     def setVarFlags(self, var, flags, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand_cache(var)
+        self._hash_var_changed(var)
         infer_caller_details(loginfo)
-        if not var in self.dict:
+        if not var in self.localvars:
             self._makeShadowCopy(var)
 
         for i in flags:
@@ -814,11 +1074,12 @@ class DataSmart(MutableMapping):
 
 
     def delVarFlags(self, var, **loginfo):
-        self.expand_cache = {}
-        if not var in self.dict:
+        self._invalidate_expand_cache(var)
+        self._hash_var_changed(var)
+        if not var in self.localvars:
             self._makeShadowCopy(var)
 
-        if var in self.dict:
+        if var in self.localvars:
             content = None
 
             loginfo['op'] = 'delete flags'
@@ -827,29 +1088,39 @@ class DataSmart(MutableMapping):
             # try to save the content
             if "_content" in self.dict[var]:
                 content  = self.dict[var]["_content"]
-                self.dict[var]            = {}
+                self._setLocalVar(var, {})
                 self.dict[var]["_content"] = content
             else:
-                del self.dict[var]
+                self._delLocalVar(var)
 
     def createCopy(self):
         """
-        Create a copy of self by setting _data to self
+        Create a copy of self which shares its variables until either sets them
         """
         # we really want this to be a DataSmart...
         data = DataSmart()
-        data.dict["_data"] = self.dict
+        data.dict = self.dict.copy()
+        data.parentdict = self.dict
+        # Copies are only held weakly so must not be in reference cycles,
+        # else they'd be updated by setVar() here until the collector ran
+        self.copies = [ref for ref in self.copies if ref() is not None]
+        self.copies.append(weakref.ref(data))
         data.varhistory = self.varhistory.copy()
-        data.varhistory.datasmart = data
         data.inchistory = self.inchistory.copy()
 
         data._tracking = self._tracking
+        data._accessed = self._accessed
+        # Python being expanded may look things up in a copy
+        data.expand_lookups = self.expand_lookups
 
         data.overrides = None
         data.overridevars = copy.copy(self.overridevars)
         # Should really be a deepcopy but has heavy overhead.
         # Instead, we're careful with writes.
         data.overridedata = copy.copy(self.overridedata)
+        # Which overrides are active only depends on OVERRIDES so is shared
+        for key, (winners, matches) in self.override_cache.iteritems():
+            data.override_cache[key] = (winners.copy(), matches)
 
         return data
 
@@ -870,42 +1141,21 @@ class DataSmart(MutableMapping):
                 self.setVar(key, referrervalue.replace(ref, value))
 
     def localkeys(self):
-        for key in self.dict:
-            if key != '_data':
-                yield key
+        for key in list(self.localvars):
+            yield key
 
     def __iter__(self):
-        deleted = set()
         overrides = set()
-        def keylist(d):        
-            klist = set()
-            for key in d:
-                if key == "_data":
-                    continue
-                if key in deleted:
-                    continue
-                if key in overrides:
-                    continue
-                if not d[key]:
-                    deleted.add(key)
-                    continue
-                klist.add(key)
-
-            if "_data" in d:
-                klist |= keylist(d["_data"])
-
-            return klist
 
         self.need_overrides()
         for var in self.overridedata:
             for (r, o) in self.overridedata[var]:
-                if o in self.overridesset:
+                if o in self.overridesset or self._override_active(o):
                     overrides.add(var)
-                elif "_" in o:
-                    if set(o.split("_")).issubset(self.overridesset):
-                        overrides.add(var)
 
-        for k in keylist(self.dict):
+        # A variable deleted here has an empty dict to hide the parent's
+        keys = [key for key, local_var in self.dict.iteritems() if local_var and key not in overrides]
+        for k in keys:
              yield k
 
         for k in overrides:
@@ -927,38 +1177,61 @@ class DataSmart(MutableMapping):
     def __delitem__(self, var):
         self.delVar(var)
 
-    def get_hash(self):
-        data = {}
-        d = self.createCopy()
-        bb.data.expandKeys(d)
-        bb.data.update_data(d)
-
-        config_whitelist = set((d.getVar("BB_HASHCONFIG_WHITELIST", True) or "").split())
-        keys = set(key for key in iter(d) if not key.startswith("__"))
-        for key in keys:
-            if key in config_whitelist:
-                continue
-
-            value = d.getVar(key, False) or ""
-            data.update({key:value})
-
-            varflags = d.getVarFlags(key, internalflags = True)
-            if not varflags:
-                continue
-            for f in varflags:
-                if f == "_content":
-                    continue
-                data.update({'%s[%s]' % (key, f):varflags[f]})
-
-        for key in ["__BBTASKS", "__BBANONFUNCS", "__BBHANDLERS"]:
-            bb_list = d.getVar(key, False) or []
-            bb_list.sort()
-            data.update({key:str(bb_list)})
-
-            if key == "__BBANONFUNCS":
-                for i in bb_list:
-                    value = d.getVar(i, True) or ""
-                    data.update({i:value})
+    # Variables starting with "__" are bitbake's bookkeeping (e.g. the files
+    # parsed and their mtimes), other than these
+    hash_internal_vars = set(["__BBTASKS", "__BBANONFUNCS", "__BBHANDLERS"])
+
+    def _hash_var_changed(self, var):
+        digest = self.hash_digests.pop(var, None)
+        if self.hash_sum is not None and var not in self.hash_changed:
+            if digest and self._hash_counted(var):
+                self.hash_sum -= digest
+            self.hash_changed.add(var)
+        for ref in self.copies:
+            data = ref()
+            if data is not None and var not in data.localvars:
+                data._hash_var_changed(var)
+
+    def _hash_counted(self, var):
+        return not var.startswith("__") or var in self.hash_internal_vars
+
+    def get_var_hash(self, var):
+        """
+        Return a digest of everything set for var (its value, flags,
+        appends and so on), 0 if nothing is. Kept until var next changes.
+        """
+        digest = self.hash_digests.get(var)
+        if digest is None:
+            digest = 0
+            local_var = self.dict.get(var)
+            if local_var:
+                # Sets with the same contents needn't iterate in the same order
+                items = sorted((flag, sorted(value) if isinstance(value, (set, frozenset)) else value)
+                               for flag, value in local_var.iteritems())
+                digest = int(hashlib.md5("%s %s" % (var, items)).hexdigest(), 16)
+            self.hash_digests[var] = digest
+        return digest
 
-        data_str = str([(k, data[k]) for k in sorted(data.keys())])
-        return hashlib.md5(data_str).hexdigest()
+    def get_hash(self):
+        """
+        Return a hash of the configuration for checking whether it changed.
+        It is the sum of the variables' digests, so only the variables
+        changed since the last call need hashing again.
+        """
+        if self.hash_sum is None:
+            self.hash_sum = 0
+            self.hash_changed = set(self.dict)
+        for var in self.hash_changed:
+            if self._hash_counted(var):
+                self.hash_sum += self.get_var_hash(var)
+        self.hash_changed = set()
+
+        total = self.hash_sum
+        config_whitelist = set((self.getVar("BB_HASHCONFIG_WHITELIST", True) or "").split())
+        for var in config_whitelist:
+            if self._hash_counted(var):
+                total -= self.get_var_hash(var)
+        for var in self.getVar("__BBANONFUNCS", False) or []:
+            if not self._hash_counted(var):
+                total += self.get_var_hash(var)
+        return "%032x" % (total % (1 << 128))
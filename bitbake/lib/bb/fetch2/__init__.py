@@ -34,6 +34,9 @@ import logging
 import urllib
 import urlparse
 import operator
+import time
+import threading
+import contextlib
 import bb.persist_data, bb.utils
 import bb.checksum
 from bb import data
@@ -564,15 +567,12 @@ def verify_checksum(ud, d, precomputed={}):
     if ud.ignore_checksums or not ud.method.supports_checksum(ud):
         return {}
 
-    if _MD5_KEY in precomputed:
-        md5data = precomputed[_MD5_KEY]
-    else:
-        md5data = bb.utils.md5_file(ud.localpath)
-
-    if _SHA256_KEY in precomputed:
-        sha256data = precomputed[_SHA256_KEY]
-    else:
-        sha256data = bb.utils.sha256_file(ud.localpath)
+    checksums = dict(precomputed)
+    missing = [key for key in (_MD5_KEY, _SHA256_KEY) if key not in checksums]
+    if missing:
+        checksums.update(bb.utils.file_digests(ud.localpath, missing))
+    md5data = checksums[_MD5_KEY]
+    sha256data = checksums[_SHA256_KEY]
 
     if ud.method.recommends_checksum(ud):
         # If strict checking enabled and neither sum defined, raise error
@@ -917,12 +917,16 @@ def rename_bad_checksum(ud, suffix):
     bb.utils.movefile(ud.localpath, new_localpath)
 
 
-def try_mirror_url(fetch, origud, ud, ld, check = False):
+def try_mirror_url(fetch, origud, ud, ld, check = False, health = None):
     # Return of None or a value means we're finished
     # False means try another url
+    started = None
     try:
         if check:
+            started = time.time()
             found = ud.method.checkstatus(fetch, ud, ld)
+            if health:
+                health.record(ud, bool(found), time.time() - started)
             if found:
                 return found
             return False
@@ -930,9 +934,15 @@ def try_mirror_url(fetch, origud, ud, ld, check = False):
         os.chdir(ld.getVar("DL_DIR", True))
 
         if not verify_donestamp(ud, ld, origud) or ud.method.need_update(ud, ld):
-            ud.method.download(ud, ld)
+            started = time.time()
+            with download_slot(fetch, ud):
+                ud.method.download(ud, ld)
             if hasattr(ud.method,"build_mirror_data"):
                 ud.method.build_mirror_data(ud, ld)
+            if health:
+                found = ud.localpath and os.path.exists(ud.localpath)
+                health.record(ud, found, time.time() - started)
+                started = None
 
         if not ud.localpath or not os.path.exists(ud.localpath):
             return False
@@ -952,7 +962,8 @@ def try_mirror_url(fetch, origud, ud, ld, check = False):
             if not os.path.exists(dest):
                 os.symlink(ud.localpath, dest)
             if not verify_donestamp(origud, ld) or origud.method.need_update(origud, ld):
-                origud.method.download(origud, ld)
+                with download_slot(fetch, origud):
+                    origud.method.download(origud, ld)
                 if hasattr(origud.method,"build_mirror_data"):
                     origud.method.build_mirror_data(origud, ld)
             return ud.localpath
@@ -970,6 +981,8 @@ def try_mirror_url(fetch, origud, ud, ld, check = False):
         raise
 
     except bb.fetch2.BBFetchException as e:
+        if health and started is not None:
+            health.record(ud, False)
         if isinstance(e, ChecksumError):
             logger.warn("Mirror checksum failure for url %s (original url: %s)\nCleaning and trying again." % (ud.url, origud.url))
             logger.warn(str(e))
@@ -998,12 +1011,172 @@ def try_mirrors(fetch, d, origud, mirrors, check = False):
 
     uris, uds = build_mirroruris(origud, mirrors, ld)
 
-    for index, uri in enumerate(uris):
-        ret = try_mirror_url(fetch, origud, uds[index], ld, check)
+    health = None
+    if ld.getVar("BB_MIRROR_HEALTH", True) == "1":
+        health = MirrorHealth(ld)
+        uds = health.order(uds)
+
+    if check and len(uds) > 1 and ld.getVar("BB_MIRROR_RACE", True) == "1":
+        first, second = uds[:2]
+        if first.host != second.host and first.method.supports_concurrency(first) \
+                and second.method.supports_concurrency(second):
+            ret = race_checkstatus(fetch, origud, uds[:2], ld, health)
+            if ret:
+                return ret
+            uds = uds[2:]
+
+    for ud in uds:
+        ret = try_mirror_url(fetch, origud, ud, ld, check, health)
         if ret != False:
             return ret
     return None
 
+def race_checkstatus(fetch, origud, uds, d, health = None):
+    """
+    Check the mirrors uds at the same time, returning the first to find
+    the object. An error is only raised if none did. All the checks are
+    waited for so that each mirror's health is recorded.
+    """
+    import Queue
+
+    results = Queue.Queue()
+    def check(ud, ld):
+        started = time.time()
+        try:
+            found = try_mirror_url(fetch, origud, ud, ld, True)
+            results.put((ud, found, time.time() - started, None))
+        except Exception as exc:
+            results.put((ud, False, time.time() - started, exc))
+
+    threads = []
+    for ud in uds:
+        thread = threading.Thread(target=check, args=(ud, d.createCopy()))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    ret = False
+    error = None
+    try:
+        for _ in uds:
+            ud, found, elapsed, exc = results.get()
+            if exc:
+                error = error or exc
+                continue
+            if health:
+                health.record(ud, bool(found), elapsed)
+            if found and not ret:
+                ret = found
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if not ret and error:
+        raise error
+    return ret
+
+class MirrorHealth(object):
+    """
+    The history of the mirror sites tried, kept in the BB_MIRROR_HEALTH
+    persistent data domain, so that try_mirrors() can leave failing mirrors
+    until last and skip ones which have failed BB_MIRROR_FAILURE_LIMIT
+    times in a row, until BB_MIRROR_RETRY_INTERVAL seconds have passed.
+
+    Each site ("type://host") maps to "successes failures consecutive
+    lastfailure latency", the latency being a moving average in seconds.
+    """
+    def __init__(self, d):
+        self.table = bb.persist_data.persist("BB_MIRROR_HEALTH", d)
+        self.limit = int(d.getVar("BB_MIRROR_FAILURE_LIMIT", True) or 3)
+        self.interval = float(d.getVar("BB_MIRROR_RETRY_INTERVAL", True) or 300)
+
+    @staticmethod
+    def site(ud):
+        if not ud.host:
+            return None
+        return "%s://%s" % (ud.type, ud.host)
+
+    def get(self, ud):
+        """
+        Return (successes, failures, consecutive, lastfailure, latency) for
+        ud's site
+        """
+        site = self.site(ud)
+        value = site and self.table.get(site)
+        if not value:
+            return (0, 0, 0, 0.0, 0.0)
+        successes, failures, consecutive, lastfailure, latency = value.split()
+        return (int(successes), int(failures), int(consecutive), float(lastfailure), float(latency))
+
+    def record(self, ud, success, elapsed = None):
+        site = self.site(ud)
+        if not site:
+            return
+        successes, failures, consecutive, lastfailure, latency = self.get(ud)
+        if success:
+            successes += 1
+            consecutive = 0
+            if elapsed is not None:
+                latency = elapsed if successes == 1 else 0.7 * latency + 0.3 * elapsed
+        else:
+            failures += 1
+            consecutive += 1
+            lastfailure = time.time()
+        self.table[site] = "%d %d %d %.3f %.3f" % (successes, failures, consecutive, lastfailure, latency)
+
+    def broken(self, ud):
+        """
+        Has ud's site failed too often to be tried again yet?
+        """
+        _, _, consecutive, lastfailure, _ = self.get(ud)
+        return consecutive >= self.limit and time.time() - lastfailure < self.interval
+
+    def order(self, uds):
+        """
+        Drop the mirrors which are broken() and move the ones which failed
+        last time after the others, fewest failures in a row and then the
+        fastest first. Otherwise the configured order is kept.
+        """
+        ranked = []
+        for index, ud in enumerate(uds):
+            if self.broken(ud):
+                logger.debug(1, "Skipping mirror %s after repeated failures" % ud.url)
+                continue
+            _, _, consecutive, _, latency = self.get(ud)
+            if consecutive:
+                ranked.append(((1, consecutive, latency, index), ud))
+            else:
+                ranked.append(((0, 0, 0, index), ud))
+        ranked.sort(key=lambda entry: entry[0])
+        return [ud for _, ud in ranked]
+
+class HostSlots(object):
+    """
+    Limits the number of concurrent downloads from each host
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.slots = {}
+
+    def get(self, host):
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.Semaphore(self.limit)
+            return self.slots[host]
+
+@contextlib.contextmanager
+def download_slot(fetch, ud):
+    """
+    Wait for a free slot for ud's host while fetch is downloading concurrently
+    """
+    slots = getattr(fetch, "download_slots", None)
+    if slots is None or not ud.host:
+        yield
+    else:
+        with slots.get(ud.host):
+            yield
+
 def trusted_network(d, url):
     """
     Use a trusted url during download if networking is enabled and
@@ -1330,6 +1503,13 @@ class FetchMethod(object):
 
     urls = property(getUrls, setUrls, None, "Urls property")
 
+    def supports_concurrency(self, urldata):
+        """
+        Can urldata be downloaded in a thread alongside other downloads?
+        The fetcher mustn't rely on or change the current directory.
+        """
+        return False
+
     def need_update(self, ud, d):
         """
         Force a fetch, even if localpath exists?
@@ -1525,6 +1705,7 @@ class Fetch(object):
         self.d = d
         self.ud = {}
         self.connection_cache = connection_cache
+        self.download_slots = None
 
         fn = d.getVar('FILE', True)
         if cache and fn and fn in urldata_cache:
@@ -1565,86 +1746,160 @@ class Fetch(object):
     def download(self, urls=None):
         """
         Fetch all urls
+
+        If BB_FETCH_THREADS is above 1, the urls whose fetchers (and their
+        mirrors' fetchers) support it are downloaded that many at a time,
+        with no more than BB_FETCH_THREADS_PER_HOST at once from one host.
         """
         if not urls:
             urls = self.urls
 
         network = self.d.getVar("BB_NO_NETWORK", True)
         premirroronly = (self.d.getVar("BB_FETCH_PREMIRRORONLY", True) == "1")
+        threads = int(self.d.getVar("BB_FETCH_THREADS", True) or 1)
+
+        concurrent = []
+        if threads > 1:
+            for u in urls:
+                ud = self.ud[u]
+                ud.setup_localpath(self.d)
+                if self.supports_concurrency(ud):
+                    concurrent.append(u)
+            if len(concurrent) < 2:
+                concurrent = []
 
         for u in urls:
-            ud = self.ud[u]
-            ud.setup_localpath(self.d)
-            m = ud.method
-            localpath = ""
+            if u not in concurrent:
+                self.download_url(u, self.d, network, premirroronly)
 
-            lf = bb.utils.lockfile(ud.lockfile)
+        if concurrent:
+            self.download_concurrently(concurrent, threads, network, premirroronly)
 
-            try:
-                self.d.setVar("BB_NO_NETWORK", network)
+    def supports_concurrency(self, ud):
+        """
+        Can ud be downloaded concurrently, from upstream or any mirror?
+        """
+        if not ud.method.supports_concurrency(ud):
+            return False
+        ld = self.d.createCopy()
+        mirrorvars = ["MIRRORS"]
+        if ud.method.try_premirror(ud, ld):
+            mirrorvars.append("PREMIRRORS")
+        for var in mirrorvars:
+            mirrors = mirror_from_string(ld.getVar(var, True))
+            uris, uds = build_mirroruris(ud, mirrors, ld)
+            for mirrorud in uds:
+                if not mirrorud.method.supports_concurrency(mirrorud):
+                    return False
+        return True
+
+    def download_concurrently(self, urls, threads, network, premirroronly):
+        """
+        Download urls from a pool of threads, each with its own copy of
+        the datastore. The first failure is raised once they've all finished.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        self.download_slots = HostSlots(int(self.d.getVar("BB_FETCH_THREADS_PER_HOST", True) or 2))
+        pool = ThreadPool(min(threads, len(urls)))
+        try:
+            results = []
+            for u in urls:
+                args = (u, self.d.createCopy(), network, premirroronly)
+                results.append(pool.apply_async(self.download_url, args))
+            pool.close()
+
+            failure = None
+            for result in results:
+                try:
+                    result.get()
+                except Exception as e:
+                    if failure is None:
+                        failure = e
+            pool.join()
+            if failure is not None:
+                raise failure
+        finally:
+            pool.terminate()
+            self.download_slots = None
+
+    def download_url(self, u, d, network, premirroronly):
+        """
+        Fetch a single url, using the datastore d
+        """
+        ud = self.ud[u]
+        ud.setup_localpath(d)
+        m = ud.method
+        localpath = ""
+
+        lf = bb.utils.lockfile(ud.lockfile)
+
+        try:
+            d.setVar("BB_NO_NETWORK", network)
  
-                if verify_donestamp(ud, self.d) and not m.need_update(ud, self.d):
+            if verify_donestamp(ud, d) and not m.need_update(ud, d):
+                localpath = ud.localpath
+            elif m.try_premirror(ud, d):
+                logger.debug(1, "Trying PREMIRRORS")
+                mirrors = mirror_from_string(d.getVar('PREMIRRORS', True))
+                localpath = try_mirrors(self, d, ud, mirrors, False)
+
+            if premirroronly:
+                d.setVar("BB_NO_NETWORK", "1")
+
+            os.chdir(d.getVar("DL_DIR", True))
+
+            firsterr = None
+            verified_stamp = verify_donestamp(ud, d)
+            if not localpath and (not verified_stamp or m.need_update(ud, d)):
+                try:
+                    if not trusted_network(d, ud.url):
+                        raise UntrustedUrl(ud.url)
+                    logger.debug(1, "Trying Upstream")
+                    with download_slot(self, ud):
+                        m.download(ud, d)
+                    if hasattr(m, "build_mirror_data"):
+                        m.build_mirror_data(ud, d)
                     localpath = ud.localpath
-                elif m.try_premirror(ud, self.d):
-                    logger.debug(1, "Trying PREMIRRORS")
-                    mirrors = mirror_from_string(self.d.getVar('PREMIRRORS', True))
-                    localpath = try_mirrors(self, self.d, ud, mirrors, False)
-
-                if premirroronly:
-                    self.d.setVar("BB_NO_NETWORK", "1")
-
-                os.chdir(self.d.getVar("DL_DIR", True))
-
-                firsterr = None
-                verified_stamp = verify_donestamp(ud, self.d)
-                if not localpath and (not verified_stamp or m.need_update(ud, self.d)):
-                    try:
-                        if not trusted_network(self.d, ud.url):
-                            raise UntrustedUrl(ud.url)
-                        logger.debug(1, "Trying Upstream")
-                        m.download(ud, self.d)
-                        if hasattr(m, "build_mirror_data"):
-                            m.build_mirror_data(ud, self.d)
-                        localpath = ud.localpath
-                        # early checksum verify, so that if checksum mismatched,
-                        # fetcher still have chance to fetch from mirror
-                        update_stamp(ud, self.d)
-
-                    except bb.fetch2.NetworkAccess:
+                    # early checksum verify, so that if checksum mismatched,
+                    # fetcher still have chance to fetch from mirror
+                    update_stamp(ud, d)
+
+                except bb.fetch2.NetworkAccess:
+                    raise
+
+                except BBFetchException as e:
+                    if isinstance(e, ChecksumError):
+                        logger.warn("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
+                        logger.debug(1, str(e))
+                        rename_bad_checksum(ud, e.checksum)
+                    elif isinstance(e, NoChecksumError):
                         raise
+                    else:
+                        logger.warn('Failed to fetch URL %s, attempting MIRRORS if available' % u)
+                        logger.debug(1, str(e))
+                    firsterr = e
+                    # Remove any incomplete fetch
+                    if not verified_stamp:
+                        m.clean(ud, d)
+                    logger.debug(1, "Trying MIRRORS")
+                    mirrors = mirror_from_string(d.getVar('MIRRORS', True))
+                    localpath = try_mirrors(self, d, ud, mirrors)
+
+            if not localpath or ((not os.path.exists(localpath)) and localpath.find("*") == -1):
+                if firsterr:
+                    logger.error(str(firsterr))
+                raise FetchError("Unable to fetch URL from any source.", u)
+
+            update_stamp(ud, d)
+
+        except BBFetchException as e:
+            if isinstance(e, ChecksumError):
+                logger.error("Checksum failure fetching %s" % u)
+            raise
 
-                    except BBFetchException as e:
-                        if isinstance(e, ChecksumError):
-                            logger.warn("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
-                            logger.debug(1, str(e))
-                            rename_bad_checksum(ud, e.checksum)
-                        elif isinstance(e, NoChecksumError):
-                            raise
-                        else:
-                            logger.warn('Failed to fetch URL %s, attempting MIRRORS if available' % u)
-                            logger.debug(1, str(e))
-                        firsterr = e
-                        # Remove any incomplete fetch
-                        if not verified_stamp:
-                            m.clean(ud, self.d)
-                        logger.debug(1, "Trying MIRRORS")
-                        mirrors = mirror_from_string(self.d.getVar('MIRRORS', True))
-                        localpath = try_mirrors(self, self.d, ud, mirrors)
-
-                if not localpath or ((not os.path.exists(localpath)) and localpath.find("*") == -1):
-                    if firsterr:
-                        logger.error(str(firsterr))
-                    raise FetchError("Unable to fetch URL from any source.", u)
-
-                update_stamp(ud, self.d)
-
-            except BBFetchException as e:
-                if isinstance(e, ChecksumError):
-                    logger.error("Checksum failure fetching %s" % u)
-                raise
-
-            finally:
-                bb.utils.unlockfile(lf)
+        finally:
+            bb.utils.unlockfile(lf)
 
     def checkstatus(self, urls=None):
         """
@@ -40,6 +40,9 @@ class Local(FetchMethod):
         """
         return urldata.type in ['file']
 
+    def supports_concurrency(self, urldata):
+        return True
+
     def urldata_init(self, ud, d):
         # We don't set localfile as for this fetcher the file is already local!
         ud.decodedurl = urllib.unquote(ud.url.split("://")[1].split(";")[0])
@@ -50,6 +50,9 @@ class Wget(FetchMethod):
     def recommends_checksum(self, urldata):
         return True
 
+    def supports_concurrency(self, urldata):
+        return True
+
     def urldata_init(self, ud, d):
         if 'protocol' in ud.parm:
             if ud.parm['protocol'] == 'git':
@@ -0,0 +1,155 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+"""
+BitBake 'Framing' implementation
+
+Messages passed over the pipes between the cooker, bitbake-worker and the
+task processes. Each message is a header giving the length of its name
+and payload, followed by the name and the payload, so a reader never has
+to search the data for the end of a message.
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import errno
+import os
+import struct
+
+header = struct.Struct("!BI")
+
+# Consumed data is only dropped from the front of a buffer once there is
+# at least this much of it and it's over half the buffer, so each byte is
+# moved a bounded number of times
+compact_threshold = 65536
+
+def frame(name, payload=""):
+    """Return the message name with payload, ready to write to a pipe"""
+    return header.pack(len(name), len(payload)) + name + payload
+
+class FrameReader(object):
+    """
+    Collect data read from a pipe and split it into messages
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        self.buffer.extend(data)
+
+    def read(self, f, size=102400):
+        """
+        Read what is available from the non-blocking file f, returning
+        whether anything was read
+        """
+        try:
+            data = f.read(size)
+        except (OSError, IOError) as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return False
+        if not data:
+            return False
+        self.feed(data)
+        return True
+
+    def pending(self):
+        """Return the number of bytes of incomplete messages buffered"""
+        return len(self.buffer) - self.pos
+
+    def _next_frame(self, pos):
+        """
+        Return the offsets of the name and payload of the message at pos and
+        the end of the message, or None if it is incomplete
+        """
+        if len(self.buffer) - pos < header.size:
+            return None
+        namelen, payloadlen = header.unpack_from(self.buffer, pos)
+        name = pos + header.size
+        payload = name + namelen
+        end = payload + payloadlen
+        if end > len(self.buffer):
+            return None
+        return name, payload, end
+
+    def _consumed(self, pos):
+        self.pos = pos
+        if self.pos == len(self.buffer):
+            del self.buffer[:]
+            self.pos = 0
+        elif self.pos >= compact_threshold and self.pos * 2 > len(self.buffer):
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+    def messages(self):
+        """Return the complete messages buffered as (name, payload) pairs"""
+        messages = []
+        pos = self.pos
+        while True:
+            offsets = self._next_frame(pos)
+            if offsets is None:
+                break
+            name, payload, end = offsets
+            messages.append((str(self.buffer[name:payload]), memoryview(self.buffer)[payload:end].tobytes()))
+            pos = end
+        self._consumed(pos)
+        return messages
+
+    def frames(self):
+        """
+        Return the complete messages buffered, still framed, as a single
+        string for passing on to another pipe
+        """
+        pos = self.pos
+        while True:
+            offsets = self._next_frame(pos)
+            if offsets is None:
+                break
+            pos = offsets[2]
+        data = memoryview(self.buffer)[self.pos:pos].tobytes()
+        self._consumed(pos)
+        return data
+
+class FrameWriter(object):
+    """
+    Queue messages to write to a non-blocking file descriptor
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.buffer) - self.pos
+
+    def queue(self, data):
+        self.buffer.extend(data)
+
+    def flush(self):
+        """Write as much of the queue as the file descriptor will take"""
+        if self.pos == len(self.buffer):
+            return
+        try:
+            written = os.write(self.fd, memoryview(self.buffer)[self.pos:])
+        except (IOError, OSError) as e:
+            if e.errno != errno.EAGAIN and e.errno != errno.EPIPE:
+                raise
+            return
+        self.pos += written
+        if self.pos == len(self.buffer):
+            del self.buffer[:]
+            self.pos = 0
+        elif self.pos >= compact_threshold and self.pos * 2 > len(self.buffer):
+            del self.buffer[:self.pos]
+            self.pos = 0
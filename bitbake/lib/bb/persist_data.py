@@ -40,11 +40,6 @@ if sqlversion[0] < 3 or (sqlversion[0] == 3 and sqlversion[1] < 3):
 
 
 logger = logging.getLogger("BitBake.PersistData")
-if hasattr(sqlite3, 'enable_shared_cache'):
-    try:
-        sqlite3.enable_shared_cache(True)
-    except sqlite3.OperationalError:
-        pass
 
 
 @total_ordering
@@ -54,9 +49,12 @@ class SQLTable(collections.MutableMapping):
         self.cachefile = cachefile
         self.table = table
         self.cursor = connect(self.cachefile)
+        self.transactions = 0
 
-        self._execute("CREATE TABLE IF NOT EXISTS %s(key TEXT, value TEXT);"
+        self._execute("CREATE TABLE IF NOT EXISTS %s(key TEXT PRIMARY KEY NOT NULL, value TEXT);"
                       % table)
+        if not self._keyed():
+            self._migrate()
 
     def _execute(self, *query):
         """Execute a query, waiting to acquire a lock if necessary"""
@@ -65,31 +63,67 @@ class SQLTable(collections.MutableMapping):
             try:
                 return self.cursor.execute(*query)
             except sqlite3.OperationalError as exc:
-                if 'database is locked' in str(exc) and count < 500:
+                # Reconnecting would lose an open transaction
+                if 'database is locked' in str(exc) and count < 500 and not self.transactions:
                     count = count + 1
                     self.cursor.close()
                     self.cursor = connect(self.cachefile)
                     continue
                 raise
 
+    def _keyed(self):
+        """Is the table keyed on key, rather than created by older versions?"""
+        for row in self._execute("PRAGMA table_info(%s);" % self.table):
+            if row[1] == "key":
+                return bool(row[5])
+        return False
+
+    def _migrate(self):
+        """
+        Rebuild a table from before keys were unique, keeping the last
+        value stored for each key
+        """
+        with self:
+            # Another process may have got here first
+            if self._keyed():
+                return
+            old = "%s_unkeyed" % self.table
+            self._execute("ALTER TABLE %s RENAME TO %s;" % (self.table, old))
+            self._execute("CREATE TABLE %s(key TEXT PRIMARY KEY NOT NULL, value TEXT);" % self.table)
+            self._execute("INSERT OR REPLACE INTO %s(key, value) SELECT key, value FROM %s "
+                          "WHERE key IS NOT NULL ORDER BY rowid;" % (self.table, old))
+            self._execute("DROP TABLE %s;" % old)
+        logger.debug(1, "Added a key to the %s table in %s", self.table, self.cachefile)
+
     def __enter__(self):
-        self.cursor.__enter__()
+        """
+        Start a transaction, so that the writes made until __exit__() are
+        committed together. Transactions can be nested.
+        """
+        if not self.transactions:
+            self._execute("BEGIN IMMEDIATE;")
+        self.transactions += 1
         return self
 
-    def __exit__(self, *excinfo):
-        self.cursor.__exit__(*excinfo)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.transactions -= 1
+        if not self.transactions:
+            if exc_type is None:
+                self.cursor.execute("COMMIT;")
+            else:
+                self.cursor.execute("ROLLBACK;")
 
     def __getitem__(self, key):
-        data = self._execute("SELECT * from %s where key=?;" %
+        data = self._execute("SELECT value from %s where key=?;" %
                              self.table, [key])
         for row in data:
-            return row[1]
+            return row[0]
         raise KeyError(key)
 
     def __delitem__(self, key):
-        if key not in self:
+        data = self._execute("DELETE from %s where key=?;" % self.table, [key])
+        if not data.rowcount:
             raise KeyError(key)
-        self._execute("DELETE from %s where key=?;" % self.table, [key])
 
     def __setitem__(self, key, value):
         if not isinstance(key, basestring):
@@ -97,18 +131,20 @@ class SQLTable(collections.MutableMapping):
         elif not isinstance(value, basestring):
             raise TypeError('Only string values are supported')
 
-        data = self._execute("SELECT * from %s where key=?;" %
-                                   self.table, [key])
-        exists = len(list(data))
-        if exists:
-            self._execute("UPDATE %s SET value=? WHERE key=?;" % self.table,
-                          [value, key])
-        else:
-            self._execute("INSERT into %s(key, value) values (?, ?);" %
-                          self.table, [key, value])
+        self._execute("INSERT OR REPLACE into %s(key, value) values (?, ?);" %
+                      self.table, [key, value])
 
     def __contains__(self, key):
-        return key in set(self)
+        data = self._execute("SELECT 1 from %s where key=?;" %
+                             self.table, [key])
+        for row in data:
+            return True
+        return False
+
+    def update(self, *args, **kwargs):
+        """Store several items in a single transaction"""
+        with self:
+            collections.MutableMapping.update(self, *args, **kwargs)
 
     def __len__(self):
         data = self._execute("SELECT COUNT(key) FROM %s;" % self.table)
@@ -201,6 +237,13 @@ class PersistData(object):
 def connect(database):
     connection = sqlite3.connect(database, timeout=5, isolation_level=None)
     connection.execute("pragma synchronous = off;")
+    # Let readers carry on while another process writes. This is a
+    # property of the database file, so it only needs setting once, and
+    # while other connections use the old journal mode it can't be.
+    try:
+        connection.execute("pragma journal_mode = WAL;")
+    except sqlite3.OperationalError:
+        pass
     return connection
 
 def persist(domain, d):
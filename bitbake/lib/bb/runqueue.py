@@ -23,18 +23,21 @@ Handles preparation and execution of a queue of tasks
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import copy
+import heapq
 import os
 import sys
 import signal
-import stat
 import fcntl
 import errno
 import logging
 import re
 import bb
+import bb.framing
 from bb import msg, data, event
 from bb import monitordisk
 import subprocess
+import time
+from collections import defaultdict
 
 try:
     import cPickle as pickle
@@ -107,44 +110,75 @@ class RunQueueScheduler(object):
         self.prio_map.extend(range(self.numTasks))
 
         self.buildable = []
+        # Buildable tasks which couldn't be started, by what they wait for
+        self.held = defaultdict(list)
         self.stamps = {}
         for taskid in xrange(self.numTasks):
             fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[taskid]]
             taskname = self.rqdata.runq_task[taskid]
-            self.stamps[taskid] = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+            self.stamps[taskid] = self.rq.rq.stampindex.stampfile(taskname, self.rqdata.dataCache, fn)
             if self.rq.runq_buildable[taskid] == 1:
                 self.buildable.append(taskid)
 
         self.rev_prio_map = None
 
-    def next_buildable_task(self):
+    def init_ready_queue(self):
         """
-        Return the id of the first task we find that is buildable
+        Turn self.buildable into a heap of (priority, taskid), this has to
+        wait until subclasses have set up the priority map
         """
-        self.buildable = [x for x in self.buildable if not self.rq.runq_running[x] == 1]
-        if not self.buildable:
-            return None
-        if len(self.buildable) == 1:
-            taskid = self.buildable[0]
-            stamp = self.stamps[taskid]
-            if stamp not in self.rq.build_stamps.itervalues():
-                return taskid
+        self.rev_prio_map = range(self.numTasks)
+        for taskid in xrange(self.numTasks):
+            self.rev_prio_map[self.prio_map[taskid]] = taskid
+        self.buildable = [(self.rev_prio_map[taskid], taskid) for taskid in self.buildable]
+        heapq.heapify(self.buildable)
+
+    def blocked_by(self, taskid):
+        """
+        Return what keeps a buildable task from being started now, or None
+        if it may be. It can't while another task with the same stamp is
+        running. The task is held back until release() is called with the
+        value returned.
+        """
+        stamp = self.stamps[taskid]
+        if stamp in self.rq.build_stamps2:
+            return stamp
+        return None
 
-        if not self.rev_prio_map:
-            self.rev_prio_map = range(self.numTasks)
-            for taskid in xrange(self.numTasks):
-                self.rev_prio_map[self.prio_map[taskid]] = taskid
+    def release(self, blocker):
+        """Put the tasks held back by blocker back in the queue"""
+        for entry in self.held.pop(blocker, ()):
+            heapq.heappush(self.buildable, entry)
+
+    def task_finished(self, task):
+        """
+        Called when a task which was started has finished, whether or not
+        it succeeded
+        """
+        self.release(self.stamps[task])
+
+    def next_buildable_task(self):
+        """
+        Return the id of the highest priority buildable task which can be
+        started. The task is left in the queue, it gets discarded once it
+        is marked as running.
+        """
+        if self.rev_prio_map is None:
+            self.init_ready_queue()
 
+        buildable = self.buildable
+        running = self.rq.runq_running
         best = None
-        bestprio = None
-        for taskid in self.buildable:
-            prio = self.rev_prio_map[taskid]
-            if bestprio is None or bestprio > prio:
-                stamp = self.stamps[taskid]
-                if stamp in self.rq.build_stamps.itervalues():
-                    continue
-                bestprio = prio
+        while buildable:
+            taskid = buildable[0][1]
+            if running[taskid] == 1:
+                heapq.heappop(buildable)
+                continue
+            blocker = self.blocked_by(taskid)
+            if blocker is None:
                 best = taskid
+                break
+            self.held[blocker].append(heapq.heappop(buildable))
 
         return best
 
@@ -156,7 +190,10 @@ class RunQueueScheduler(object):
             return self.next_buildable_task()
 
     def newbuilable(self, task):
-        self.buildable.append(task)
+        if self.rev_prio_map is None:
+            self.buildable.append(task)
+        else:
+            heapq.heappush(self.buildable, (self.rev_prio_map[task], task))
 
 class RunQueueSchedulerSpeed(RunQueueScheduler):
     """
@@ -171,16 +208,9 @@ class RunQueueSchedulerSpeed(RunQueueScheduler):
         """
         RunQueueScheduler.__init__(self, runqueue, rqdata)
 
-        sortweight = sorted(copy.deepcopy(self.rqdata.runq_weight))
-        copyweight = copy.deepcopy(self.rqdata.runq_weight)
-        self.prio_map = []
-
-        for weight in sortweight:
-            idx = copyweight.index(weight)
-            self.prio_map.append(idx)
-            copyweight[idx] = -1
-
-        self.prio_map.reverse()
+        # Heaviest first, tasks with equal weights in reverse task order
+        weights = self.rqdata.runq_weight
+        self.prio_map = sorted(xrange(self.numTasks), key=lambda taskid: (weights[taskid], taskid), reverse=True)
 
 class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
     """
@@ -198,21 +228,259 @@ class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
         #FIXME - whilst this groups all fnids together it does not reorder the
         #fnid groups optimally.
 
-        basemap = copy.deepcopy(self.prio_map)
+        # Each fnid's tasks go where its first task was, in the same order
+        # they had relative to each other
+        fnid_tasks = defaultdict(list)
+        fnid_order = []
+        for taskid in self.prio_map:
+            fnid = self.rqdata.runq_fnid[taskid]
+            if fnid not in fnid_tasks:
+                fnid_order.append(fnid)
+            fnid_tasks[fnid].append(taskid)
         self.prio_map = []
-        while (len(basemap) > 0):
-            entry = basemap.pop(0)
-            self.prio_map.append(entry)
-            fnid = self.rqdata.runq_fnid[entry]
-            todel = []
-            for entry in basemap:
-                entry_fnid = self.rqdata.runq_fnid[entry]
-                if entry_fnid == fnid:
-                    todel.append(basemap.index(entry))
-                    self.prio_map.append(entry)
-            todel.reverse()
-            for idx in todel:
-                del basemap[idx]
+        for fnid in fnid_order:
+            self.prio_map.extend(fnid_tasks[fnid])
+
+class RunQueueSchedulerResource(RunQueueSchedulerSpeed):
+    """
+    A scheduler which runs tasks in the same order as the speed scheduler
+    but limits how many tasks of each resource class can run at once. A
+    task's class comes from its [resourceclass] flag, e.g. "cpu", "io" or
+    "memory", or BB_RESOURCE_DEFAULT_CLASS if it has none, and
+    BB_RESOURCE_BUDGETS sets the limits as class:count pairs. Whilst the
+    load average is above BB_RESOURCE_MAX_LOAD no further "cpu" tasks are
+    started, and whilst there is less than BB_RESOURCE_MIN_FREE_MEMORY
+    megabytes of memory available no further "memory" tasks are, nor any
+    other tasks apart from "io" ones. One task of each class is always
+    allowed to run so the build can't stall.
+    """
+    name = "resource"
+
+    # Seconds between checks of the load average and free memory
+    sample_interval = 1
+
+    def __init__(self, runqueue, rqdata):
+        RunQueueSchedulerSpeed.__init__(self, runqueue, rqdata)
+
+        cfgData = self.rq.cfgData
+        self.budgets = {}
+        for entry in (cfgData.getVar("BB_RESOURCE_BUDGETS", True) or "").split():
+            resourceclass, _, budget = entry.partition(":")
+            try:
+                self.budgets[resourceclass] = max(int(budget), 1)
+            except ValueError:
+                bb.fatal("Invalid BB_RESOURCE_BUDGETS entry '%s', expected class:count" % entry)
+        try:
+            self.max_load = float(cfgData.getVar("BB_RESOURCE_MAX_LOAD", True) or 0)
+            self.min_free_memory = int(cfgData.getVar("BB_RESOURCE_MIN_FREE_MEMORY", True) or 0) * 1024
+        except ValueError as exc:
+            bb.fatal("Invalid resource scheduler setting: %s" % exc)
+
+        defaultclass = cfgData.getVar("BB_RESOURCE_DEFAULT_CLASS", True) or None
+        self.resourceclass = []
+        for taskid in xrange(self.numTasks):
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[taskid]]
+            taskname = self.rqdata.runq_task[taskid]
+            classes = self.rqdata.dataCache.task_deps[fn].get('resourceclass', {})
+            self.resourceclass.append(classes.get(taskname) or defaultclass)
+
+        self.running = defaultdict(int)
+        self.running_heavy = 0
+        self.overloaded = set()
+        self.last_sample = 0
+
+    def sample(self):
+        """
+        Work out which classes are held back by the load average or memory
+        pressure, at most once every sample_interval seconds
+        """
+        now = time.time()
+        if now - self.last_sample < self.sample_interval:
+            return
+        self.last_sample = now
+        overloaded = set()
+        if self.max_load:
+            try:
+                if os.getloadavg()[0] > self.max_load:
+                    overloaded.add("cpu")
+            except OSError:
+                pass
+        if self.min_free_memory:
+            available = self.available_memory()
+            if available is not None and available < self.min_free_memory:
+                overloaded.add("memory")
+        self.set_overloaded(overloaded)
+
+    def set_overloaded(self, overloaded):
+        """Hold back the classes in overloaded, releasing any others"""
+        for resourceclass in self.overloaded - overloaded:
+            self.release(("resourceclass", resourceclass))
+            if resourceclass == "memory":
+                self.release(("memory",))
+        self.overloaded = overloaded
+
+    @staticmethod
+    def available_memory():
+        """Return the available memory in kB, or None if it isn't known"""
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1])
+        except (IOError, ValueError, IndexError):
+            pass
+        return None
+
+    def blocked_by(self, taskid):
+        blocker = RunQueueSchedulerSpeed.blocked_by(self, taskid)
+        if blocker is not None:
+            return blocker
+        resourceclass = self.resourceclass[taskid]
+        if resourceclass is not None:
+            running = self.running[resourceclass]
+            if running >= self.budgets.get(resourceclass, running + 1):
+                return ("resourceclass", resourceclass)
+            if running and resourceclass in self.overloaded:
+                return ("resourceclass", resourceclass)
+        if resourceclass != "io" and "memory" in self.overloaded and self.running_heavy:
+            return ("memory",)
+        return None
+
+    def task_finished(self, task):
+        RunQueueSchedulerSpeed.task_finished(self, task)
+        resourceclass = self.resourceclass[task]
+        self.release(("resourceclass", resourceclass))
+        if resourceclass != "io":
+            self.release(("memory",))
+
+    def next_buildable_task(self):
+        self.running = defaultdict(int)
+        for taskid in self.rq.build_stamps:
+            self.running[self.resourceclass[taskid]] += 1
+        self.running_heavy = sum(count for resourceclass, count in self.running.items()
+                                 if resourceclass != "io")
+        self.sample()
+        return RunQueueSchedulerSpeed.next_buildable_task(self)
+
+class RunQueueSchedulerCritical(RunQueueSchedulerSpeed):
+    """
+    A scheduler which runs first the tasks with the longest chain of work
+    left behind them, using how long each task took last time. Tasks that
+    haven't run before are assumed to take the average time of tasks with
+    the same name. Ties, and builds with no history, fall back to the task
+    weights used by the speed scheduler.
+    """
+    name = "critical"
+
+    def __init__(self, runqueue, rqdata):
+        RunQueueSchedulerSpeed.__init__(self, runqueue, rqdata)
+
+        durations = self.rq.taskdurations
+        if not durations.durations:
+            self.import_buildstats(durations)
+
+        dataCache = self.rqdata.dataCache
+        covered = self.rq.rq.scenequeue_covered
+        known = {}
+        for taskid in xrange(self.numTasks):
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[taskid]]
+            duration = durations.get(dataCache.pkg_fn[fn], self.rqdata.runq_task[taskid])
+            if duration is not None:
+                known[taskid] = duration
+        if not known:
+            return
+
+        bytask = defaultdict(list)
+        for taskid, duration in known.iteritems():
+            bytask[self.rqdata.runq_task[taskid]].append(duration)
+        average = sum(known.itervalues()) / len(known)
+        for taskname in bytask:
+            bytask[taskname] = sum(bytask[taskname]) / len(bytask[taskname])
+
+        duration = []
+        for taskid in xrange(self.numTasks):
+            if taskid in covered:
+                # Will be skipped in favour of the setscene task
+                duration.append(0)
+            elif taskid in known:
+                duration.append(known[taskid])
+            else:
+                duration.append(bytask.get(self.rqdata.runq_task[taskid], average))
+
+        path = self.critical_paths(duration)
+        weights = self.rqdata.runq_weight
+        self.prio_map = sorted(xrange(self.numTasks), key=lambda taskid: (path[taskid], weights[taskid], taskid), reverse=True)
+
+    def critical_paths(self, duration):
+        """
+        Return the length of the longest chain of tasks from each task to
+        the end of the build, working back from the tasks nothing depends on
+        """
+        path = list(duration)
+        deps_left = [len(self.rqdata.runq_revdeps[taskid]) for taskid in xrange(self.numTasks)]
+        endpoints = [taskid for taskid in xrange(self.numTasks) if not deps_left[taskid]]
+        while endpoints:
+            taskid = endpoints.pop()
+            for dep in self.rqdata.runq_depends[taskid]:
+                path[dep] = max(path[dep], duration[dep] + path[taskid])
+                deps_left[dep] -= 1
+                if not deps_left[dep]:
+                    endpoints.append(dep)
+        return path
+
+    def import_buildstats(self, durations):
+        """
+        Seed the durations from the most recent previous build recorded
+        by OE's buildstats class, if there is one
+        """
+        bsbase = self.rq.cfgData.getVar("BUILDSTATS_BASE", True)
+        if not bsbase:
+            return
+        bsdir = self.previous_buildstats(bsbase, self.rq.cfgData.getVar("BUILDNAME", True))
+        if not bsdir:
+            return
+
+        dataCache = self.rqdata.dataCache
+        pfmap = {}
+        for fn in set(self.rqdata.taskData.fn_index[fnid] for fnid in self.rqdata.runq_fnid):
+            pn = dataCache.pkg_fn[fn]
+            pe, pv, pr = dataCache.pkg_pepvpr[fn]
+            pfmap["%s-%s-%s" % (pn, pv, pr)] = pn
+            if pe:
+                pfmap["%s-%s_%s-%s" % (pn, pe, pv, pr)] = pn
+        durations.import_buildstats(bsdir, pfmap)
+
+    @staticmethod
+    def previous_buildstats(bsbase, buildname):
+        """
+        Return the newest build directory under bsbase, laid out as
+        <target>-<machine>/<BUILDNAME>, other than the current build's.
+        The .buildname file can't be used as it already names the
+        current build by the time the runqueue is set up.
+        """
+        newest, newest_mtime = None, None
+        try:
+            bns = os.listdir(bsbase)
+        except OSError:
+            return None
+        for bn in bns:
+            if bn.startswith("."):
+                continue
+            try:
+                builds = os.listdir(os.path.join(bsbase, bn))
+            except OSError:
+                continue
+            for build in builds:
+                if build == buildname:
+                    continue
+                bsdir = os.path.join(bsbase, bn, build)
+                try:
+                    mtime = os.stat(bsdir).st_mtime
+                except OSError:
+                    continue
+                if os.path.isdir(bsdir) and (newest_mtime is None or mtime > newest_mtime):
+                    newest, newest_mtime = bsdir, mtime
+        return newest
 
 class RunQueueData:
     """
@@ -806,18 +1074,35 @@ class RunQueueData:
         if hasattr(bb.parse.siggen, "tasks_resolved"):
             bb.parse.siggen.tasks_resolved(virtmap, virtpnmap, self.dataCache)
 
-        # Iterate over the task list and call into the siggen code
-        dealtwith = set()
-        todeal = set(range(len(self.runq_fnid)))
-        while len(todeal) > 0:
-            for task in todeal.copy():
-                if len(self.runq_depends[task] - dealtwith) == 0:
-                    dealtwith.add(task)
-                    todeal.remove(task)
-                    procdep = []
-                    for dep in self.runq_depends[task]:
-                        procdep.append(self.taskData.fn_index[self.runq_fnid[dep]] + "." + self.runq_task[dep])
-                    self.runq_hash[task] = bb.parse.siggen.get_taskhash(self.taskData.fn_index[self.runq_fnid[task]], self.runq_task[task], procdep, self.dataCache)
+        logger.verbose("Compute task hashes")
+        started = time.time()
+
+        # The file checksums and taints don't depend on the order
+        tasknames = [(taskData.fn_index[self.runq_fnid[task]], self.runq_task[task]) for task in xrange(len(self.runq_fnid))]
+        bb.parse.siggen.prepare_taskhashes(tasknames, self.dataCache, bb.utils.cpu_count())
+        prepared = time.time()
+
+        # Iterate over the task list and call into the siggen code a level
+        # of the dependency graph at a time, each task after its dependencies
+        deps_left = [len(deps) for deps in self.runq_depends]
+        level = [task for task in xrange(len(self.runq_fnid)) if not deps_left[task]]
+        levels = 0
+        while level:
+            levels += 1
+            nextlevel = []
+            for task in level:
+                procdep = []
+                for dep in self.runq_depends[task]:
+                    procdep.append("%s.%s" % tasknames[dep])
+                self.runq_hash[task] = bb.parse.siggen.get_taskhash(tasknames[task][0], tasknames[task][1], procdep, self.dataCache)
+                for revdep in self.runq_revdeps[task]:
+                    deps_left[revdep] -= 1
+                    if not deps_left[revdep]:
+                        nextlevel.append(revdep)
+            level = nextlevel
+
+        logger.verbose("Computed %s task hashes over %s levels in %.2fs (%.2fs of it on file checksums and taints)",
+                       len(self.runq_fnid), levels, time.time() - started, prepared - started)
 
         return len(self.runq_fnid)
 
@@ -857,6 +1142,8 @@ class RunQueue:
         self.setsceneverify = cfgData.getVar("BB_SETSCENE_VERIFY_FUNCTION", True) or None
         self.depvalidate = cfgData.getVar("BB_SETSCENE_DEPVALID", True) or None
 
+        self.stampindex = bb.build.StampIndex()
+
         self.state = runQueuePrepare
 
         # For disk space monitor
@@ -902,8 +1189,8 @@ class RunQueue:
             "time" : self.cfgData.getVar("TIME", True),
         }
 
-        worker.stdin.write("<cookerconfig>" + pickle.dumps(self.cooker.configuration) + "</cookerconfig>")
-        worker.stdin.write("<workerdata>" + pickle.dumps(workerdata) + "</workerdata>")
+        worker.stdin.write(bb.framing.frame("cookerconfig", pickle.dumps(self.cooker.configuration)))
+        worker.stdin.write(bb.framing.frame("workerdata", pickle.dumps(workerdata)))
         worker.stdin.flush()
 
         return worker, workerpipe
@@ -913,7 +1200,7 @@ class RunQueue:
             return
         logger.debug(1, "Teardown for bitbake-worker")
         try:
-           worker.stdin.write("<quit></quit>")
+           worker.stdin.write(bb.framing.frame("quit"))
            worker.stdin.flush()
         except IOError:
            pass
@@ -957,13 +1244,7 @@ class RunQueue:
         return fds
 
     def check_stamp_task(self, task, taskname = None, recurse = False, cache = None):
-        def get_timestamp(f):
-            try:
-                if not os.access(f, os.F_OK):
-                    return None
-                return os.stat(f)[stat.ST_MTIME]
-            except:
-                return None
+        stampindex = self.stampindex
 
         if self.stamppolicy == "perfile":
             fulldeptree = False
@@ -977,10 +1258,10 @@ class RunQueue:
         if taskname is None:
             taskname = self.rqdata.runq_task[task]
 
-        stampfile = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+        stampfile = stampindex.stampfile(taskname, self.rqdata.dataCache, fn)
 
         # If the stamp is missing, it's not current
-        if not os.access(stampfile, os.F_OK):
+        if not stampindex.exists(stampfile):
             logger.debug(2, "Stampfile %s not available", stampfile)
             return False
         # If it's a 'nostamp' task, it's not current
@@ -996,15 +1277,15 @@ class RunQueue:
             cache = {}
 
         iscurrent = True
-        t1 = get_timestamp(stampfile)
+        t1 = stampindex.mtime(stampfile)
         for dep in self.rqdata.runq_depends[task]:
             if iscurrent:
                 fn2 = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[dep]]
                 taskname2 = self.rqdata.runq_task[dep]
-                stampfile2 = bb.build.stampfile(taskname2, self.rqdata.dataCache, fn2)
-                stampfile3 = bb.build.stampfile(taskname2 + "_setscene", self.rqdata.dataCache, fn2)
-                t2 = get_timestamp(stampfile2)
-                t3 = get_timestamp(stampfile3)
+                stampfile2 = stampindex.stampfile(taskname2, self.rqdata.dataCache, fn2)
+                stampfile3 = stampindex.stampfile(taskname2 + "_setscene", self.rqdata.dataCache, fn2)
+                t2 = stampindex.mtime(stampfile2)
+                t3 = stampindex.mtime(stampfile3)
                 if t3 and t3 > t2:
                    continue
                 if fn == fn2 or (fulldeptree and fn2 not in stampwhitelist):
@@ -1079,6 +1360,8 @@ class RunQueue:
 
         if (self.state is runQueueComplete or self.state is runQueueFailed) and self.rqexe:
             self.teardown_workers()
+            if self.rqexe.taskdurations:
+                self.rqexe.taskdurations.save()
             if self.rqexe.stats.failed:
                 logger.info("Tasks Summary: Attempted %d tasks of which %d didn't need to be rerun and %d failed.", self.rqexe.stats.completed + self.rqexe.stats.failed, self.rqexe.stats.skipped, self.rqexe.stats.failed)
             else:
@@ -1268,6 +1551,8 @@ class RunQueue:
 
 class RunQueueExecute:
 
+    taskdurations = None
+
     def __init__(self, rq):
         self.rq = rq
         self.cooker = rq.cooker
@@ -1282,7 +1567,8 @@ class RunQueueExecute:
         self.runq_complete = []
 
         self.build_stamps = {}
-        self.build_stamps2 = []
+        # The stamps of the tasks currently running
+        self.build_stamps2 = set()
         self.failed_fnids = []
 
         self.stampcache = {}
@@ -1298,7 +1584,7 @@ class RunQueueExecute:
 
         # self.build_stamps[pid] may not exist when use shared work directory.
         if task in self.build_stamps:
-            self.build_stamps2.remove(self.build_stamps[task])
+            self.build_stamps2.discard(self.build_stamps[task])
             del self.build_stamps[task]
 
         if status != 0:
@@ -1313,7 +1599,7 @@ class RunQueueExecute:
             if not worker:
                 continue
             try:
-                worker.stdin.write("<finishnow></finishnow>")
+                worker.stdin.write(bb.framing.frame("finishnow"))
                 worker.stdin.flush()
             except IOError:
                 # worker must have died?
@@ -1378,6 +1664,11 @@ class RunQueueExecuteTasks(RunQueueExecute):
 
         self.stampcache = {}
 
+        # When each running task was started, to record how long it took
+        self.task_started = {}
+        self.taskdurations = bb.cache.TaskDurationCache(self.cfgData.getVar("PERSISTENT_DIR", True) or
+                                                        self.cfgData.getVar("CACHE", True))
+
         initial_covered = self.rq.scenequeue_covered.copy()
 
         # Mark initial buildable tasks
@@ -1437,6 +1728,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
             fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
             taskname = self.rqdata.runq_task[task] + '_setscene'
             bb.build.del_stamp(taskname, self.rqdata.dataCache, fn)
+            self.rq.stampindex.stamp_removed(taskname, self.rqdata.dataCache, fn)
             self.rq.scenequeue_covered.remove(task)
 
         toremove = covered_remove
@@ -1491,6 +1783,22 @@ class RunQueueExecuteTasks(RunQueueExecute):
                     schedulers.add(getattr(module, name))
         return schedulers
 
+    def runqueue_process_waitpid(self, task, status):
+        started = self.task_started.pop(task, None)
+        if status == 0 and not self.cooker.configuration.dry_run:
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+            taskname = self.rqdata.runq_task[task]
+            if started is not None:
+                self.taskdurations.record(self.rqdata.dataCache.pkg_fn[fn], taskname, time.time() - started)
+            # The worker has written the stamp, as in bb.build._exec_task(),
+            # and left replacing the old one to us
+            taskdep = self.rqdata.dataCache.task_deps[fn]
+            if not ('nostamp' in taskdep and taskname in taskdep['nostamp']):
+                self.rq.stampindex.stamp_made(taskname, self.rqdata.dataCache, fn)
+        ret = RunQueueExecute.runqueue_process_waitpid(self, task, status)
+        self.sched.task_finished(task)
+        return ret
+
     def setbuildable(self, task):
         self.runq_buildable[task] = 1
         self.sched.newbuilable(task)
@@ -1579,7 +1887,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
                 self.runq_running[task] = 1
                 self.stats.taskActive()
                 if not self.cooker.configuration.dry_run:
-                    bb.build.make_stamp(taskname, self.rqdata.dataCache, fn)
+                    bb.build.make_stamp(taskname, self.rqdata.dataCache, fn, self.rq.stampindex)
                 self.task_complete(task)
                 return True
             else:
@@ -1597,14 +1905,15 @@ class RunQueueExecuteTasks(RunQueueExecute):
                         logger.critical("Failed to spawn fakeroot worker to run %s:%s: %s" % (fn, taskname, str(exc)))
                         self.rq.state = runQueueFailed
                         return True
-                self.rq.fakeworker.stdin.write("<runtask>" + pickle.dumps((fn, task, taskname, False, self.cooker.collection.get_file_appends(fn), taskdepdata)) + "</runtask>")
+                self.rq.fakeworker.stdin.write(bb.framing.frame("runtask", pickle.dumps((fn, task, taskname, False, self.cooker.collection.get_file_appends(fn), taskdepdata))))
                 self.rq.fakeworker.stdin.flush()
             else:
-                self.rq.worker.stdin.write("<runtask>" + pickle.dumps((fn, task, taskname, False, self.cooker.collection.get_file_appends(fn), taskdepdata)) + "</runtask>")
+                self.rq.worker.stdin.write(bb.framing.frame("runtask", pickle.dumps((fn, task, taskname, False, self.cooker.collection.get_file_appends(fn), taskdepdata))))
                 self.rq.worker.stdin.flush()
 
-            self.build_stamps[task] = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
-            self.build_stamps2.append(self.build_stamps[task]) 
+            self.build_stamps[task] = self.rq.stampindex.stampfile(taskname, self.rqdata.dataCache, fn)
+            self.build_stamps2.add(self.build_stamps[task])
+            self.task_started[task] = time.time()
             self.runq_running[task] = 1
             self.stats.taskActive()
             if self.stats.active < self.number_tasks:
@@ -1831,7 +2140,7 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
                 if 'noexec' in taskdep and taskname in taskdep['noexec']:
                     noexec.append(task)
                     self.task_skip(task)
-                    bb.build.make_stamp(taskname + "_setscene", self.rqdata.dataCache, fn)
+                    bb.build.make_stamp(taskname + "_setscene", self.rqdata.dataCache, fn, self.rq.stampindex)
                     continue
 
                 if self.rq.check_stamp_task(realtask, taskname + "_setscene", cache=self.stampcache):
@@ -1988,10 +2297,10 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
             if 'fakeroot' in taskdep and taskname in taskdep['fakeroot']:
                 if not self.rq.fakeworker:
                     self.rq.start_fakeworker(self)
-                self.rq.fakeworker.stdin.write("<runtask>" + pickle.dumps((fn, realtask, taskname, True, self.cooker.collection.get_file_appends(fn), None)) + "</runtask>")
+                self.rq.fakeworker.stdin.write(bb.framing.frame("runtask", pickle.dumps((fn, realtask, taskname, True, self.cooker.collection.get_file_appends(fn), None))))
                 self.rq.fakeworker.stdin.flush()
             else:
-                self.rq.worker.stdin.write("<runtask>" + pickle.dumps((fn, realtask, taskname, True, self.cooker.collection.get_file_appends(fn), None)) + "</runtask>")
+                self.rq.worker.stdin.write(bb.framing.frame("runtask", pickle.dumps((fn, realtask, taskname, True, self.cooker.collection.get_file_appends(fn), None))))
                 self.rq.worker.stdin.flush()
 
             self.runq_running[task] = 1
@@ -2030,6 +2339,12 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
     def runqueue_process_waitpid(self, task, status):
         task = self.rq.rqdata.runq_setscene.index(task)
 
+        if status == 0 and not self.cooker.configuration.dry_run:
+            realtask = self.rqdata.runq_setscene[task]
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[realtask]]
+            taskname = self.rqdata.runq_task[realtask] + "_setscene"
+            self.rq.stampindex.stamp_made(taskname, self.rqdata.dataCache, fn)
+
         RunQueueExecute.runqueue_process_waitpid(self, task, status)
 
 class TaskFailure(Exception):
@@ -2142,7 +2457,7 @@ class runQueuePipe():
         if pipeout:
             pipeout.close()
         bb.utils.nonblockingfd(self.input)
-        self.queue = ""
+        self.queue = bb.framing.FrameReader()
         self.d = d
         self.rq = rq
         self.rqexec = rqexec
@@ -2164,41 +2479,25 @@ class runQueuePipe():
                 bb.error("%s process (%s) exited unexpectedly (%s), shutting down..." % (name, w.pid, str(w.returncode)))
                 self.rq.finish_runqueue(True)
 
-        start = len(self.queue)
-        try:
-            self.queue = self.queue + self.input.read(102400)
-        except (OSError, IOError) as e:
-            if e.errno != errno.EAGAIN:
-                raise
-        end = len(self.queue)
-        found = True
-        while found and len(self.queue):
-            found = False
-            index = self.queue.find("</event>")
-            while index != -1 and self.queue.startswith("<event>"):
+        ret = self.queue.read(self.input)
+        for name, data in self.queue.messages():
+            if name == "event":
                 try:
-                    event = pickle.loads(self.queue[7:index])
+                    event = pickle.loads(data)
                 except ValueError as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[7:index]))
+                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, data))
                 bb.event.fire_from_worker(event, self.d)
-                found = True
-                self.queue = self.queue[index+8:]
-                index = self.queue.find("</event>")
-            index = self.queue.find("</exitcode>")
-            while index != -1 and self.queue.startswith("<exitcode>"):
+            elif name == "exitcode":
                 try:
-                    task, status = pickle.loads(self.queue[10:index])
+                    task, status = pickle.loads(data)
                 except ValueError as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[10:index]))
+                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, data))
                 self.rqexec.runqueue_process_waitpid(task, status)
-                found = True
-                self.queue = self.queue[index+11:]
-                index = self.queue.find("</exitcode>")
-        return (end > start)
+        return ret
 
     def close(self):
         while self.read():
             continue
-        if len(self.queue) > 0:
-            print("Warning, worker left partial message: %s" % self.queue)
+        if self.queue.pending():
+            print("Warning, worker left partial message (%s bytes)" % self.queue.pending())
         self.input.close()
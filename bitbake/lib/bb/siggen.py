@@ -3,7 +3,9 @@ import logging
 import os
 import re
 import tempfile
+from multiprocessing.pool import ThreadPool
 import bb.data
+from bb.cache import MultiProcessCache
 
 logger = logging.getLogger('BitBake.SigGen')
 
@@ -44,6 +46,9 @@ class SignatureGenerator(object):
     def get_taskhash(self, fn, task, deps, dataCache):
         return "0"
 
+    def prepare_taskhashes(self, tasks, dataCache, threads=1):
+        return
+
     def set_taskdata(self, hashes, deps, checksum):
         return
 
@@ -56,6 +61,9 @@ class SignatureGenerator(object):
     def dump_sigtask(self, fn, task, stampbase, runtime):
         return
 
+    def set_basehash_cache(self, cache):
+        return
+
     def invalidate_task(self, task, d, fn):
         bb.build.del_stamp(task, d, fn)
 
@@ -83,6 +91,8 @@ class SignatureGeneratorBasic(SignatureGenerator):
         self.taints = {}
         self.gendeps = {}
         self.lookupcache = {}
+        self.basehashcache = None
+        self.taskhash_inputs = {}
         self.pkgnameextract = re.compile("(?P<fn>.*)\..*")
         self.basewhitelist = set((data.getVar("BB_HASHBASE_WHITELIST", True) or "").split())
         self.taskwhitelist = None
@@ -95,6 +105,14 @@ class SignatureGeneratorBasic(SignatureGenerator):
         else:
             self.twl = None
 
+    def set_basehash_cache(self, cache):
+        """
+        Reuse basehashes from cache where the variables they were worked out
+        from haven't changed. The dependency data dump_sigtask() needs is
+        then not kept so this is only for the parser processes.
+        """
+        self.basehashcache = cache
+
     def _build_data(self, fn, d):
 
         tasklist, gendeps, lookupcache = bb.data.generate_dependencies(d)
@@ -124,12 +142,13 @@ class SignatureGeneratorBasic(SignatureGenerator):
                 newdeps -= seen
 
             alldeps = sorted(seen)
+            h = hashlib.md5(data)
             for dep in alldeps:
-                data = data + dep
+                h.update(dep)
                 var = lookupcache[dep]
                 if var is not None:
-                    data = data + str(var)
-            self.basehash[fn + "." + task] = hashlib.md5(data).hexdigest()
+                    h.update(str(var))
+            self.basehash[fn + "." + task] = h.hexdigest()
             taskdeps[task] = alldeps
 
         self.taskdeps[fn] = taskdeps
@@ -138,13 +157,45 @@ class SignatureGeneratorBasic(SignatureGenerator):
 
         return taskdeps
 
+    def _build_data_cached(self, fn, d):
+        cache = self.basehashcache
+        key = cache.datakey(d, self.basewhitelist)
+        accessed = d.getAccessedVars()
+
+        entry = cache.get(fn, d, key)
+        if entry:
+            varnames, basehashes = entry
+        else:
+            # Work them out in a copy to find which variables were read,
+            # its expansions all being made afresh
+            data = d.createCopy()
+            data.enableAccessTracking()
+            taskdeps = self._build_data(fn, data)
+            varnames = data.getAccessedVars()
+            basehashes = dict((task, self.basehash[fn + "." + task]) for task in taskdeps)
+            # The dependency data isn't needed in the parser processes
+            del self.taskdeps[fn], self.gendeps[fn], self.lookupcache[fn]
+            # As with the recipe cache, those asking not to be cached may
+            # expand differently next time without any variable changing
+            if not data.getVar("__BB_DONT_CACHE", False):
+                cache.store(fn, d, key, varnames, basehashes)
+
+        for task in basehashes:
+            self.basehash[fn + "." + task] = basehashes[task]
+        if accessed is not None:
+            accessed.update(varnames)
+        return basehashes
+
     def finalise(self, fn, d, variant):
 
         if variant:
             fn = "virtual:" + variant + ":" + fn
 
         try:
-            taskdeps = self._build_data(fn, d)
+            if self.basehashcache is not None:
+                taskdeps = self._build_data_cached(fn, d)
+            else:
+                taskdeps = self._build_data(fn, d)
         except:
             bb.note("Error during finalise of %s" % fn)
             raise
@@ -174,6 +225,55 @@ class SignatureGeneratorBasic(SignatureGenerator):
             pass
         return taint
 
+    def prepare_taskhashes(self, tasks, dataCache, threads=1):
+        """
+        Gather what get_taskhash() needs for tasks (a list of (fn, task))
+        that doesn't depend on other tasks' hashes: the file checksums,
+        worked out with up to threads threads, and the taints, found by
+        listing each stamp directory once instead of trying to open a
+        taint file for every task.
+        """
+        jobs = {}
+        fns = set()
+        for fn, task in tasks:
+            if task in dataCache.file_checksums[fn]:
+                job = (dataCache.file_checksums[fn][task], dataCache.pkg_fn[fn])
+                jobs.setdefault(job, []).append(fn + "." + task)
+            fns.add(fn)
+
+        def file_checksums(job):
+            return bb.fetch2.get_file_checksums(*job)
+
+        jobs = jobs.items()
+        if threads > 1 and len(jobs) > 1:
+            # Mostly reading and hashing files which release the GIL
+            pool = ThreadPool(min(threads, len(jobs)))
+            try:
+                results = pool.map(file_checksums, [job for job, _ in jobs])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [file_checksums(job) for job, _ in jobs]
+        checksums = {}
+        for (_, keys), result in zip(jobs, results):
+            for k in keys:
+                checksums[k] = result
+
+        taintfiles = set()
+        for stampdir in set(os.path.dirname(dataCache.stamp[fn]) for fn in fns):
+            try:
+                taintfiles.update(os.path.join(stampdir, f) for f in os.listdir(stampdir) if f.endswith(".taint"))
+            except OSError:
+                pass
+
+        for fn, task in tasks:
+            taint = None
+            if dataCache.stamp[fn] + "." + task + ".taint" in taintfiles:
+                taint = self.read_taint(fn, task, dataCache.stamp[fn])
+            k = fn + "." + task
+            self.taskhash_inputs[k] = (checksums.get(k, []), taint)
+
     def get_taskhash(self, fn, task, deps, dataCache):
         k = fn + "." + task
         data = dataCache.basetaskhash[k]
@@ -181,7 +281,7 @@ class SignatureGeneratorBasic(SignatureGenerator):
         self.file_checksum_values[k] = {}
         recipename = dataCache.pkg_fn[fn]
         for dep in sorted(deps, key=clean_basepath):
-            depname = dataCache.pkg_fn[self.pkgnameextract.search(dep).group('fn')]
+            depname = dataCache.pkg_fn[dep.rsplit(".", 1)[0]]
             if not self.rundep_check(fn, recipename, task, dep, depname, dataCache):
                 continue
             if dep not in self.taskhash:
@@ -189,22 +289,27 @@ class SignatureGeneratorBasic(SignatureGenerator):
             data = data + self.taskhash[dep]
             self.runtaskdeps[k].append(dep)
 
-        if task in dataCache.file_checksums[fn]:
-            checksums = bb.fetch2.get_file_checksums(dataCache.file_checksums[fn][task], recipename)
-            for (f,cs) in checksums:
-                self.file_checksum_values[k][f] = cs
-                if cs:
-                    data = data + cs
+        if k in self.taskhash_inputs:
+            checksums, taint = self.taskhash_inputs.pop(k)
+        else:
+            checksums = []
+            if task in dataCache.file_checksums[fn]:
+                checksums = bb.fetch2.get_file_checksums(dataCache.file_checksums[fn][task], recipename)
+            taint = self.read_taint(fn, task, dataCache.stamp[fn])
+
+        for (f,cs) in checksums:
+            self.file_checksum_values[k][f] = cs
+            if cs:
+                data = data + cs
 
         taskdep = dataCache.task_deps[fn]
         if 'nostamp' in taskdep and task in taskdep['nostamp']:
             # Nostamp tasks need an implicit taint so that they force any dependent tasks to run
             import uuid
-            taint = str(uuid.uuid4())
-            data = data + taint
-            self.taints[k] = "nostamp:" + taint
+            nostamp_taint = str(uuid.uuid4())
+            data = data + nostamp_taint
+            self.taints[k] = "nostamp:" + nostamp_taint
 
-        taint = self.read_taint(fn, task, dataCache.stamp[fn])
         if taint:
             data = data + taint
             self.taints[k] = taint
@@ -280,6 +385,62 @@ class SignatureGeneratorBasic(SignatureGenerator):
                     bb.error("The mismatched hashes were %s and %s" % (dataCache.basetaskhash[k], self.basehash[k]))
                 self.dump_sigtask(fn, task, dataCache.stamp[fn], True)
 
+class BasehashCache(MultiProcessCache):
+    """
+    The basehashes of the tasks of each recipe parsed before, with the
+    variables read working them out and the sum of their digests (see
+    DataSmart.get_var_hash()) so they need only be worked out again when
+    one of those variables changes
+    """
+    cache_file_name = "bb_basehash.dat"
+    CACHE_VERSION = 1
+
+    def datakey(self, d, basewhitelist):
+        """
+        A key for what the basehashes depend on besides the values of the
+        variables read. Whether a function's execs are dependencies depends
+        on which variables exist so that's their names.
+        """
+        h = hashlib.md5()
+        h.update(" ".join(sorted(key for key in d if not key.startswith("__"))))
+        h.update(" ".join(sorted(basewhitelist)))
+        return h.hexdigest()
+
+    def get(self, fn, d, key):
+        entry = self.cachedata[0].get(fn)
+        if not entry or entry[0] != key:
+            return None
+        _, varnames, digest, basehashes = entry
+        if sum(d.get_var_hash(var) for var in varnames) != digest:
+            return None
+        return varnames, basehashes
+
+    @staticmethod
+    def _intern(varnames):
+        # The same names appear in most entries, share them in the file
+        return tuple(intern(var) if type(var) is str else var for var in varnames)
+
+    def store(self, fn, d, key, varnames, basehashes):
+        varnames = self._intern(varnames)
+        digest = sum(d.get_var_hash(var) for var in varnames)
+        self.cachedata_extras[0][fn] = (key, varnames, digest, basehashes)
+
+    def merge_data(self, source, dest):
+        # Replace the entries for older versions of the recipes
+        for fn, (key, varnames, digest, basehashes) in source[0].iteritems():
+            dest[0][fn] = (key, self._intern(varnames), digest, basehashes)
+
+basehashcache = BasehashCache()
+
+def basehash_cache_init(d):
+    basehashcache.init_cache(d)
+
+def basehash_cache_save(d):
+    basehashcache.save_extras(d)
+
+def basehash_cache_savemerge(d):
+    basehashcache.save_merge(d)
+
 class SignatureGeneratorBasicHash(SignatureGeneratorBasic):
     name = "basichash"
 
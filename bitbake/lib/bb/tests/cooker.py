@@ -0,0 +1,202 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for cooker.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import shutil
+import os
+import re
+import bb
+import bb.cache
+import bb.cooker
+import bb.parse
+import bb.siggen
+
+class CollectFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, "cache")
+        for fn in ["layer1/recipes-a/foo/foo_1.0.bb",
+                   "layer1/recipes-a/foo/foo-native_1.0.bb",
+                   "layer1/recipes-b/bar/bar_2.0.bb",
+                   "layer2/recipes-a/foo/foo_1.0.bbappend",
+                   "layer2/recipes-a/foo/foo_%.bbappend",
+                   "layer2/recipes-a/foo/fo%.bbappend",
+                   "layer2/recipes-b/bar/bar_2.%.bbappend",
+                   "layer3/baz/baz.bb"]:
+            self.touch(fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def touch(self, fn):
+        path = os.path.join(self.tempdir, fn)
+        bb.utils.mkdirhier(os.path.dirname(path))
+        open(path, "w").close()
+
+    def collect(self):
+        d = bb.data.init()
+        d.setVar("BBFILES", " ".join([
+            "%s/layer1/recipes-*/*/*.bb" % self.tempdir,
+            "%s/layer2/recipes-*/*/*.bbappend" % self.tempdir,
+            "%s/layer1/recipes-a/*/*.bb" % self.tempdir,
+            "%s/layer3" % self.tempdir]))
+        d.setVar("CACHE", self.cachedir)
+        collection = bb.cooker.CookerCollectFiles([])
+        bbfiles, masked = collection.collect_bbfiles(d, d)
+        return collection, bbfiles
+
+    def linear_appends(self, collection, fn):
+        # The matching rules get_file_appends() implements with its index
+        f = os.path.basename(fn)
+        return [filename for bbappend, filename in collection.bbappends
+                if bbappend == f or ('%' in bbappend and bbappend.startswith(f[:bbappend.index('%')]))]
+
+    def test_collect(self):
+        collection, bbfiles = self.collect()
+        names = [os.path.relpath(fn, self.tempdir) for fn in bbfiles]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(sorted(names), ["layer1/recipes-a/foo/foo-native_1.0.bb",
+                                         "layer1/recipes-a/foo/foo_1.0.bb",
+                                         "layer1/recipes-b/bar/bar_2.0.bb",
+                                         "layer3/baz/baz.bb"])
+        self.assertEqual(len(collection.bbappends), 4)
+
+    def test_file_appends(self):
+        collection, bbfiles = self.collect()
+        for fn in bbfiles + ["/other/fo.bb", "/other/bar_2.1.bb", "/other/bar_3.bb"]:
+            self.assertEqual(collection.get_file_appends(fn), self.linear_appends(collection, fn))
+        appends = [os.path.basename(fn) for fn in collection.get_file_appends("foo_1.0.bb")]
+        self.assertEqual(sorted(appends), ["fo%.bbappend", "foo_%.bbappend", "foo_1.0.bbappend"])
+        appends = [os.path.basename(fn) for fn in collection.get_file_appends("foo-native_1.0.bb")]
+        self.assertEqual(appends, ["fo%.bbappend"])
+
+    def test_snapshot(self):
+        # Just modified directories aren't trusted, make them look older
+        for dirpath, _, _ in os.walk(self.tempdir):
+            os.utime(dirpath, (1000000000, 1000000000))
+        collection, bbfiles = self.collect()
+        snapshot = bb.cache.CollectSnapshotCache(self.cachedir)
+        pattern = "%s/layer1/recipes-*/*/*.bb" % self.tempdir
+        self.assertEqual(sorted(snapshot.lookup(pattern)),
+                         sorted(fn for fn in bbfiles if "/layer1/" in fn))
+
+        # A new recipe changes its directory's mtime
+        self.touch("layer1/recipes-b/bar/bar_3.0.bb")
+        self.assertEqual(snapshot.lookup(pattern), None)
+        collection, bbfiles = self.collect()
+        self.assertIn(os.path.join(self.tempdir, "layer1/recipes-b/bar/bar_3.0.bb"), bbfiles)
+
+class ParseCostTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_save(self):
+        parsecost = bb.cache.ParseCostCache(self.tempdir)
+        parsecost.costs = {"a.bb": 1.0, "b.bb": 2.0}
+        parsecost.save()
+        parsecost = bb.cache.ParseCostCache(self.tempdir)
+        self.assertEqual(parsecost.costs, {"a.bb": 1.0, "b.bb": 2.0})
+        # b.bb is gone
+        parsecost.costs["c.bb"] = 3.0
+        parsecost.save(["a.bb", "c.bb"])
+        self.assertEqual(bb.cache.ParseCostCache(self.tempdir).costs, {"a.bb": 1.0, "c.bb": 3.0})
+        self.assertEqual(os.listdir(self.tempdir), [parsecost.cache_file_name])
+
+class ReparseTest(unittest.TestCase):
+
+    recipe = 'export PATH = "/bin"\nPN = "foo"\nPV = "%s"\nPR = "r0"\ndo_compile() {\n\ttrue\n}\naddtask compile\n'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("BB_SIGNATURE_HANDLER", "basic")
+        self.saved_siggen = getattr(bb.parse, "siggen", None)
+        bb.parse.siggen = bb.siggen.init(self.d)
+        self.fns = []
+        for version in ("1.0", "2.0"):
+            fn = os.path.join(self.tempdir, "foo_%s.bb" % version)
+            with open(fn, "w") as f:
+                f.write(self.recipe % version)
+            self.fns.append(fn)
+
+    def tearDown(self):
+        bb.parse.siggen = self.saved_siggen
+        shutil.rmtree(self.tempdir)
+
+    def parser(self, caches_array):
+        cooker = type("Cooker", (object,), {})()
+        cooker.caches_array = caches_array
+        cooker.recipecache = bb.cache.CacheData(caches_array)
+        cooker.skiplist = {}
+        cooker.collection = bb.cooker.CookerCollectFiles([("layer", self.tempdir, re.compile(self.tempdir), 7)])
+        cooker.collection.get_file_appends = lambda fn: []
+        cooker.add_filewatch = lambda deps: None
+        cooker.add_recipe_filedeps = lambda fn, deps: None
+        cooker.parsecache_valid = True
+        parser = bb.cooker.CookerParser.__new__(bb.cooker.CookerParser)
+        parser.cooker = cooker
+        parser.cfgdata = self.d
+        parser.bb_cache = bb.cache.Cache
+        parser.filelist = self.fns
+        for fn in self.fns:
+            for vfn, info_array in bb.cache.Cache.parse(fn, [], self.d, caches_array):
+                cooker.recipecache.add_from_recipeinfo(vfn, info_array)
+                cooker.recipecache.bbfile_priority[vfn] = 0
+        cooker.recipecache.world_target.add("foo")
+        return parser
+
+    def test_reparse(self):
+        parser = self.parser([bb.cache.CoreRecipeInfo])
+        recipecache = parser.cooker.recipecache
+        with open(self.fns[0], "w") as f:
+            f.write(self.recipe % "1.1")
+        parser.reparse_modified(set([self.fns[0]]))
+        self.assertTrue(parser.cooker.parsecache_valid)
+        self.assertEqual(recipecache.pkg_pepvpr[self.fns[0]], ("", "1.1", "r0"))
+        self.assertEqual(sorted(recipecache.pkg_pn["foo"]), self.fns)
+        self.assertEqual(recipecache.bbfile_priority, {self.fns[0] : 7, self.fns[1] : 0})
+        # Only removing both versions takes foo out of world
+        recipecache.remove_recipeinfo(self.fns[0])
+        self.assertEqual(recipecache.world_target, set(["foo"]))
+        recipecache.remove_recipeinfo(self.fns[1])
+        self.assertEqual(recipecache.world_target, set())
+
+    def test_reparse_unsupported(self):
+        class ExtraRecipeInfo(bb.cache.RecipeInfoCommon):
+            def __init__(self, filename, metadata):
+                pass
+            def add_cacheData(self, cachedata, fn):
+                pass
+            @classmethod
+            def init_cacheData(cls, cachedata):
+                pass
+        parser = self.parser([bb.cache.CoreRecipeInfo, ExtraRecipeInfo])
+        recipecache = parser.cooker.recipecache
+        self.assertFalse(recipecache.supports_reparse())
+        parser.reparse_modified(set([self.fns[0]]))
+        self.assertFalse(parser.cooker.parsecache_valid)
+        # Left for the full parse as it was
+        self.assertEqual(recipecache.pkg_pepvpr[self.fns[0]], ("", "1.0", "r0"))
+        self.assertEqual(sorted(recipecache.pkg_pn["foo"]), self.fns)
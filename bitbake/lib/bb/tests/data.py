@@ -20,7 +20,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import gc
 import unittest
+import weakref
 import bb
 import bb.data
 import bb.parse
@@ -219,6 +221,163 @@ class TestMemoize(unittest.TestCase):
         self.assertEqual(d.getVar("foo", False),
                          d.getVar("bar", False))
 
+class TestExpandCache(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "foo")
+        self.d.setVar("BAR", "${FOO} bar")
+        self.d.setVar("BAZ", "${BAR} baz")
+        self.d.setVar("OTHER", "other")
+        self.assertEqual(self.d.getVar("BAZ", True), "foo bar baz")
+        self.assertEqual(self.d.getVar("OTHER", True), "other")
+
+    def test_unrelated_write(self):
+        self.d.setVar("UNRELATED", "${OTHER}")
+        self.assertTrue("BAZ" in self.d.expand_cache)
+        self.assertTrue("OTHER" in self.d.expand_cache)
+
+    def test_dependent_write(self):
+        self.d.setVar("FOO", "value")
+        self.assertFalse("BAZ" in self.d.expand_cache)
+        self.assertTrue("OTHER" in self.d.expand_cache)
+        self.assertEqual(self.d.getVar("BAZ", True), "value bar baz")
+
+    def test_append(self):
+        self.d.setVar("FOO_append", " appended")
+        self.assertEqual(self.d.getVar("BAZ", True), "foo appended bar baz")
+        self.d.delVarFlag("FOO", "_append")
+        self.assertEqual(self.d.getVar("BAZ", True), "foo bar baz")
+
+    def test_remove(self):
+        self.d.setVar("BAR_remove", "${OTHER}")
+        self.d.setVar("BAR_append", " other")
+        self.assertEqual(self.d.getVar("BAZ", True), "foo bar baz")
+        self.d.setVar("OTHER", "bar")
+        self.assertEqual(self.d.getVar("BAZ", True), "foo other baz")
+
+    def test_override(self):
+        self.d.setVar("OVERRIDES", "foo")
+        self.d.setVar("FOO_foo", "overridden")
+        self.assertEqual(self.d.getVar("BAZ", True), "overridden bar baz")
+        self.d.setVar("OVERRIDES", "")
+        self.assertEqual(self.d.getVar("BAZ", True), "foo bar baz")
+
+    def test_flag(self):
+        self.d.setVarFlag("OTHER", "flag", "${FOO}")
+        self.assertEqual(self.d.getVarFlag("OTHER", "flag", True), "foo")
+        self.d.setVar("FOO", "value")
+        self.assertEqual(self.d.getVarFlag("OTHER", "flag", True), "value")
+        self.d.setVarFlag("OTHER", "flag", "${BAR}")
+        self.assertEqual(self.d.getVarFlag("OTHER", "flag", True), "value bar")
+
+    def test_python(self):
+        self.d.setVar("PY", "${@d.getVar('F' + 'OO', True)} ${BAR}")
+        self.assertEqual(self.d.getVar("PY", True), "foo foo bar")
+        self.d.setVar("FOO", "value")
+        self.assertEqual(self.d.getVar("PY", True), "value value bar")
+        self.d.setVar("UNRELATED", "unrelated")
+        self.assertTrue("PY" in self.d.expand_cache)
+
+    def test_volatile(self):
+        self.d.setVar("TIME", "${@__import__('time').time()} ${BAR}")
+        self.d.setVar("LATER", "${TIME}")
+        self.d.getVar("LATER", True)
+        self.d.setVar("UNRELATED", "unrelated")
+        self.assertFalse("TIME" in self.d.expand_cache)
+        self.assertFalse("LATER" in self.d.expand_cache)
+
+    def test_volatile_lookup(self):
+        # Looking up variables doesn't make python depend only on them
+        self.d.setVar("EXISTS", "${@os.path.exists(d.getVar('FOO', True))}")
+        self.assertEqual(self.d.getVar("EXISTS", True), "False")
+        self.d.setVar("UNRELATED", "unrelated")
+        self.assertFalse("EXISTS" in self.d.expand_cache)
+
+    def test_pure_python(self):
+        self.d.setVar("PY", "${@' '.join(sorted(x.upper() for x in BAR.split()))}")
+        self.assertEqual(self.d.getVar("PY", True), "BAR FOO")
+        self.d.setVar("UNRELATED", "unrelated")
+        self.assertTrue("PY" in self.d.expand_cache)
+
+    def test_inactive_override(self):
+        self.d.setVar("OVERRIDES", "foo")
+        self.d.setVar("FOO_other", "other")
+        self.assertEqual(self.d.getVar("BAZ", True), "foo bar baz")
+        self.d.setVar("FOO_other", "changed")
+        self.d.setVar("FOO_bar_foo", "other")
+        self.assertTrue("BAZ" in self.d.expand_cache)
+        self.d.setVar("FOO_other_foo_append", " other")
+        self.assertTrue("BAZ" in self.d.expand_cache)
+
+    def test_override_append(self):
+        self.d.setVar("OVERRIDES", "foo:bar")
+        self.d.setVar("FOO_bar", "bar")
+        self.assertEqual(self.d.getVar("BAZ", True), "bar bar baz")
+        self.d.setVar("FOO_bar_append", " appended")
+        self.assertEqual(self.d.getVar("BAZ", True), "bar appended bar baz")
+        self.d.setVar("FOO_foo_bar", "both")
+        self.assertEqual(self.d.getVar("BAZ", True), "both bar baz")
+
+class TestCreateCopy(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "foo")
+        self.d.setVarFlag("FOO", "flag", "flag")
+        self.d.setVar("BAR", "bar")
+        self.copies = [self.d]
+        for i in range(3):
+            self.copies.append(self.copies[-1].createCopy())
+
+    def test_write_copy(self):
+        d = self.copies[-1]
+        d.setVarFlag("FOO", "flag", "copy")
+        d.setVar("NEW", "new")
+        self.assertEqual(d.getVarFlag("FOO", "flag"), "copy")
+        self.assertEqual(d.getVar("FOO", False), "foo")
+        for parent in self.copies[:-1]:
+            self.assertEqual(parent.getVarFlag("FOO", "flag"), "flag")
+            self.assertEqual(parent.getVar("NEW", False), None)
+
+    def test_write_parent(self):
+        self.copies[2].setVar("BAR", "copy")
+        self.d.setVar("FOO", "parent")
+        self.d.setVar("BAR", "parent")
+        self.d.setVar("NEW", "new")
+        for d in self.copies:
+            self.assertEqual(d.getVar("FOO", False), "parent")
+            self.assertEqual(d.getVar("NEW", False), "new")
+        self.assertEqual(self.copies[1].getVar("BAR", False), "parent")
+        self.assertEqual(self.copies[3].getVar("BAR", False), "copy")
+
+    def test_delete(self):
+        self.copies[1].delVar("FOO")
+        self.assertEqual(self.d.getVar("FOO", False), "foo")
+        for d in self.copies[1:]:
+            self.assertEqual(d.getVar("FOO", False), None)
+            self.assertFalse("FOO" in d.keys())
+        self.copies[2].setVar("BAR", "copy")
+        self.copies[2].delVarFlags("BAR")
+        self.assertEqual(self.copies[3].getVar("BAR", False), "copy")
+        self.copies[2].setVarFlag("BAZ", "flag", "flag")
+        self.copies[2].delVarFlags("BAZ")
+        self.assertFalse("BAZ" in self.copies[3].keys())
+        self.assertEqual(list(self.copies[2].localkeys()), ["BAR"])
+
+    def test_freed(self):
+        # Parents update their copies on writes until the copies are gone,
+        # which mustn't need the cyclic collector to run
+        self.d.setVar("BAZ", "${FOO} ${@d.getVar('BAR', True)}")
+        gc.disable()
+        try:
+            d = self.d.createCopy()
+            self.assertEqual(d.getVar("BAZ", True), "foo bar")
+            self.assertEqual(d.getVarFlag("FOO", "flag", True), "flag")
+            ref = weakref.ref(d)
+            del d
+            self.assertEqual(ref(), None)
+        finally:
+            gc.enable()
+
 class TestConcat(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -372,6 +531,31 @@ class TestOverrides(unittest.TestCase):
         self.d.setVar("OVERRIDES", "foo:bar:some_val")
         self.assertEqual(self.d.getVar("TEST", True), "testvalue3")
 
+    def test_override_after_resolved(self):
+        self.d.setVar("TEST_foo", "testvalue2")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue2")
+        self.d.setVar("TEST_local", "testvalue3")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue3")
+        self.d.delVar("TEST_local")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue2")
+
+    def test_overrides_changed(self):
+        self.d.setVar("TEST_foo", "testvalue2")
+        self.d.setVar("TEST_append_bar", " append")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue2 append")
+        self.d.setVar("OVERRIDES", "bar")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue append")
+        self.d.setVar("OVERRIDES", "foo")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue2")
+
+    def test_override_in_copy(self):
+        self.d.setVar("TEST_foo", "testvalue2")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue2")
+        d2 = self.d.createCopy()
+        d2.setVar("TEST_bar", "testvalue3")
+        self.assertEqual(d2.getVar("TEST", True), "testvalue3")
+        self.assertEqual(self.d.getVar("TEST", True), "testvalue2")
+
 class TestKeyExpansion(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
@@ -402,6 +586,115 @@ class TestFlags(unittest.TestCase):
         self.assertEqual(self.d.getVarFlag("foo", "flag1"), "value of flag1")
         self.assertEqual(self.d.getVarFlag("foo", "flag2"), None)
 
+    def test_export_copy(self):
+        self.d.setVarFlag("foo", "export", "1")
+        d = self.d.createCopy()
+        d.setVarFlag("bar", "export", "1")
+        self.assertEqual(d.getVar("__exportlist", False), set(["foo", "bar"]))
+        self.assertEqual(self.d.getVar("__exportlist", False), set(["foo"]))
+
+class TestHash(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "foo")
+        self.d.setVarFlag("FOO", "flag", "value")
+        self.d.setVar("BAR", "bar")
+        self.d.setVar("BB_HASHCONFIG_WHITELIST", "DATE")
+
+    def test_changes(self):
+        h = self.d.get_hash()
+        self.d.setVar("FOO", "changed")
+        self.assertNotEqual(self.d.get_hash(), h)
+        self.d.setVar("FOO", "foo")
+        self.assertEqual(self.d.get_hash(), h)
+        self.d.setVarFlag("FOO", "flag", "changed")
+        self.assertNotEqual(self.d.get_hash(), h)
+        self.d.delVarFlag("FOO", "flag")
+        self.assertNotEqual(self.d.get_hash(), h)
+
+    def test_add_delete(self):
+        h = self.d.get_hash()
+        self.d.setVar("BAZ_append", " baz")
+        self.assertNotEqual(self.d.get_hash(), h)
+        self.d.delVar("BAZ")
+        self.assertEqual(self.d.get_hash(), h)
+
+    def test_whitelist(self):
+        h = self.d.get_hash()
+        self.d.setVar("DATE", "20160101")
+        self.assertEqual(self.d.get_hash(), h)
+
+    def test_order(self):
+        d = bb.data.init()
+        d.setVar("BB_HASHCONFIG_WHITELIST", "DATE")
+        d.setVar("BAR", "bar")
+        d.setVarFlag("FOO", "flag", "value")
+        d.setVar("FOO", "foo")
+        self.assertEqual(d.get_hash(), self.d.get_hash())
+
+    def test_copy(self):
+        h = self.d.get_hash()
+        d = self.d.createCopy()
+        self.assertEqual(d.get_hash(), h)
+        self.d.setVar("BAR", "changed")
+        self.assertNotEqual(d.get_hash(), h)
+        self.assertEqual(d.get_hash(), self.d.get_hash())
+
+    def test_var_hash(self):
+        h = self.d.get_var_hash("BAR")
+        self.assertEqual(self.d.get_var_hash("UNSET"), 0)
+        d = self.d.createCopy()
+        d.setVarFlag("BAR", "doc", "a flag")
+        self.assertNotEqual(d.get_var_hash("BAR"), h)
+        self.assertEqual(self.d.get_var_hash("BAR"), h)
+        d.delVarFlag("BAR", "doc")
+        self.assertEqual(d.get_var_hash("BAR"), h)
+
+    def test_var_hash_set(self):
+        # The same set iterating in a different order
+        names = ["V%d" % i for i in range(20)]
+        others = set("X%d" % i for i in range(200))
+        self.d.setVar("__exportlist", set(names))
+        d = bb.data.init()
+        d.setVar("__exportlist", (set(names) | others) - others)
+        self.assertEqual(d.get_var_hash("__exportlist"), self.d.get_var_hash("__exportlist"))
+
+class TestAccessTracking(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "foo")
+        self.d.setVar("BAR", "${FOO} bar")
+        self.d.setVar("UNUSED", "unused")
+
+    def test_tracking(self):
+        d2 = self.d.createCopy()
+        d2.enableAccessTracking()
+        d3 = d2.createCopy()
+        self.assertEqual(d3.getVar("BAR", True), "foo bar")
+        self.assertEqual(d2.getAccessedVars(), set(["BAR", "FOO"]))
+        self.assertEqual(self.d.getAccessedVars(), None)
+
+    def test_configsig(self):
+        import bb.cache
+        sig = bb.cache.ConfigSignature(self.d)
+        d2 = self.d.createCopy()
+        d2.enableAccessTracking()
+        d2.getVar("BAR", True)
+        mask = sig.mask(d2.getAccessedVars())
+        record = sig.record()
+
+        self.d.setVar("UNUSED", "changed")
+        changed = bb.cache.ConfigSignature(self.d).changed(record)
+        self.assertTrue(changed)
+        self.assertFalse(mask & changed)
+
+        self.d.setVar("FOO_append", " more")
+        changed = bb.cache.ConfigSignature(self.d).changed(record)
+        self.assertTrue(mask & changed)
+
+        self.d.setVar("NEWVAR", "new")
+        self.assertEqual(bb.cache.ConfigSignature(self.d).changed(record), None)
+
 
 class Contains(unittest.TestCase):
     def setUp(self):
@@ -312,6 +312,63 @@ class URITest(unittest.TestCase):
             self.assertEqual(uri.params, {})
             self.assertEqual(str(uri), (str(uri).split(";"))[0])
 
+class HTTPServer(object):
+    """
+    Serves the files in a directory over HTTP on localhost from a thread,
+    slowly enough that concurrent requests overlap, counting the requests
+    made and the most handled at once
+    """
+    def __init__(self, rootdir, delay=0.2):
+        import BaseHTTPServer, SocketServer, SimpleHTTPServer, threading, time
+
+        server = self
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(rootdir, path.split("?")[0].lstrip("/"))
+
+            def handle_request(self, method):
+                with server.lock:
+                    server.requests.append(self.path)
+                    server.active += 1
+                    server.maxactive = max(server.maxactive, server.active)
+                try:
+                    time.sleep(server.delay)
+                    method(self)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+            def do_GET(self):
+                self.handle_request(SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET)
+
+            def do_HEAD(self):
+                self.handle_request(SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = []
+        self.active = 0
+        self.maxactive = 0
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path, host="127.0.0.1"):
+        return "http://%s:%s/%s" % (host, self.port, path)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
 class FetcherTest(unittest.TestCase):
 
     def setUp(self):
@@ -477,6 +534,198 @@ class FetcherLocalTest(FetcherTest):
         tree = self.fetchUnpack(['file://dir/subdir/e;subdir=bar'])
         self.assertEqual(tree, ['bar/dir/subdir/e'])
 
+class FetcherConcurrentTest(FetcherTest):
+
+    def setUp(self):
+        FetcherTest.setUp(self)
+        self.srcdir = os.path.join(self.tempdir, "served")
+        os.mkdir(self.srcdir)
+        self.sha256 = {}
+        for i in range(6):
+            name = "file%d.tar" % i
+            with open(os.path.join(self.srcdir, name), "w") as f:
+                f.write(name * 1000)
+            self.sha256[name] = bb.utils.sha256_file(os.path.join(self.srcdir, name))
+        self.server = HTTPServer(self.srcdir)
+        self.d.setVar("FETCHCMD_wget", "/usr/bin/env wget -t 1 -T 30 -nv --no-proxy")
+        self.d.setVar("BB_FETCH_THREADS", "4")
+
+    def tearDown(self):
+        self.server.stop()
+        FetcherTest.tearDown(self)
+
+    def urls(self, count, hosts=["127.0.0.1"]):
+        urls = []
+        for i in range(count):
+            name = "file%d.tar" % i
+            urls.append(self.server.url(name, hosts[i % len(hosts)]) + ";name=%s" % i)
+            self.d.setVarFlag("SRC_URI", "%s.sha256sum" % i, self.sha256[name])
+        return urls
+
+    def assertDownloaded(self, count):
+        for i in range(count):
+            name = "file%d.tar" % i
+            self.assertEqual(bb.utils.sha256_file(os.path.join(self.dldir, name)), self.sha256[name])
+            self.assertTrue(os.path.exists(os.path.join(self.dldir, name + ".done")))
+
+    def test_concurrent(self):
+        self.d.setVar("BB_FETCH_THREADS_PER_HOST", "4")
+        fetcher = bb.fetch2.Fetch(self.urls(4), self.d)
+        fetcher.download()
+        self.assertDownloaded(4)
+        self.assertTrue(self.server.maxactive > 1)
+        self.assertEqual(fetcher.download_slots, None)
+
+        # Already downloaded
+        fetcher = bb.fetch2.Fetch(self.urls(4), self.d)
+        fetcher.download()
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_per_host_limit(self):
+        self.d.setVar("BB_FETCH_THREADS_PER_HOST", "1")
+        fetcher = bb.fetch2.Fetch(self.urls(4), self.d)
+        fetcher.download()
+        self.assertDownloaded(4)
+        self.assertEqual(self.server.maxactive, 1)
+
+        # The limit is per host, counting localhost as another one
+        for name in os.listdir(self.dldir):
+            os.unlink(os.path.join(self.dldir, name))
+        self.server.maxactive = 0
+        fetcher = bb.fetch2.Fetch(self.urls(4, ["127.0.0.1", "localhost"]), self.d)
+        fetcher.download()
+        self.assertDownloaded(4)
+        self.assertEqual(self.server.maxactive, 2)
+
+    def test_failures(self):
+        urls = self.urls(4)
+        self.d.setVarFlag("SRC_URI", "1.sha256sum", "0" * 64)
+        fetcher = bb.fetch2.Fetch(urls + [self.server.url("missing.tar")], self.d)
+        with self.assertRaises(bb.fetch2.FetchError):
+            fetcher.download()
+        self.assertEqual(fetcher.download_slots, None)
+        # The others were still downloaded and verified
+        for i in [0, 2, 3]:
+            self.assertTrue(os.path.exists(os.path.join(self.dldir, "file%d.tar.done" % i)))
+        self.assertFalse(os.path.exists(os.path.join(self.dldir, "file1.tar.done")))
+
+    def test_mirrors(self):
+        self.d.setVar("PREMIRRORS", "http://invalid.yoctoproject.org/.* %s" % self.server.url(""))
+        urls = ["http://invalid.yoctoproject.org/file0.tar;name=0", self.urls(2)[1]]
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        self.assertTrue(fetcher.supports_concurrency(fetcher.ud[urls[0]]))
+        fetcher.download()
+        self.assertDownloaded(2)
+
+        # A git mirror has to be tried serially
+        self.d.setVar("PREMIRRORS", "http://invalid.yoctoproject.org/.* git://invalid.yoctoproject.org/foo.git")
+        self.d.setVar("SRCREV", "0" * 40)
+        fetcher = bb.fetch2.Fetch(urls, self.d)
+        self.assertFalse(fetcher.supports_concurrency(fetcher.ud[urls[0]]))
+
+class MirrorHealthTest(FetcherTest):
+
+    def setUp(self):
+        FetcherTest.setUp(self)
+        self.gooddir = os.path.join(self.tempdir, "good")
+        os.mkdir(self.gooddir)
+        for name in ["a.tar", "b.tar", "c.tar"]:
+            with open(os.path.join(self.gooddir, name), "w") as f:
+                f.write(name)
+        self.good = HTTPServer(self.gooddir, delay=0)
+        self.bad = HTTPServer(self.tempdir, delay=0)
+        self.d.setVar("FETCHCMD_wget", "/usr/bin/env wget -t 1 -T 30 -nv --no-proxy")
+        self.d.setVar("BB_MIRROR_HEALTH", "1")
+        # Nothing listens upstream
+        import socket
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.upstream = "http://127.0.0.1:%s" % sock.getsockname()[1]
+        sock.close()
+
+    def tearDown(self):
+        self.good.stop()
+        self.bad.stop()
+        FetcherTest.tearDown(self)
+
+    def fetch(self, name, check=False):
+        fetcher = bb.fetch2.Fetch(["%s/%s" % (self.upstream, name)], self.d)
+        if check:
+            fetcher.checkstatus()
+        else:
+            fetcher.download()
+        return fetcher
+
+    def health(self, server, host="127.0.0.1"):
+        url = server.url("", host)
+        fetcher = bb.fetch2.Fetch([url], self.d)
+        return bb.fetch2.MirrorHealth(self.d).get(fetcher.ud[url])
+
+    def test_failing_mirror_tried_last(self):
+        self.d.setVar("PREMIRRORS", "http://.*/.* %s \n http://.*/.* %s" % (self.bad.url(""), self.good.url("")))
+        self.fetch("a.tar")
+        self.assertEqual(len(self.bad.requests), 1)
+        self.assertEqual(self.health(self.bad)[:3], (0, 1, 1))
+        self.assertEqual(self.health(self.good)[:3], (1, 0, 0))
+
+        self.fetch("b.tar")
+        self.assertEqual(len(self.bad.requests), 1)
+        self.assertEqual(len(self.good.requests), 2)
+
+        # Without the history the configured order is used
+        self.d.setVar("BB_MIRROR_HEALTH", "0")
+        self.fetch("c.tar")
+        self.assertEqual(len(self.bad.requests), 2)
+
+    def test_circuit_breaker(self):
+        self.d.setVar("PREMIRRORS", "http://.*/.* %s" % self.bad.url(""))
+        self.d.setVar("MIRRORS", "http://.*/.* %s" % self.good.url(""))
+        self.d.setVar("BB_MIRROR_FAILURE_LIMIT", "2")
+        for name in ["a.tar", "b.tar", "c.tar"]:
+            self.fetch(name)
+        # Upstream is down so each fetch went to MIRRORS, the failing
+        # premirror being skipped once it had failed twice
+        self.assertEqual(len(self.bad.requests), 2)
+        self.assertEqual(len(self.good.requests), 3)
+
+        self.d.setVar("BB_MIRROR_RETRY_INTERVAL", "0")
+        os.unlink(os.path.join(self.dldir, "c.tar"))
+        os.unlink(os.path.join(self.dldir, "c.tar.done"))
+        self.fetch("c.tar")
+        self.assertEqual(len(self.bad.requests), 3)
+
+    def test_race_checkstatus(self):
+        self.bad.stop()
+        self.bad = HTTPServer(self.gooddir, delay=0.5)
+        self.d.setVar("PREMIRRORS", "http://.*/.* %s \n http://.*/.* %s" % (self.bad.url(""), self.good.url("", "localhost")))
+        self.d.setVar("BB_MIRROR_RACE", "1")
+        self.fetch("a.tar", check=True)
+        # Both mirrors were asked once and the slower one waited for
+        self.assertEqual(len(self.bad.requests), 1)
+        self.assertEqual(len(self.good.requests), 1)
+        self.assertEqual(self.health(self.bad)[:3], (1, 0, 0))
+        self.assertEqual(self.health(self.good, "localhost")[:3], (1, 0, 0))
+
+    def test_race_checkstatus_error(self):
+        self.d.setVar("PREMIRRORS", "http://.*/.* %s \n http://.*/.* %s" % (self.bad.url(""), self.good.url("", "localhost")))
+        self.d.setVar("BB_MIRROR_RACE", "1")
+        checkstatus = bb.fetch2.wget.Wget.checkstatus
+        def failing_checkstatus(method, fetch, ud, d):
+            if ud.host.startswith("127.0.0.1"):
+                raise bb.fetch2.NetworkAccess(ud.url, "checkstatus")
+            return checkstatus(method, fetch, ud, d)
+        bb.fetch2.wget.Wget.checkstatus = failing_checkstatus
+        try:
+            # The other mirror has it so the error doesn't matter
+            self.fetch("a.tar", check=True)
+            self.assertEqual(len(self.good.requests), 1)
+            self.good.stop()
+            self.good = HTTPServer(self.tempdir, delay=0)
+            self.d.setVar("PREMIRRORS", "http://.*/.* %s \n http://.*/.* %s" % (self.bad.url(""), self.good.url("", "localhost")))
+            self.assertRaises(bb.fetch2.NetworkAccess, self.fetch, "a.tar", True)
+        finally:
+            bb.fetch2.wget.Wget.checkstatus = checkstatus
+
 class FetcherNetworkTest(FetcherTest):
 
     if os.environ.get("BB_SKIP_NETTESTS") == "yes":
@@ -0,0 +1,77 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for framing.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import os
+import bb
+import bb.framing
+import bb.utils
+
+class FramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [("event", "x" * 100), ("exitcode", ""), ("quit", ""),
+                         ("runtask", "<runtask>" + "\0\xff" * 50000 + "</event>")]
+        self.data = "".join(bb.framing.frame(name, payload) for name, payload in self.messages)
+
+    def test_whole(self):
+        reader = bb.framing.FrameReader()
+        reader.feed(self.data)
+        self.assertEqual(reader.messages(), self.messages)
+        self.assertEqual(reader.pending(), 0)
+        self.assertEqual(reader.messages(), [])
+
+    def test_split(self):
+        # Data arriving a few bytes at a time, messages must come out whole
+        for chunksize in [1, 3, 7, 4096]:
+            reader = bb.framing.FrameReader()
+            received = []
+            for i in xrange(0, len(self.data), chunksize):
+                reader.feed(self.data[i:i + chunksize])
+                received.extend(reader.messages())
+            self.assertEqual(received, self.messages)
+            self.assertEqual(reader.pending(), 0)
+
+    def test_frames(self):
+        reader = bb.framing.FrameReader()
+        reader.feed(self.data[:-10])
+        forwarded = reader.frames()
+        self.assertEqual(forwarded, self.data[:len(forwarded)])
+        self.assertEqual(reader.pending(), len(self.data) - 10 - len(forwarded))
+        reader.feed(self.data[-10:])
+        forwarded += reader.frames()
+        self.assertEqual(forwarded, self.data)
+
+    def test_pipe(self):
+        pipein, pipeout = os.pipe()
+        pipein = os.fdopen(pipein, 'rb')
+        bb.utils.nonblockingfd(pipein)
+        bb.utils.nonblockingfd(pipeout)
+        writer = bb.framing.FrameWriter(pipeout)
+        reader = bb.framing.FrameReader()
+        received = []
+        for _ in xrange(20):
+            writer.queue(self.data)
+        while len(writer) or reader.pending() or len(received) < 20 * len(self.messages):
+            writer.flush()
+            while reader.read(pipein):
+                received.extend(reader.messages())
+        self.assertEqual(received, self.messages * 20)
+        pipein.close()
+        os.close(pipeout)
@@ -145,3 +145,50 @@ python () {
         self.assertEqual(d1.getVar("VAR_var", True), "B")
         self.assertEqual(d2.getVar("VAR_var", True), None)
 
+
+class BasehashCacheTest(unittest.TestCase):
+
+    recipe = """
+export PATH = "/bin"
+A = "1"
+B = "2"
+do_compile() {
+	echo ${A}
+}
+addtask compile
+"""
+
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("BB_SIGNATURE_HANDLER", "basic")
+        self.f = tempfile.NamedTemporaryFile(suffix = ".bb")
+        os.chdir(os.path.dirname(self.f.name))
+
+    def parse(self, content, cache=None):
+        self.f.seek(0)
+        self.f.truncate()
+        self.f.write(content)
+        self.f.flush()
+        bb.parse.siggen = bb.siggen.init(self.d)
+        if cache:
+            bb.parse.siggen.set_basehash_cache(cache)
+        d = bb.parse.handle(self.f.name, self.d)['']
+        return d.getVar("BB_BASEHASH_task-do_compile", True)
+
+    def test_basehash_cache(self):
+        cache = bb.siggen.BasehashCache()
+        basehash = self.parse(self.recipe)
+        self.assertEqual(self.parse(self.recipe, cache), basehash)
+        cache.merge_data(cache.cachedata_extras, cache.cachedata)
+        # Poison the entry to tell a hit from a miss
+        key, varnames, digest, _ = cache.cachedata[0][self.f.name]
+        self.assertIn("A", varnames)
+        self.assertNotIn("B", varnames)
+        cache.cachedata[0][self.f.name] = (key, varnames, digest, {"do_compile" : "poisoned"})
+        self.assertEqual(self.parse(self.recipe, cache), "poisoned")
+        # Changing a variable the task doesn't read still hits
+        self.assertEqual(self.parse(self.recipe.replace('B = "2"', 'B = "3"'), cache), "poisoned")
+        # Changing one it does read doesn't
+        changed = self.recipe.replace('A = "1"', 'A = "3"')
+        self.assertEqual(self.parse(changed, cache), self.parse(changed))
+        self.assertNotEqual(self.parse(changed), basehash)
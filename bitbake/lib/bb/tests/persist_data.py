@@ -0,0 +1,131 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for persist_data.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import bb
+import bb.data
+import bb.persist_data
+import bb.utils
+
+def hammer(args):
+    """
+    Read and write the BB_TEST domain as a parser or worker would, with
+    its own keys and some keys shared with the other processes
+    """
+    persistdir, worker, count = args
+    d = bb.data.init()
+    d.setVar("PERSISTENT_DIR", persistdir)
+    for i in range(count):
+        table = bb.persist_data.persist("BB_TEST", d)
+        key = "worker%d-%d" % (worker, i)
+        table[key] = str(i)
+        if table[key] != str(i):
+            return "%s read back as %s" % (key, table[key])
+        table["shared-%d" % (i % 10)] = "%d-%d" % (worker, i)
+        if "shared-%d" % (i % 10) not in table:
+            return "shared-%d missing" % (i % 10)
+        if i % 10 == 0:
+            with table:
+                for j in range(10):
+                    table["batch%d-%d" % (worker, j)] = str(i)
+        table.get_by_pattern("worker%d-%%" % worker)
+    return None
+
+class PersistDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.persistdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("PERSISTENT_DIR", self.persistdir)
+        self.dbfile = os.path.join(self.persistdir, "bb_persist_data.sqlite3")
+
+    def tearDown(self):
+        bb.utils.prunedir(self.persistdir)
+
+    def test_table(self):
+        table = bb.persist_data.persist("BB_TEST", self.d)
+        table["a"] = "1"
+        table["b"] = "2"
+        table["a"] = "3"
+        self.assertEqual(table["a"], "3")
+        self.assertEqual(len(table), 2)
+        self.assertTrue("b" in table)
+        self.assertFalse("c" in table)
+        self.assertEqual(sorted(table.items()), [("a", "3"), ("b", "2")])
+        del table["b"]
+        self.assertRaises(KeyError, table.__delitem__, "b")
+        self.assertRaises(KeyError, table.__getitem__, "b")
+        self.assertRaises(TypeError, table.__setitem__, "c", 1)
+
+        connection = sqlite3.connect(self.dbfile)
+        self.assertEqual(connection.execute("pragma journal_mode;").fetchone()[0], "wal")
+
+    def test_transaction(self):
+        table = bb.persist_data.persist("BB_TEST", self.d)
+        other = bb.persist_data.persist("BB_TEST", self.d)
+        with table:
+            table["a"] = "1"
+            with table:
+                table["b"] = "2"
+            self.assertFalse("a" in other)
+        self.assertEqual(other["b"], "2")
+
+        try:
+            with table:
+                table["a"] = "changed"
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(other["a"], "1")
+
+        table.update({"c" : "3"}, d="4")
+        self.assertEqual(sorted(other.items()), [("a", "1"), ("b", "2"), ("c", "3"), ("d", "4")])
+
+    def test_migrate(self):
+        connection = sqlite3.connect(self.dbfile)
+        connection.execute("CREATE TABLE BB_TEST(key TEXT, value TEXT);")
+        connection.executemany("INSERT INTO BB_TEST(key, value) VALUES (?, ?);",
+                               [("a", "1"), ("b", "2"), ("a", "3")])
+        connection.commit()
+        connection.close()
+
+        table = bb.persist_data.persist("BB_TEST", self.d)
+        self.assertTrue(table._keyed())
+        self.assertEqual(sorted(table.items()), [("a", "3"), ("b", "2")])
+        table["b"] = "4"
+        self.assertEqual(len(table), 2)
+
+    def test_concurrent(self):
+        pool = multiprocessing.Pool(8)
+        try:
+            errors = pool.map(hammer, [(self.persistdir, worker, 100) for worker in range(16)])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual([error for error in errors if error], [])
+
+        table = bb.persist_data.persist("BB_TEST", self.d)
+        self.assertEqual(len(table), 16 * 100 + 10 + 16 * 10)
+        for worker in range(16):
+            self.assertEqual(table["worker%d-99" % worker], "99")
+            self.assertEqual(table["batch%d-9" % worker], "90")
@@ -0,0 +1,207 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the PR server
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import
+import unittest
+import os
+import sqlite3
+import tempfile
+import threading
+import bb.utils
+import prserv
+import prserv.db
+import prserv.serv
+
+class PRTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tempdir, "prserv.sqlite3")
+
+    def tearDown(self):
+        bb.utils.prunedir(self.tempdir)
+
+    def open(self, **kwargs):
+        db = prserv.db.PRData(self.dbfile, **kwargs)
+        self.addCleanup(db.disconnect)
+        return db["PRMAIN"]
+
+    def test_read_unlocked(self):
+        table = self.open()
+        self.assertEqual(table.getValue("1.0-r0", "arm", "a"), 0)
+        table.sync_if_dirty()
+        self.assertEqual(table.getValue("1.0-r0", "arm", "a"), 0)
+        self.assertFalse(table.dirty)
+
+        # Only reading, the table shouldn't keep others from writing
+        conn = sqlite3.connect(self.dbfile, timeout=0)
+        conn.execute("INSERT INTO PRMAIN_nohist VALUES ('2.0-r0', 'arm', 'a', 0);")
+        conn.commit()
+        conn.close()
+
+    def test_failed_write(self):
+        # Two requests' writes awaiting the PR server's group commit,
+        # with bad ones from others in between
+        table = self.open()
+        self.assertEqual(table.getValue("1.0-r0", "arm", "a"), 0)
+        self.assertRaises(prserv.NotFoundError, table.getValue, "1.0-r0", None, "b")
+        self.assertEqual(table.importone(None, "arm", "b", 3), None)
+        self.assertRaises(prserv.NotFoundError, table._getValueNohist, "1.0-r0", None, "b")
+        self.assertEqual(table.getValue("2.0-r0", "arm", "a"), 0)
+        table.sync_if_dirty()
+
+        conn = sqlite3.connect(self.dbfile)
+        rows = conn.execute("SELECT version, pkgarch, checksum, value FROM PRMAIN_nohist;").fetchall()
+        conn.close()
+        self.assertEqual(sorted(rows), [("1.0-r0", "arm", "a", 0), ("2.0-r0", "arm", "a", 0)])
+        self.assertEqual(table.cached("1.0-r0", "arm", "a"), 0)
+
+    def test_cache_nohist(self):
+        table = self.open()
+        self.assertEqual(table.getValue("1.0-r0", "arm", "a"), 0)
+        # Not committed yet
+        self.assertEqual(table.cached("1.0-r0", "arm", "a"), None)
+        table.sync_if_dirty()
+        self.assertEqual(table.cached("1.0-r0", "arm", "a"), 0)
+
+        self.assertEqual(table.getValue("1.0-r0", "arm", "b"), 1)
+        self.assertEqual(table.cached("1.0-r0", "arm", "a"), None)
+        table.sync_if_dirty()
+        self.assertEqual(table.cached("1.0-r0", "arm", "a"), None)
+        self.assertEqual(table.cached("1.0-r0", "arm", "b"), 1)
+
+        self.assertEqual(table.importone("1.0-r0", "arm", "a", 5), 5)
+        self.assertEqual(table.cached("1.0-r0", "arm", "b"), None)
+        table.sync_if_dirty()
+        self.assertEqual(table.getValue("1.0-r0", "arm", "b"), 6)
+
+    def test_cache_hist(self):
+        table = self.open(nohist=False, cachesize=2)
+        for checksum in "abc":
+            table.getValue("1.0-r0", "arm", checksum)
+        table.sync_if_dirty()
+        self.assertEqual(table.cached("1.0-r0", "arm", "b"), 1)
+        self.assertEqual(table.cached("1.0-r0", "arm", "c"), 2)
+        # The least recently used was dropped
+        self.assertEqual(table.cached("1.0-r0", "arm", "a"), None)
+        self.assertEqual(table.getValue("1.0-r0", "arm", "a"), 0)
+        self.assertEqual(table.cached("1.0-r0", "arm", "a"), 0)
+        self.assertEqual(table.cached("1.0-r0", "arm", "b"), None)
+
+    def test_export_pages(self):
+        table = self.open()
+        for version in ("1.0-r0", "2.0-r0"):
+            for checksum in "abcde":
+                table.getValue(version, "arm", checksum)
+        table.importone("1.0-r0", "x86", "a", 3)
+        table.sync_if_dirty()
+
+        expected = [("1.0-r0", "arm", "e", 4), ("1.0-r0", "x86", "a", 3), ("2.0-r0", "arm", "e", 4)]
+        rows = table.export(None, None, None, False)[1]
+        self.assertEqual(sorted((row["version"], row["pkgarch"], row["checksum"], row["value"]) for row in rows),
+                         expected)
+        rows = table.export(None, None, None, False, None, 2)[1]
+        self.assertEqual([row["checksum"] for row in rows], ["e", "a"])
+        rows = table.export(None, None, None, False, ["1.0-r0", "x86", "a"], 2)[1]
+        self.assertEqual([(row["version"], row["checksum"]) for row in rows], [("2.0-r0", "e")])
+
+class PRServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tempdir, "prserv.sqlite3")
+        self.server = prserv.serv.PRServer(self.dbfile, os.path.join(self.tempdir, "prserv.log"),
+                                           ("127.0.0.1", 0), daemon=False)
+        self.thread = threading.Thread(target=self.server.work_forever)
+        self.thread.start()
+        self.host, self.port = self.server.getinfo()
+
+    def tearDown(self):
+        prserv.serv.PRServerConnection(self.host, self.port).terminate()
+        self.thread.join()
+        bb.utils.prunedir(self.tempdir)
+
+    def connect(self):
+        return prserv.serv.PRServerConnection(self.host, self.port)
+
+    def committed(self):
+        """The values in the database file, as another process sees them"""
+        conn = sqlite3.connect(self.dbfile)
+        try:
+            return dict(((version, pkgarch, checksum), value) for version, pkgarch, checksum, value
+                        in conn.execute("SELECT version, pkgarch, checksum, value FROM PRMAIN_nohist;"))
+        finally:
+            conn.close()
+
+    def test_getpr(self):
+        conn = self.connect()
+        self.assertEqual(conn.getPR("1.0-r0", "arm", "a"), 0)
+        self.assertEqual(conn.getPR("1.0-r0", "arm", "b"), 1)
+        self.assertEqual(conn.getPRs([("1.0-r0", "arm", "b"), ("1.0-r0", "arm", "c"), ("2.0-r0", "arm", "c")]),
+                         [1, 2, 0])
+        self.assertEqual(conn.getPRs([]), [])
+        self.assertEqual(self.committed()[("1.0-r0", "arm", "c")], 2)
+
+        self.assertEqual(conn.importmany([("3.0-r0", "arm", "a", 5), ("3.0-r0", "arm", "b", 7)]), [5, 7])
+        self.assertEqual(conn.getPR("3.0-r0", "arm", "c"), 8)
+        self.assertEqual(self.committed()[("3.0-r0", "arm", "b")], 7)
+
+    def test_fallback(self):
+        del self.server.funcs["getPRs"]
+        del self.server.funcs["importmany"]
+        conn = self.connect()
+        self.assertEqual(conn.getPRs([("1.0-r0", "arm", "a"), ("1.0-r0", "arm", "b")]), [0, 1])
+        self.assertEqual(conn.importmany([("2.0-r0", "arm", "a", 3)]), [3])
+
+    def test_export(self):
+        conn = self.connect()
+        entries = [("1.0-r0", "arm%d" % i, "a", i) for i in range(7)]
+        self.assertEqual(conn.importmany(entries), range(7))
+        saved = prserv.serv.PAGESIZE
+        prserv.serv.PAGESIZE = 3
+        try:
+            metainfo, datainfo = conn.export()
+            self.assertEqual(metainfo["tbl_name"], "PRMAIN_nohist")
+            self.assertEqual([(row["version"], row["pkgarch"], row["checksum"], row["value"]) for row in datainfo],
+                             entries)
+
+            del self.server.funcs["exportpage"]
+            self.assertEqual(len(conn.export(pkgarch="arm2")[1]), 1)
+        finally:
+            prserv.serv.PAGESIZE = saved
+
+    def test_concurrent_clients(self):
+        results = {}
+        def client(name):
+            conn = self.connect()
+            results[name] = [conn.getPR("1.0-r0", "arm", "%s-%d" % (name, i)) for i in range(20)]
+            results[name] += conn.getPRs([("1.0-r0", "arm", "%s-batch%d" % (name, i)) for i in range(20)])
+        threads = [threading.Thread(target=client, args=("client%d" % i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every checksum got its own value, and each was committed
+        values = sum(results.values(), [])
+        self.assertEqual(sorted(values), range(8 * 40))
+        committed = self.committed()
+        for name, clientvalues in results.items():
+            for i, value in enumerate(clientvalues[:20]):
+                self.assertEqual(committed[("1.0-r0", "arm", "%s-%d" % (name, i))], value)
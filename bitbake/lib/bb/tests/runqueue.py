@@ -0,0 +1,534 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for runqueue.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import logging
+import shutil
+import random
+import os
+import bb
+import bb.parse
+import bb.runqueue
+import bb.cache
+import bb.siggen
+import bb.fetch2
+
+class FakeObject(object):
+    pass
+
+class TaskGraph(object):
+    """
+    A synthetic set of recipes each with a chain of tasks, with random
+    dependencies on earlier recipes and some shared stamps, in the form
+    the schedulers expect to find in the runqueue and its RunQueueData
+    """
+    tasknames = ["do_fetch", "do_unpack", "do_compile", "do_install", "do_build"]
+
+    def __init__(self, stampdir, recipes, seed):
+        rand = random.Random(seed)
+        self.rqdata = rqdata = FakeObject()
+        rqdata.runq_fnid = []
+        rqdata.runq_task = []
+        rqdata.runq_depends = []
+        rqdata.runq_revdeps = []
+        rqdata.runq_weight = []
+        rqdata.taskData = FakeObject()
+        rqdata.taskData.fn_index = []
+        rqdata.dataCache = FakeObject()
+        rqdata.dataCache.stamp = {}
+        rqdata.dataCache.stamp_base = {}
+        rqdata.dataCache.stamp_extrainfo = {}
+        rqdata.dataCache.task_deps = {}
+        rqdata.dataCache.pkg_fn = {}
+        rqdata.dataCache.pkg_pepvpr = {}
+
+        for fnid in xrange(recipes):
+            fn = "/recipes/r%d.bb" % fnid
+            rqdata.taskData.fn_index.append(fn)
+            rqdata.dataCache.stamp[fn] = os.path.join(stampdir, "r%d" % fnid)
+            rqdata.dataCache.stamp_base[fn] = {}
+            rqdata.dataCache.stamp_extrainfo[fn] = {}
+            rqdata.dataCache.pkg_fn[fn] = "r%d" % fnid
+            rqdata.dataCache.pkg_pepvpr[fn] = ("", "1.0", "r0")
+            rqdata.dataCache.task_deps[fn] = {'resourceclass' : {'do_fetch' : 'io', 'do_compile' : 'cpu'}}
+            if fnid % 7 == 1:
+                # Pairs of recipes sharing a work directory
+                rqdata.dataCache.stamp_base[fn]["do_unpack"] = rqdata.dataCache.stamp["/recipes/r%d.bb" % (fnid - 1)]
+            first = len(rqdata.runq_fnid)
+            for i, taskname in enumerate(self.tasknames):
+                taskid = len(rqdata.runq_fnid)
+                rqdata.runq_fnid.append(fnid)
+                rqdata.runq_task.append(taskname)
+                deps = set()
+                if i:
+                    deps.add(taskid - 1)
+                if taskname == "do_compile" and first:
+                    for _ in xrange(rand.randint(0, 4)):
+                        deps.add(rand.randrange(0, first / len(self.tasknames)) * len(self.tasknames) + 3)
+                rqdata.runq_depends.append(deps)
+                rqdata.runq_revdeps.append(set())
+                # Plenty of equal weights to check ties are broken the same
+                rqdata.runq_weight.append(rand.randint(1, recipes / 2))
+        for taskid, deps in enumerate(rqdata.runq_depends):
+            for dep in deps:
+                rqdata.runq_revdeps[dep].add(taskid)
+
+    def runqueue(self, threads, cfgData=None):
+        rq = FakeObject()
+        rq.cfgData = cfgData or bb.data.init()
+        rq.rq = FakeObject()
+        rq.rq.scenequeue_covered = set()
+        rq.rq.stampindex = bb.build.StampIndex()
+        rq.taskdurations = bb.cache.TaskDurationCache(None)
+        numtasks = len(self.rqdata.runq_fnid)
+        rq.runq_buildable = [0] * numtasks
+        rq.runq_running = [0] * numtasks
+        rq.runq_complete = [0] * numtasks
+        rq.build_stamps = {}
+        rq.build_stamps2 = set()
+        rq.number_tasks = threads
+        rq.stats = bb.runqueue.RunQueueStats(numtasks)
+        for taskid in xrange(numtasks):
+            if not self.rqdata.runq_depends[taskid]:
+                rq.runq_buildable[taskid] = 1
+        return rq
+
+    def run(self, schedulerclass, threads):
+        """Return the order schedulerclass would start the tasks in"""
+        rq = self.runqueue(threads)
+        return self.simulate(rq, schedulerclass(rq, self.rqdata))
+
+    def simulate(self, rq, sched, check=None):
+        """
+        Run the build with each task taking the same time, check is called
+        whenever a task is started
+        """
+        started = []
+        active = []
+        while len(started) < len(rq.runq_running):
+            while True:
+                taskid = sched.next()
+                if taskid is None:
+                    break
+                started.append(taskid)
+                active.append(taskid)
+                rq.runq_running[taskid] = 1
+                rq.build_stamps[taskid] = sched.stamps[taskid]
+                rq.build_stamps2.add(sched.stamps[taskid])
+                rq.stats.taskActive()
+                if check:
+                    check(rq)
+            # Complete the longest running task
+            taskid = active.pop(0)
+            del rq.build_stamps[taskid]
+            rq.build_stamps2.discard(sched.stamps[taskid])
+            sched.task_finished(taskid)
+            rq.stats.taskCompleted()
+            rq.runq_complete[taskid] = 1
+            for revdep in self.rqdata.runq_revdeps[taskid]:
+                if all(rq.runq_complete[dep] for dep in self.rqdata.runq_depends[revdep]):
+                    rq.runq_buildable[revdep] = 1
+                    sched.newbuilable(revdep)
+        return started
+
+class LinearSchedulerMixin(object):
+    """The original list scanning implementation of next_buildable_task()"""
+
+    def next_buildable_task(self):
+        if self.rev_prio_map is None:
+            self.rev_prio_map = range(self.numTasks)
+            for taskid in xrange(self.numTasks):
+                self.rev_prio_map[self.prio_map[taskid]] = taskid
+        self.buildable = [x for x in self.buildable if not self.rq.runq_running[x] == 1]
+        best = None
+        bestprio = None
+        for taskid in self.buildable:
+            prio = self.rev_prio_map[taskid]
+            if bestprio is None or bestprio > prio:
+                if self.stamps[taskid] in self.rq.build_stamps2:
+                    continue
+                bestprio = prio
+                best = taskid
+        return best
+
+    def newbuilable(self, task):
+        self.buildable.append(task)
+
+def original_speed_prio_map(rqdata):
+    sortweight = sorted(rqdata.runq_weight)
+    copyweight = list(rqdata.runq_weight)
+    prio_map = []
+    for weight in sortweight:
+        idx = copyweight.index(weight)
+        prio_map.append(idx)
+        copyweight[idx] = -1
+    prio_map.reverse()
+    return prio_map
+
+def original_completion_prio_map(rqdata):
+    basemap = original_speed_prio_map(rqdata)
+    prio_map = []
+    while (len(basemap) > 0):
+        entry = basemap.pop(0)
+        prio_map.append(entry)
+        fnid = rqdata.runq_fnid[entry]
+        todel = []
+        for entry in basemap:
+            entry_fnid = rqdata.runq_fnid[entry]
+            if entry_fnid == fnid:
+                todel.append(basemap.index(entry))
+                prio_map.append(entry)
+        todel.reverse()
+        for idx in todel:
+            del basemap[idx]
+    return prio_map
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stampdir = tempfile.mkdtemp()
+        self.saved_siggen = getattr(bb.parse, "siggen", None)
+        bb.parse.siggen = bb.siggen.SignatureGenerator(None)
+
+    def tearDown(self):
+        bb.parse.siggen = self.saved_siggen
+        shutil.rmtree(self.stampdir)
+
+    def test_ready_queue(self):
+        graph = TaskGraph(self.stampdir, 60, 1)
+        for schedulerclass in [bb.runqueue.RunQueueScheduler,
+                               bb.runqueue.RunQueueSchedulerSpeed,
+                               bb.runqueue.RunQueueSchedulerCompletion]:
+            linear = type("Linear", (LinearSchedulerMixin, schedulerclass), {})
+            for threads in [1, 4, 16]:
+                order = graph.run(schedulerclass, threads)
+                self.assertEqual(sorted(order), range(len(graph.rqdata.runq_fnid)))
+                self.assertEqual(order, graph.run(linear, threads))
+
+    def test_prio_maps(self):
+        for seed in xrange(5):
+            graph = TaskGraph(self.stampdir, 40, seed)
+            rq = graph.runqueue(1)
+            self.assertEqual(bb.runqueue.RunQueueSchedulerSpeed(rq, graph.rqdata).prio_map,
+                             original_speed_prio_map(graph.rqdata))
+            self.assertEqual(bb.runqueue.RunQueueSchedulerCompletion(rq, graph.rqdata).prio_map,
+                             original_completion_prio_map(graph.rqdata))
+
+    def test_resource_budgets(self):
+        graph = TaskGraph(self.stampdir, 60, 1)
+        d = bb.data.init()
+        d.setVar("BB_RESOURCE_BUDGETS", "cpu:2 io:1")
+        rq = graph.runqueue(8, d)
+        sched = bb.runqueue.RunQueueSchedulerResource(rq, graph.rqdata)
+        peak = {"cpu" : 0, "io" : 0, None : 0}
+        def check(rq):
+            running = {"cpu" : 0, "io" : 0, None : 0}
+            for taskid in rq.build_stamps:
+                running[sched.resourceclass[taskid]] += 1
+            for resourceclass in running:
+                peak[resourceclass] = max(peak[resourceclass], running[resourceclass])
+        order = graph.simulate(rq, sched, check)
+        self.assertEqual(sorted(order), range(len(graph.rqdata.runq_fnid)))
+        self.assertEqual(peak["cpu"], 2)
+        self.assertEqual(peak["io"], 1)
+        self.assertTrue(peak[None] > 2)
+
+    def test_resource_pressure(self):
+        graph = TaskGraph(self.stampdir, 20, 1)
+        d = bb.data.init()
+        d.setVar("BB_RESOURCE_MAX_LOAD", "1")
+        rq = graph.runqueue(8, d)
+        sched = bb.runqueue.RunQueueSchedulerResource(rq, graph.rqdata)
+        # Pretend the system is overloaded for the whole build
+        sched.sample = lambda: sched.overloaded.add("cpu")
+        peak = [0]
+        def check(rq):
+            running = [sched.resourceclass[taskid] for taskid in rq.build_stamps].count("cpu")
+            peak[0] = max(peak[0], running)
+        order = graph.simulate(rq, sched, check)
+        self.assertEqual(sorted(order), range(len(graph.rqdata.runq_fnid)))
+        self.assertEqual(peak[0], 1)
+
+    def test_resource_memory_pressure(self):
+        graph = TaskGraph(self.stampdir, 20, 1)
+        d = bb.data.init()
+        d.setVar("BB_RESOURCE_DEFAULT_CLASS", "memory")
+        for overloaded, heavy in [(set(), 8), (set(["memory"]), 1)]:
+            rq = graph.runqueue(8, d)
+            sched = bb.runqueue.RunQueueSchedulerResource(rq, graph.rqdata)
+            self.assertEqual(sched.resourceclass[:3], ["io", "memory", "cpu"])
+            sched.sample = lambda: None
+            sched.overloaded = overloaded
+            peak = [0]
+            def check(rq):
+                running = [sched.resourceclass[taskid] for taskid in rq.build_stamps]
+                peak[0] = max(peak[0], len(running) - running.count("io"))
+            order = graph.simulate(rq, sched, check)
+            self.assertEqual(sorted(order), range(len(graph.rqdata.runq_fnid)))
+            # Whilst memory is short only one task which isn't "io" runs
+            self.assertEqual(peak[0], heavy)
+
+    def test_held_tasks(self):
+        graph = TaskGraph(self.stampdir, 60, 1)
+        d = bb.data.init()
+        d.setVar("BB_RESOURCE_BUDGETS", "io:1")
+        rq = graph.runqueue(8, d)
+        sched = bb.runqueue.RunQueueSchedulerResource(rq, graph.rqdata)
+        checked = []
+        blocked_by = sched.blocked_by
+        def counting(taskid):
+            checked.append(taskid)
+            return blocked_by(taskid)
+        sched.blocked_by = counting
+
+        # Only the do_fetch tasks are buildable, once one is running the
+        # others wait for it to finish rather than being looked at again
+        taskid = sched.next()
+        rq.runq_running[taskid] = 1
+        rq.build_stamps[taskid] = sched.stamps[taskid]
+        rq.build_stamps2.add(sched.stamps[taskid])
+        rq.stats.taskActive()
+        self.assertEqual(sched.next(), None)
+        self.assertEqual(len(sched.held[("resourceclass", "io")]), 59)
+        del checked[:]
+        self.assertEqual(sched.next(), None)
+        self.assertEqual(checked, [])
+
+        del rq.build_stamps[taskid]
+        rq.build_stamps2.discard(sched.stamps[taskid])
+        rq.stats.taskCompleted()
+        sched.task_finished(taskid)
+        self.assertFalse(sched.held)
+        self.assertNotEqual(sched.next(), None)
+
+    def test_critical_path(self):
+        graph = TaskGraph(self.stampdir, 40, 1)
+        rq = graph.runqueue(4)
+        # No history so the same as the speed scheduler
+        self.assertEqual(bb.runqueue.RunQueueSchedulerCritical(rq, graph.rqdata).prio_map,
+                         bb.runqueue.RunQueueSchedulerSpeed(rq, graph.rqdata).prio_map)
+
+        # Make one recipe's compile far longer than everything else, the
+        # tasks leading up to it should come first
+        for fnid in xrange(40):
+            rq.taskdurations.record("r%d" % fnid, "do_compile", 10)
+        rq.taskdurations.record("r0", "do_compile", 1000)
+        sched = bb.runqueue.RunQueueSchedulerCritical(rq, graph.rqdata)
+        self.assertEqual(sched.prio_map[:2], [0, 1])
+        order = graph.simulate(rq, sched)
+        self.assertEqual(order[0], 0)
+
+    def test_buildstats(self):
+        graph = TaskGraph(self.stampdir, 10, 1)
+        bsbase = os.path.join(self.stampdir, "buildstats")
+        for build, elapsed in [("201601010000", "100.00"), ("201601020000", "512.50")]:
+            bb.utils.mkdirhier(os.path.join(bsbase, "image-qemux86", build, "r3-1.0-r0"))
+            with open(os.path.join(bsbase, "image-qemux86", build, "r3-1.0-r0/do_compile"), "w") as f:
+                f.write("Event: TaskStarted \nStarted: 1451606400.00 \n"
+                        "r3-1.0-r0: do_compile: Elapsed time: %s seconds \n"
+                        "Status: PASSED \n" % elapsed)
+            os.utime(os.path.join(bsbase, "image-qemux86", build), (int(build[:8]), int(build[:8])))
+        # The current build has already started, with nothing recorded yet
+        bb.utils.mkdirhier(os.path.join(bsbase, "image-qemux86/201601030000"))
+        with open(os.path.join(bsbase, ".buildname"), "w") as f:
+            f.write("image-qemux86/201601030000")
+        d = bb.data.init()
+        d.setVar("BUILDSTATS_BASE", bsbase)
+        d.setVar("BUILDNAME", "201601030000")
+        rq = graph.runqueue(4, d)
+        sched = bb.runqueue.RunQueueSchedulerCritical(rq, graph.rqdata)
+        self.assertEqual(rq.taskdurations.durations, {("r3", "do_compile") : 512.5})
+
+class TaskHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stampdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.stampdir)
+
+    def taskhashes(self, graph, threads=None):
+        siggen = bb.siggen.SignatureGeneratorBasicHash(bb.data.init())
+        rqdata = graph.rqdata
+        tasks = [(rqdata.taskData.fn_index[fnid], task) for fnid, task in zip(rqdata.runq_fnid, rqdata.runq_task)]
+        if threads:
+            siggen.prepare_taskhashes(tasks, rqdata.dataCache, threads)
+        hashes = []
+        # The graph's tasks come after their dependencies
+        for taskid, (fn, task) in enumerate(tasks):
+            deps = ["%s.%s" % tasks[dep] for dep in rqdata.runq_depends[taskid]]
+            hashes.append(siggen.get_taskhash(fn, task, deps, rqdata.dataCache))
+        self.assertEqual(siggen.taskhash_inputs, {})
+        return hashes, siggen
+
+    def test_prepared_taskhashes(self):
+        graph = TaskGraph(self.stampdir, 30, 1)
+        dataCache = graph.rqdata.dataCache
+        dataCache.basetaskhash = {}
+        dataCache.file_checksums = {}
+        for fnid, fn in enumerate(graph.rqdata.taskData.fn_index):
+            for task in graph.tasknames:
+                dataCache.basetaskhash[fn + "." + task] = "%s%s" % (fnid, task)
+            dataCache.file_checksums[fn] = {}
+            if fnid % 3 == 0:
+                path = os.path.join(self.stampdir, "file%d" % fnid)
+                with open(path, "w") as f:
+                    f.write("contents %d" % fnid)
+                dataCache.file_checksums[fn]["do_fetch"] = "%s:True %s:False" % (path, path + ".missing")
+        with open(dataCache.stamp["/recipes/r4.bb"] + ".do_compile.taint", "w") as f:
+            f.write("a taint")
+
+        hashes, siggen = self.taskhashes(graph)
+        self.assertEqual(siggen.taints.keys(), ["/recipes/r4.bb.do_compile"])
+        self.assertEqual(len(siggen.file_checksum_values["/recipes/r3.bb.do_fetch"]), 1)
+        for threads in [1, 4]:
+            self.assertEqual(self.taskhashes(graph, threads)[0], hashes)
+        # The taint reaches the tasks depending on it
+        without = self.taskhashes(graph)[0]
+        os.unlink(dataCache.stamp["/recipes/r4.bb"] + ".do_compile.taint")
+        self.assertNotEqual(self.taskhashes(graph, 4)[0], without)
+
+    def test_nostamp_taint(self):
+        graph = TaskGraph(self.stampdir, 3, 1)
+        dataCache = graph.rqdata.dataCache
+        dataCache.basetaskhash = {}
+        dataCache.file_checksums = {}
+        for fn in graph.rqdata.taskData.fn_index:
+            for task in graph.tasknames:
+                dataCache.basetaskhash[fn + "." + task] = fn + task
+            dataCache.file_checksums[fn] = {}
+        dataCache.task_deps["/recipes/r1.bb"]['nostamp'] = ['do_compile']
+
+        warnings = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                warnings.append(record.getMessage())
+        handler = Handler(logging.WARNING)
+        logger = logging.getLogger("BitBake.SigGen")
+        logger.addHandler(handler)
+        try:
+            hashes, siggen = self.taskhashes(graph)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(siggen.taints.keys(), ["/recipes/r1.bb.do_compile"])
+        self.assertTrue(siggen.taints["/recipes/r1.bb.do_compile"].startswith("nostamp:"))
+        self.assertEqual(warnings, [])
+        # Each run gets a new taint
+        self.assertNotEqual(self.taskhashes(graph)[0], hashes)
+
+class StampIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stampdir = tempfile.mkdtemp()
+        self.saved_siggen = getattr(bb.parse, "siggen", None)
+        bb.parse.siggen = bb.siggen.SignatureGeneratorBasicHash(bb.data.init())
+        self.graph = TaskGraph(self.stampdir, 3, 1)
+        self.dataCache = dataCache = self.graph.rqdata.dataCache
+        dataCache.stampclean = dict(dataCache.stamp)
+        dataCache.stamp_base_clean = dict((fn, {}) for fn in dataCache.stamp)
+        for fn in dataCache.stamp:
+            for task in self.graph.tasknames:
+                bb.parse.siggen.taskhash[fn + "." + task] = "new"
+
+    def tearDown(self):
+        bb.parse.siggen = self.saved_siggen
+        shutil.rmtree(self.stampdir)
+
+    def assertIndexCurrent(self, index):
+        for stampdir, entries in index.dirs.items():
+            self.assertEqual(sorted(entries), sorted(os.listdir(stampdir)))
+
+    def test_stamp_index(self):
+        fn = "/recipes/r0.bb"
+        stamp = self.dataCache.stamp[fn]
+        for name in ["do_fetch.old", "do_fetch_setscene.old", "do_fetch.sigdata.old", "do_fetch.taint", "do_unpack.old"]:
+            open(stamp + "." + name, "w").close()
+
+        index = bb.build.StampIndex()
+        newstamp = index.stampfile("do_fetch", self.dataCache, fn)
+        self.assertEqual(newstamp, stamp + ".do_fetch.new")
+        self.assertFalse(index.exists(newstamp))
+        self.assertEqual(index.mtime(newstamp), None)
+        self.assertEqual(index.mtime(stamp + ".do_fetch.old"), int(os.stat(stamp + ".do_fetch.old").st_mtime))
+
+        # As if written by the worker, leaving the server to replace the
+        # other stamps for the task
+        open(newstamp, "w").close()
+        self.assertFalse(index.exists(newstamp))
+        index.stamp_made("do_fetch", self.dataCache, fn)
+        self.assertIndexCurrent(index)
+        self.assertFalse(os.path.exists(stamp + ".do_fetch.old"))
+        self.assertFalse(os.path.exists(stamp + ".do_fetch_setscene.old"))
+        self.assertTrue(index.exists(stamp + ".do_fetch.sigdata.old"))
+        self.assertTrue(index.exists(stamp + ".do_fetch.taint"))
+        self.assertTrue(index.exists(stamp + ".do_unpack.old"))
+        self.assertEqual(index.mtime(newstamp), int(os.stat(newstamp).st_mtime))
+
+        bb.build.del_stamp("do_fetch", self.dataCache, fn)
+        index.stamp_removed("do_fetch", self.dataCache, fn)
+        self.assertIndexCurrent(index)
+        self.assertFalse(index.exists(newstamp))
+
+    def test_make_stamp_index(self):
+        fn = "/recipes/r1.bb"
+        stamp = self.dataCache.stamp[fn]
+        for name in ["do_fetch.old", "do_fetch.older", "do_fetch.sigdata.old", "do_compile.old"]:
+            open(stamp + "." + name, "w").close()
+        index = bb.build.StampIndex()
+        self.assertFalse(index.exists(stamp + ".do_fetch.new"))
+
+        bb.build.make_stamp("do_fetch", self.dataCache, fn, index)
+        self.assertIndexCurrent(index)
+        self.assertEqual(sorted(index.cleanable[os.path.dirname(stamp)]["r1.do_fetch.*"]), ["r1.do_fetch.new"])
+        bb.build.make_stamp("do_compile", self.dataCache, fn, index)
+        self.assertIndexCurrent(index)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(stamp))),
+                         ["r1.do_compile.new", "r1.do_fetch.new", "r1.do_fetch.sigdata.old"])
+
+    def test_prune_stamps(self):
+        old, new = "0" * 32, "1" * 32
+        recipedir = os.path.join(self.stampdir, "all", "foo")
+        os.makedirs(recipedir)
+        names = ["1.0-r0.do_fetch." + old, "1.0-r0.do_fetch." + new,
+                 "1.0-r0.do_fetch.sigdata." + old, "1.0-r0.do_fetch.sigdata." + new,
+                 "1.0-r0.do_fetch.sigbasedata." + "2" * 32, "1.0-r0.do_fetch.taint",
+                 "1.0-r0.do_compile_setscene." + old + ".qemux86",
+                 "1.0-r0.do_compile_setscene." + new + ".qemuarm",
+                 "1.0-r0.do_compile.sigdata." + old,
+                 "0.9-r0.do_fetch." + old, "README"]
+        for age, name in enumerate(names):
+            path = os.path.join(recipedir, name)
+            open(path, "w").close()
+            os.utime(path, (age * 10, age * 10))
+        # Make the newer stamp older than the one it replaces
+        os.utime(os.path.join(recipedir, names[0]), (100, 100))
+
+        removed = bb.build.prune_stamps(self.stampdir, keep=0, dry_run=True)
+        self.assertEqual(len(os.listdir(recipedir)), len(names))
+        self.assertEqual(removed, [os.path.join(recipedir, name) for name in
+                                   ["1.0-r0.do_fetch." + new, "1.0-r0.do_fetch.sigbasedata." + "2" * 32,
+                                    "1.0-r0.do_fetch.sigdata." + new]])
+
+        bb.build.prune_stamps(self.stampdir, keep=0, per_dir=True)
+        self.assertEqual(sorted(os.listdir(recipedir)), sorted(
+                         ["1.0-r0.do_fetch." + old, "1.0-r0.do_fetch.sigdata." + old, "1.0-r0.do_fetch.taint",
+                          "1.0-r0.do_compile_setscene." + old + ".qemux86",
+                          "1.0-r0.do_compile_setscene." + new + ".qemuarm",
+                          "1.0-r0.do_compile.sigdata." + old, "README"]))
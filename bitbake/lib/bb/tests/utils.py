@@ -376,3 +376,20 @@ do_functionname() {
         (updated, newlines) = bb.utils.edit_metadata(self._origfile.splitlines(True), varlist, handle_var)
         self.assertTrue(updated, 'List should be updated but isn\'t')
         self.assertEqual(newlines, newfile5.splitlines(True))
+
+class FileDigests(unittest.TestCase):
+    def test_file_digests(self):
+        import hashlib
+        content = os.urandom(10000) + "\n" * 5000 + "\0" * 3000
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            digests = bb.utils.file_digests(f.name, ["md5", "sha1", "sha256"], blocksize=4096)
+            self.assertEqual(digests, {"md5" : hashlib.md5(content).hexdigest(),
+                                       "sha1" : hashlib.sha1(content).hexdigest(),
+                                       "sha256" : hashlib.sha256(content).hexdigest()})
+            self.assertEqual(bb.utils.md5_file(f.name), digests["md5"])
+            self.assertEqual(bb.utils.sha256_file(f.name), digests["sha256"])
+
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertEqual(bb.utils.file_digests(f.name, ["md5"]), {"md5" : hashlib.md5("").hexdigest()})
@@ -499,39 +499,37 @@ def unlockfile(lf):
     fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
     lf.close()
 
-def md5_file(filename):
+def file_digests(filename, algorithms=("md5", "sha256"), blocksize=1024*1024):
     """
-    Return the hex string representation of the MD5 checksum of filename.
+    Return a dict of the hex digests of filename for each of the hashlib
+    algorithms named, reading the file once in blocks of blocksize bytes.
     """
-    try:
-        import hashlib
-        m = hashlib.md5()
-    except ImportError:
-        import md5
-        m = md5.new()
+    import hashlib
 
+    hashers = [(name, hashlib.new(name)) for name in algorithms]
+    buf = bytearray(blocksize)
     with open(filename, "rb") as f:
-        for line in f:
-            m.update(line)
-    return m.hexdigest()
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                break
+            block = buffer(buf, 0, count)
+            for _, hasher in hashers:
+                hasher.update(block)
+    return dict((name, hasher.hexdigest()) for name, hasher in hashers)
+
+def md5_file(filename):
+    """
+    Return the hex string representation of the MD5 checksum of filename.
+    """
+    return file_digests(filename, ["md5"])["md5"]
 
 def sha256_file(filename):
     """
     Return the hex string representation of the 256-bit SHA checksum of
-    filename.  On Python 2.4 this will return None, so callers will need to
-    handle that by either skipping SHA checks, or running a standalone sha256sum
-    binary.
+    filename.
     """
-    try:
-        import hashlib
-    except ImportError:
-        return None
-
-    s = hashlib.sha256()
-    with open(filename, "rb") as f:
-        for line in f:
-            s.update(line)
-    return s.hexdigest()
+    return file_digests(filename, ["sha256"])["sha256"]
 
 def preserved_envvars_exported():
     """Variables which are taken from the environment and placed in and exported
@@ -2,7 +2,9 @@ import logging
 import os.path
 import errno
 import prserv
+import threading
 import time
+from collections import OrderedDict
 
 try:
     import sqlite3
@@ -24,12 +26,22 @@ if sqlversion[0] < 3 or (sqlversion[0] == 3 and sqlversion[1] < 3):
 # tuple (version, pkgarch, checksum), otherwise return historical value.
 # Value can decrement if returning to a previous build.
 #
+# The values most recently served are also kept in memory, keyed by the
+# (version, pkgarch) in "No History" mode, as only the latest checksum's
+# value is returned for those, and by the whole query tuple otherwise.
+# They go into the cache once they are committed, which the PR server
+# relies on to answer from it without waiting for the database.
+#
 
 class PRTable(object):
-    def __init__(self, conn, table, nohist):
+    def __init__(self, conn, table, nohist, cachesize=10000):
         self.conn = conn
         self.nohist = nohist
         self.dirty = False
+        self.cache = OrderedDict()
+        self.cachesize = cachesize
+        self.cachelock = threading.Lock()
+        self.pending = OrderedDict()
         if nohist:
             self.table = "%s_nohist" % table 
         else:
@@ -41,6 +53,9 @@ class PRTable(object):
                     checksum TEXT NOT NULL, \
                     value INTEGER, \
                     PRIMARY KEY (version, pkgarch, checksum));" % self.table)
+        # Finds the largest value of a (version, pkgarch) without a scan
+        self._execute("CREATE INDEX IF NOT EXISTS %s_value ON %s (version, pkgarch, value);"
+                      % (self.table, self.table))
 
     def _execute(self, *query):
         """Execute a query, waiting to acquire a lock if necessary"""
@@ -55,8 +70,58 @@ class PRTable(object):
                 raise exc
 
     def sync(self):
+        # The EXCLUSIVE transaction is begun again by the next write, so
+        # that nothing is locked while we only read
         self.conn.commit()
-        self._execute("BEGIN EXCLUSIVE TRANSACTION")
+        with self.cachelock:
+            for key, entry in self.pending.iteritems():
+                self._cache(key, entry)
+        self.pending = OrderedDict()
+
+    def _cachekey(self, version, pkgarch, checksum):
+        if self.nohist:
+            return (version, pkgarch)
+        return (version, pkgarch, checksum)
+
+    def _cache(self, key, entry):
+        self.cache.pop(key, None)
+        self.cache[key] = entry
+        if len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
+
+    def _served(self, version, pkgarch, checksum, value, written=False):
+        """Note a value read from or written to the table"""
+        key = self._cachekey(version, pkgarch, checksum)
+        if written and self.nohist:
+            # The value of any other checksum of (version, pkgarch)
+            # cached isn't the one to return any more
+            with self.cachelock:
+                self.cache.pop(key, None)
+        if self.dirty or written:
+            self.pending.pop(key, None)
+            self.pending[key] = (checksum, value)
+        else:
+            with self.cachelock:
+                self._cache(key, (checksum, value))
+
+    def _forget(self, version, pkgarch, checksum):
+        key = self._cachekey(version, pkgarch, checksum)
+        with self.cachelock:
+            self.cache.pop(key, None)
+        self.pending.pop(key, None)
+
+    def cached(self, version, pkgarch, checksum):
+        """
+        Return the committed value of a query tuple if it is in the
+        cache, or None. Safe to call while another thread uses the table.
+        """
+        key = self._cachekey(version, pkgarch, checksum)
+        with self.cachelock:
+            entry = self.cache.get(key)
+            if entry is None or entry[0] != checksum:
+                return None
+            self._cache(key, entry)
+            return entry[1]
 
     def sync_if_dirty(self):
         if self.dirty:
@@ -68,6 +133,7 @@ class PRTable(object):
                            (version, pkgarch, checksum))
         row=data.fetchone()
         if row != None:
+            self._served(version, pkgarch, checksum, row[0])
             return row[0]
         else:
             #no value found, try to insert
@@ -84,6 +150,7 @@ class PRTable(object):
                                (version, pkgarch, checksum))
             row=data.fetchone()
             if row != None:
+                self._served(version, pkgarch, checksum, row[0], written=True)
                 return row[0]
             else:
                 raise prserv.NotFoundError
@@ -96,6 +163,7 @@ class PRTable(object):
                             (version, pkgarch, checksum, version, pkgarch))
         row=data.fetchone()
         if row != None:
+            self._served(version, pkgarch, checksum, row[0])
             return row[0]
         else:
             #no value found, try to insert
@@ -104,8 +172,10 @@ class PRTable(object):
                                % (self.table,self.table),
                                (version, pkgarch, checksum, version, pkgarch))
             except sqlite3.IntegrityError as exc:
+                # sqlite has only undone this statement; rolling back the
+                # transaction would lose the writes of others the PR
+                # server is yet to commit
                 logger.error(str(exc))
-                self.conn.rollback()
 
             self.dirty = True
 
@@ -113,11 +183,14 @@ class PRTable(object):
                                (version, pkgarch, checksum))
             row=data.fetchone()
             if row != None:
+                self._served(version, pkgarch, checksum, row[0], written=True)
                 return row[0]
             else:
                 raise prserv.NotFoundError
 
     def getValue(self, version, pkgarch, checksum):
+        if None in (version, pkgarch, checksum):
+            raise prserv.NotFoundError
         if self.nohist:
             return self._getValueNohist(version, pkgarch, checksum)
         else:
@@ -145,6 +218,7 @@ class PRTable(object):
             row = data.fetchone()
             if row != None:
                 val = row[0]
+                self._served(version, pkgarch, checksum, val, written=True)
         return val
 
     def _importNohist(self, version, pkgarch, checksum, value):
@@ -166,18 +240,29 @@ class PRTable(object):
         data = self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=? AND value>=?;" % self.table,
                             (version,pkgarch,checksum,value))
         row=data.fetchone()
+        # The imported value needn't be the largest of (version, pkgarch)
+        self._forget(version, pkgarch, checksum)
         if row != None:
             return row[0]
         else:
             return None
 
     def importone(self, version, pkgarch, checksum, value):
+        if None in (version, pkgarch, checksum, value):
+            return None
         if self.nohist:
             return self._importNohist(version, pkgarch, checksum, value)
         else:
             return self._importHist(version, pkgarch, checksum, value)
 
-    def export(self, version, pkgarch, checksum, colinfo):
+    def export(self, version, pkgarch, checksum, colinfo, after=None, count=None):
+        """
+        Return the table's column information if colinfo is set and its
+        rows matching any of version, pkgarch and checksum given. With a
+        count, only that many rows are returned, in key order and from
+        after the (version, pkgarch, checksum) of after, so that a large
+        table can be exported a page at a time.
+        """
         metainfo = {}
         #column info 
         if colinfo:
@@ -198,9 +283,8 @@ class PRTable(object):
         datainfo = []
 
         if self.nohist:
-            sqlstmt = "SELECT T1.version, T1.pkgarch, T1.checksum, T1.value FROM %s as T1, \
-                    (SELECT version,pkgarch,max(value) as maxvalue FROM %s GROUP BY version,pkgarch) as T2 \
-                    WHERE T1.version=T2.version AND T1.pkgarch=T2.pkgarch AND T1.value=T2.maxvalue " % (self.table, self.table)
+            sqlstmt = "SELECT T1.version, T1.pkgarch, T1.checksum, T1.value FROM %s as T1 \
+                    WHERE T1.value=(SELECT max(value) FROM %s WHERE version=T1.version AND pkgarch=T1.pkgarch) " % (self.table, self.table)
         else:
             sqlstmt = "SELECT * FROM %s as T1 WHERE 1=1 " % self.table
         sqlarg = []
@@ -214,6 +298,11 @@ class PRTable(object):
         if checksum:
             where += "AND T1.checksum=? "
             sqlarg.append(str(checksum))
+        if after:
+            where += "AND (T1.version>? OR (T1.version=? AND (T1.pkgarch>? OR (T1.pkgarch=? AND T1.checksum>?)))) "
+            sqlarg.extend([after[0], after[0], after[1], after[1], after[2]])
+        if count:
+            where += "ORDER BY T1.version, T1.pkgarch, T1.checksum LIMIT %d " % count
 
         sqlstmt += where + ";"
 
@@ -233,9 +322,10 @@ class PRTable(object):
 
 class PRData(object):
     """Object representing the PR database"""
-    def __init__(self, filename, nohist=True):
+    def __init__(self, filename, nohist=True, cachesize=10000):
         self.filename=os.path.abspath(filename)
         self.nohist=nohist
+        self.cachesize=cachesize
         #build directory hierarchy
         try:
             os.makedirs(os.path.dirname(self.filename))
@@ -258,7 +348,7 @@ class PRData(object):
         if tblname in self._tables:
             return self._tables[tblname]
         else:
-            tableobj = self._tables[tblname] = PRTable(self.connection, tblname, self.nohist)
+            tableobj = self._tables[tblname] = PRTable(self.connection, tblname, self.nohist, self.cachesize)
             return tableobj
 
     def __delitem__(self, tblname):
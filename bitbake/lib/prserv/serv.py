@@ -1,9 +1,10 @@
 import os,sys,logging
 import signal, time
 from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
 import threading
-import Queue
 import socket
+import xmlrpclib
 
 try:
     import sqlite3
@@ -22,6 +23,10 @@ if sys.hexversion < 0x020600F0:
     sys.exit(1)
 
 class Handler(SimpleXMLRPCRequestHandler):
+    # Keep connections open for further requests, closing idle ones
+    protocol_version = "HTTP/1.1"
+    timeout = 30
+
     def _dispatch(self,method,params):
         try:
             value=self.server.funcs[method](*params)
@@ -32,14 +37,24 @@ class Handler(SimpleXMLRPCRequestHandler):
         return value
 
 PIDPREFIX = "/tmp/PRServer_%s_%s.pid"
+# Rows exported or imported per request by PRServerConnection
+PAGESIZE = 5000
 singleton = None
 
 
-class PRServer(SimpleXMLRPCServer):
+class PRServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """
+    Each connection is served from its own thread, the requests taking
+    turns at the database. A request's writes are committed before it's
+    answered, together with the writes of any others which arrive while
+    the previous commit is in progress.
+    """
+    daemon_threads = True
+
     def __init__(self, dbfile, logfile, interface, daemon=True):
         ''' constructor '''
         try:
-            SimpleXMLRPCServer.__init__(self, interface,
+            SimpleXMLRPCServer.__init__(self, interface, requestHandler=Handler,
                                         logRequests=False, allow_none=True)
         except socket.error:
             ip=socket.gethostbyname(interface[0])
@@ -56,66 +71,97 @@ class PRServer(SimpleXMLRPCServer):
         self.pidfile=PIDPREFIX % (self.host, self.port)
 
         self.register_function(self.getPR, "getPR")
+        self.register_function(self.getPRs, "getPRs")
         self.register_function(self.quit, "quit")
         self.register_function(self.ping, "ping")
         self.register_function(self.export, "export")
+        self.register_function(self.exportpage, "exportpage")
         self.register_function(self.importone, "importone")
+        self.register_function(self.importmany, "importmany")
         self.register_introspection_functions()
 
         self.db = prserv.db.PRData(self.dbfile)
         self.table = self.db["PRMAIN"]
 
-        self.requestqueue = Queue.Queue()
-        self.handlerthread = threading.Thread(target = self.process_request_thread)
-        self.handlerthread.daemon = False
-
-    def process_request_thread(self):
-        """Same as in BaseServer but as a thread.
-
-        In addition, exception handling is done here.
-
-        """
-        iter_count = 1
-        # 60 iterations between syncs or sync if dirty every ~30 seconds
-        iterations_between_sync = 60
-
-        while not self.quit:
-            try:
-                (request, client_address) = self.requestqueue.get(True, 30)
-            except Queue.Empty:
-                self.table.sync_if_dirty()
-                continue
-            try:
-                self.finish_request(request, client_address)
-                self.shutdown_request(request)
-                iter_count = (iter_count + 1) % iterations_between_sync
-                if iter_count == 0:
-                    self.table.sync_if_dirty()
-            except:
-                self.handle_error(request, client_address)
-                self.shutdown_request(request)
-                self.table.sync()
-            self.table.sync_if_dirty()
+        # dblock serialises the use of the database connection. The
+        # commits started is only changed with it held, the rest of the
+        # group commit state with commitcond held.
+        self.dblock = threading.Lock()
+        self.commitcond = threading.Condition()
+        self.commits_started = 0
+        self.commits_done = 0
+        self.committing = False
 
     def sigint_handler(self, signum, stack):
-        self.table.sync()
+        with self.dblock:
+            self.table.sync()
 
     def sigterm_handler(self, signum, stack):
-        self.table.sync()
+        with self.dblock:
+            self.table.sync()
         raise SystemExit
 
-    def process_request(self, request, client_address):
-        self.requestqueue.put((request, client_address))
+    def run_committed(self, func, *args):
+        """
+        Call func(*args) with the database to ourselves and return its
+        result once what it wrote, or read of others' writes, is committed
+        """
+        with self.dblock:
+            result = func(*args)
+            needed = self.commits_started
+            if self.table.dirty:
+                needed += 1
+
+        with self.commitcond:
+            while self.commits_done < needed:
+                if self.committing:
+                    self.commitcond.wait()
+                    continue
+                # Commit everything written so far on behalf of all the
+                # requests waiting
+                self.committing = True
+                self.commitcond.release()
+                try:
+                    with self.dblock:
+                        self.commits_started += 1
+                        commit = self.commits_started
+                        self.table.sync_if_dirty()
+                finally:
+                    self.commitcond.acquire()
+                    self.committing = False
+                    self.commits_done = commit
+                    self.commitcond.notify_all()
+        return result
 
     def export(self, version=None, pkgarch=None, checksum=None, colinfo=True):
         try:
-            return self.table.export(version, pkgarch, checksum, colinfo)
+            return self.run_committed(self.table.export, version, pkgarch, checksum, colinfo)
+        except sqlite3.Error as exc:
+            logger.error(str(exc))
+            return None
+
+    def exportpage(self, version, pkgarch, checksum, colinfo, after, count):
+        """
+        export() a page of count rows from after the (version, pkgarch,
+        checksum) of after, or from the start if it is empty
+        """
+        try:
+            return self.run_committed(self.table.export, version, pkgarch, checksum, colinfo, after, count)
         except sqlite3.Error as exc:
             logger.error(str(exc))
             return None
 
     def importone(self, version, pkgarch, checksum, value):
-        return self.table.importone(version, pkgarch, checksum, value)
+        return self.run_committed(self.table.importone, version, pkgarch, checksum, value)
+
+    def importmany(self, entries):
+        """
+        importone() for each (version, pkgarch, checksum, value) in
+        entries, returning the list of results
+        """
+        def importall():
+            return [self.table.importone(*entry) for entry in entries]
+        return self.run_committed(importall)
 
     def ping(self):
         return not self.quit
@@ -123,7 +169,7 @@ class PRServer(SimpleXMLRPCServer):
     def getinfo(self):
         return (self.host, self.port)
 
-    def getPR(self, version, pkgarch, checksum):
+    def _getPR(self, version, pkgarch, checksum):
         try:
             return self.table.getValue(version, pkgarch, checksum)
         except prserv.NotFoundError:
@@ -133,6 +179,26 @@ class PRServer(SimpleXMLRPCServer):
             logger.error(str(exc))
             return None
 
+    def getPR(self, version, pkgarch, checksum):
+        value = self.table.cached(version, pkgarch, checksum)
+        if value is not None:
+            return value
+        return self.run_committed(self._getPR, version, pkgarch, checksum)
+
+    def getPRs(self, queries):
+        """
+        getPR() for each (version, pkgarch, checksum) in queries, returning
+        the list of values
+        """
+        values = [self.table.cached(*query) for query in queries]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            def getmissing():
+                return [self._getPR(*queries[i]) for i in missing]
+            for i, value in zip(missing, self.run_committed(getmissing)):
+                values[i] = value
+        return values
+
     def quit(self):
         self.quit=True
         return
@@ -144,11 +210,11 @@ class PRServer(SimpleXMLRPCServer):
         logger.info("Started PRServer with DBfile: %s, IP: %s, PORT: %s, PID: %s" %
                      (self.dbfile, self.host, self.port, str(os.getpid())))
 
-        self.handlerthread.start()
         while not self.quit:
             self.handle_request()
-        self.handlerthread.join()
-        self.db.disconnect()
+        with self.dblock:
+            self.table.sync_if_dirty()
+            self.db.disconnect()
         logger.info("PRServer: stopping...")
         self.server_close()
         return
@@ -276,15 +342,65 @@ class PRServerConnection(object):
     def getPR(self, version, pkgarch, checksum):
         return self.connection.getPR(version, pkgarch, checksum)
 
+    def getPRs(self, queries):
+        """
+        Return the PRs for a list of (version, pkgarch, checksum) in a
+        single request, or one at a time from servers without getPRs
+        """
+        try:
+            return self.connection.getPRs(queries)
+        except xmlrpclib.Fault as exc:
+            if "getPRs" not in exc.faultString:
+                raise
+            return [self.getPR(*query) for query in queries]
+
     def ping(self):
         return self.connection.ping()
 
     def export(self,version=None, pkgarch=None, checksum=None, colinfo=True):
-        return self.connection.export(version, pkgarch, checksum, colinfo)
+        """
+        Export the rows a page at a time, so that the server answers
+        others in between, or all at once from servers without exportpage
+        """
+        metainfo, datainfo = None, []
+        after = []
+        while True:
+            try:
+                page = self.connection.exportpage(version, pkgarch, checksum, colinfo and not after,
+                                                  after, PAGESIZE)
+            except xmlrpclib.Fault as exc:
+                if "exportpage" not in exc.faultString:
+                    raise
+                return self.connection.export(version, pkgarch, checksum, colinfo)
+            if page is None:
+                return None
+            if metainfo is None:
+                metainfo = page[0]
+            if not page[1]:
+                return (metainfo, datainfo)
+            datainfo.extend(page[1])
+            last = page[1][-1]
+            after = [last['version'], last['pkgarch'], last['checksum']]
 
     def importone(self, version, pkgarch, checksum, value):
         return self.connection.importone(version, pkgarch, checksum, value)
 
+    def importmany(self, entries):
+        """
+        Import a list of (version, pkgarch, checksum, value) a page per
+        request, or one at a time into servers without importmany
+        """
+        results = []
+        for i in range(0, len(entries), PAGESIZE):
+            page = entries[i:i + PAGESIZE]
+            try:
+                results.extend(self.connection.importmany(page))
+            except xmlrpclib.Fault as exc:
+                if "importmany" not in exc.faultString:
+                    raise
+                results.extend(self.importone(*entry) for entry in page)
+        return results
+
     def getinfo(self):
         return self.host, self.port
 
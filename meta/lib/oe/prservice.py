@@ -46,6 +46,7 @@ def prserv_import_db(d, filter_version=None, filter_pkgarch=None, filter_checksu
             return None
     #get the entry values
     imported = []
+    entries = []
     prefix = "PRAUTO$"
     for v in d.keys():
         if v.startswith(prefix):
@@ -62,11 +63,12 @@ def prserv_import_db(d, filter_version=None, filter_pkgarch=None, filter_checksu
             except BaseException as exc:
                 bb.debug("Not valid value of %s:%s" % (v,str(exc)))
                 continue
-            ret = conn.importone(version,pkgarch,checksum,value)
-            if ret != value:
-                bb.error("importing(%s,%s,%s,%d) failed. DB may have larger value %d" % (version,pkgarch,checksum,value,ret))
-            else:
-               imported.append((version,pkgarch,checksum,value))
+            entries.append((version,pkgarch,checksum,value))
+    for (version,pkgarch,checksum,value), ret in zip(entries, conn.importmany(entries)):
+        if ret != value:
+            bb.error("importing(%s,%s,%s,%d) failed. DB may have larger value %d" % (version,pkgarch,checksum,value,ret))
+        else:
+            imported.append((version,pkgarch,checksum,value))
     return imported
 
 def prserv_export_tofile(d, metainfo, datainfo, lockdown, nomax=False):
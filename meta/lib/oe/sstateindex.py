@@ -0,0 +1,91 @@
+#
+# Indexes of the sstate objects available, so that sstate_checkhashes()
+# doesn't have to check for each object on its own.
+#
+# An index is asked about objects by their path relative to SSTATE_DIR
+# or the mirror, and answers True if the object is there, False if it
+# isn't, or None if it doesn't know and the object has to be checked
+# for the usual way.
+#
+
+import errno
+import os
+
+class SstateIndex(object):
+    def available(self, path):
+        return None
+
+class LocalIndex(SstateIndex):
+    """
+    The objects in a directory, found by listing each subdirectory the
+    paths to be asked about are in once, rather than checking for each.
+    Only the objects found are checked for.
+    """
+    def __init__(self, sstatedir, paths):
+        self.sstatedir = sstatedir
+        self.listings = {}
+        for path in paths:
+            subdir = os.path.dirname(path)
+            if subdir not in self.listings:
+                self.listings[subdir] = self._list(subdir)
+
+    def _list(self, subdir):
+        try:
+            return set(os.listdir(os.path.join(self.sstatedir, subdir)))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return set()
+
+    def available(self, path):
+        subdir, name = os.path.split(path)
+        if subdir not in self.listings:
+            return None
+        if name not in self.listings[subdir]:
+            return False
+        # Fetches from file:// mirrors leave symlinks, which can dangle
+        return os.path.exists(os.path.join(self.sstatedir, path))
+
+class ManifestIndex(SstateIndex):
+    """
+    The objects listed in a manifest published along with a mirror, one
+    path per line. The manifest can be older than the mirror's contents,
+    so objects it doesn't list are unknown rather than missing.
+    """
+    def __init__(self, manifest):
+        self.paths = set()
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    self.paths.add(line)
+
+    def available(self, path):
+        if path in self.paths:
+            return True
+        return None
+
+def write_manifest(sstatedir, manifest):
+    """
+    Write a manifest of the objects in sstatedir for ManifestIndex, and
+    return the number listed
+    """
+    paths = []
+    for root, dirs, files in os.walk(sstatedir):
+        dirs.sort()
+        reldir = os.path.relpath(root, sstatedir)
+        for name in sorted(files):
+            if not name.startswith("sstate:"):
+                continue
+            if not os.path.exists(os.path.join(root, name)):
+                continue
+            if reldir != ".":
+                name = os.path.join(reldir, name)
+            paths.append(name)
+
+    tmpfile = manifest + ".tmp"
+    with open(tmpfile, "w") as f:
+        for path in paths:
+            f.write(path + "\n")
+    os.rename(tmpfile, manifest)
+    return len(paths)
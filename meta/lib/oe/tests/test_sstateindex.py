@@ -0,0 +1,40 @@
+import unittest
+import oe, oe.sstateindex
+import tempfile
+import os
+import shutil
+
+class TestSstateIndex(unittest.TestCase):
+    OBJECTS = [ "ab/sstate:foo:abcd_populate_sysroot.tgz",
+                "ab/sstate:foo:abcd_populate_sysroot.tgz.siginfo",
+                "x86_64/cd/sstate:bar:cdef_package.tgz" ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix = "oe-test_sstateindex")
+        for path in self.OBJECTS:
+            path = os.path.join(self.tmpdir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+        # As left by a fetch from a file:// mirror which has since gone
+        os.symlink(os.path.join(self.tmpdir, "gone"),
+                   os.path.join(self.tmpdir, "ab/sstate:foo:abef_package.tgz"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_local(self):
+        wanted = self.OBJECTS + [ "ab/sstate:foo:abef_package.tgz", "ef/sstate:baz:ef01_package.tgz" ]
+        index = oe.sstateindex.LocalIndex(self.tmpdir, wanted)
+        self.assertEqual([ index.available(path) for path in wanted ], [ True, True, True, False, False ])
+        self.assertEqual(index.available("01/sstate:baz:0123_package.tgz"), None)
+
+    def test_manifest(self):
+        manifest = os.path.join(self.tmpdir, "sstate-index.txt")
+        self.assertEqual(oe.sstateindex.write_manifest(self.tmpdir, manifest), 3)
+        index = oe.sstateindex.ManifestIndex(manifest)
+        for path in self.OBJECTS:
+            self.assertTrue(index.available(path))
+        # Possibly added to the mirror since
+        self.assertEqual(index.available("ef/sstate:baz:ef01_package.tgz"), None)
+        self.assertEqual(index.available("sstate-index.txt"), None)